@@ -13,9 +13,11 @@ import torch
 from torch import Tensor
 
 import math
-from typing import Tuple, Optional, NamedTuple
+from typing import Dict, List, Tuple, Optional, NamedTuple, Sequence
 import sys
 import warnings
+
+from flexibletopology.utils.neighbors import cumsum_from_zero, neighbor_pairs_nopbc_cell_list
 has_cuaev = False
 
 if sys.version_info[:2] < (3, 7):
@@ -27,6 +29,28 @@ else:
     from torch.jit import Final
 
 
+# Number of atoms per molecule from which the neighbor search without PBC
+# switches from checking all pairs to a linked cell list.
+CELL_LIST_THRESHOLD = 768
+
+# Number of atoms per molecule up to which the AEVs without PBC are computed
+# from all the pairs and triplets with compute_aev_dense. Timed with the
+# ani-1ccx parameters, scripted forward and backward on one CPU thread, it is
+# 5-10% faster than the pairs from 3 to 5 atoms and breaks even at about 6
+# (30% slower at 10). Below 3 atoms there are no triplets and the pairs win.
+SMALL_SYSTEM_THRESHOLD = 5
+
+# Precision policies of the AEV computation: 'native' computes and
+# accumulates in the dtype of the coordinates, 'single' in float32 and
+# 'mixed' computes the terms in float32 and accumulates them in float64.
+PRECISIONS = ('native', 'single', 'mixed')
+
+# Reductions of the terms into the AEVs: 'scatter' adds them with
+# index_add_, 'segment' sorts them by destination and sums the runs with
+# segment_reduce, see add_rows_.
+REDUCTIONS = ('scatter', 'segment')
+
+
 class SpeciesAEV(NamedTuple):
     species: Tensor
     aevs: Tensor
@@ -122,6 +146,120 @@ def charge_terms(Rcr: float, EtaR: Tensor, ShfR: Tensor, distances: Tensor, char
     return ret.flatten(start_dim=1)
 
 
+def radial_charge_terms(Rcr: float, EtaR: Tensor, ShfR: Tensor, distances: Tensor, charges: Tensor) -> Tensor:
+    """Compute the radial and the charge radial subAEV terms of the center
+    atom given neighbors in one pass.
+
+    This is the fusion of :func:`radial_terms` and :func:`charge_terms`:
+    the Gaussian and the cosine of the cutoff are evaluated once per pair
+    and shared by both channels. The output tensor has the shape
+    (pairs, 2 * ``radial_sublength``), the radial terms are followed by the
+    charge terms.
+    """
+    distances = distances.view(-1, 1, 1)
+    charges = charges.view(-1, 1, 1)
+    half_cosine = 0.5 * torch.cos(distances * (math.pi / Rcr))
+    # 0.25 coefficient of NeuroChem, see radial_terms
+    gaussian = 0.25 * torch.exp(-EtaR * (distances - ShfR)**2)
+    radial = gaussian * (half_cosine + 0.5)
+    charge = gaussian * (charges * half_cosine + 0.5)
+    return torch.cat([radial.flatten(start_dim=1), charge.flatten(start_dim=1)], dim=1)
+
+
+def radial_basis(Rcr: float, EtaR: Tensor, ShfR: Tensor, distances: Tensor) -> Tuple[Tensor, Tensor]:
+    """Compute the two functions of the distance that the radial and the
+    charge radial terms are made of, with their derivatives.
+
+    With the Gaussians ``G`` and ``H = G * 0.5 * cos(pi * d / Rcr)`` the
+    radial terms are ``H + 0.5 * G`` and the charge terms ``0.5 * G + q * H``.
+    Returns the values and the derivatives, both of shape
+    (pairs, 2 * ``radial_sublength``) with ``G`` followed by ``H``.
+    """
+    distances = distances.view(-1, 1, 1)
+    half_cosine = 0.5 * torch.cos(distances * (math.pi / Rcr))
+    d_half_cosine = -0.5 * (math.pi / Rcr) * torch.sin(distances * (math.pi / Rcr))
+    gaussian = 0.25 * torch.exp(-EtaR * (distances - ShfR)**2)
+    d_gaussian = -2 * EtaR * (distances - ShfR) * gaussian
+    values = torch.cat([gaussian.flatten(start_dim=1),
+                        (gaussian * half_cosine).flatten(start_dim=1)], dim=1)
+    derivatives = torch.cat([d_gaussian.flatten(start_dim=1),
+                             (d_gaussian * half_cosine + gaussian * d_half_cosine).flatten(start_dim=1)],
+                            dim=1)
+    return values, derivatives
+
+
+def radial_spline_table(Rcr: float, EtaR: Tensor, ShfR: Tensor, num_intervals: int) -> Tensor:
+    """Tabulate :func:`radial_basis` as cubic Hermite splines on
+    ``num_intervals`` equal intervals of [0, Rcr].
+
+    The spline of every interval matches the values and the derivatives of
+    the basis at both of its ends. The table is computed in float64 and
+    holds the coefficients of the polynomials of the interval coordinate
+    ``t`` in [0, 1], with the shape
+    (``num_intervals``, 4, 2 * ``radial_sublength``) where the second
+    dimension is the power of ``t``.
+    """
+    spacing = Rcr / num_intervals
+    distances = torch.linspace(0, Rcr, num_intervals + 1, dtype=torch.float64, device=EtaR.device)
+    values, derivatives = radial_basis(Rcr, EtaR.to(torch.float64), ShfR.to(torch.float64),
+                                       distances)
+    tangents = derivatives * spacing
+    p0, p1 = values[:-1], values[1:]
+    m0, m1 = tangents[:-1], tangents[1:]
+    return torch.stack([p0, m0, 3 * (p1 - p0) - 2 * m0 - m1, 2 * (p0 - p1) + m0 + m1], dim=1)
+
+
+def radial_spline_error_bound(Rcr: float, EtaR: Tensor, ShfR: Tensor, num_intervals: int) -> float:
+    """Bound of the error of the radial and charge radial terms interpolated
+    from a :func:`radial_spline_table`, for charges in [-1, 1].
+
+    The cubic Hermite interpolation of a function ``f`` with the spacing
+    ``h`` is off by at most ``h**4 / 384 * max|f^(4)|``. The fourth
+    derivatives of ``G`` and ``H`` are estimated with finite differences on
+    a grid 16 times finer than the table. A radial or charge term adds the
+    errors of ``G`` and ``H`` with weights summing to at most 1.5. The
+    rounding errors of the dtype the table is evaluated in come on top.
+    """
+    spacing = Rcr / num_intervals
+    step = spacing / 16
+    distances = torch.arange(0, 16 * num_intervals + 1, dtype=torch.float64) * step
+    values, _ = radial_basis(Rcr, EtaR.cpu().to(torch.float64), ShfR.cpu().to(torch.float64),
+                             distances)
+    fourth_derivative = (values[4:] - 4 * values[3:-1] + 6 * values[2:-2] -
+                         4 * values[1:-3] + values[:-4]) / step**4
+    return 1.5 * spacing**4 / 384 * float(fourth_derivative.abs().max())
+
+
+def interpolate_radial_spline(table: Tensor, Rcr: float, distances: Tensor,
+                              derivative: bool = False) -> Tensor:
+    """Evaluate :func:`radial_basis` (or its derivative with respect to the
+    distances) for distances in [0, Rcr] from a :func:`radial_spline_table`.
+
+    The values are differentiable with respect to ``distances``.
+    """
+    num_intervals = table.shape[0]
+    scaled = distances * (num_intervals / Rcr)
+    interval = scaled.detach().floor().clamp(0, num_intervals - 1)
+    t = (scaled - interval).unsqueeze(1)
+    coefficients = table.index_select(0, interval.to(torch.long))
+    c0, c1, c2, c3 = coefficients.unbind(1)
+    if derivative:
+        ret = torch.addcmul(2 * c2, 3 * c3, t)
+        return torch.addcmul(c1, ret, t) * (num_intervals / Rcr)
+    ret = torch.addcmul(c2, c3, t)
+    ret = torch.addcmul(c1, ret, t)
+    return torch.addcmul(c0, ret, t)
+
+
+def tabulated_radial_charge_terms(Rcr: float, table: Tensor, distances: Tensor,
+                                  charges: Tensor) -> Tensor:
+    """Same as :func:`radial_charge_terms` with the Gaussians and the cutoff
+    interpolated from a :func:`radial_spline_table` instead of evaluated."""
+    gaussian, gaussian_cosine = interpolate_radial_spline(table, Rcr, distances).chunk(2, dim=1)
+    return torch.cat([gaussian_cosine + 0.5 * gaussian,
+                      torch.addcmul(0.5 * gaussian, charges.view(-1, 1), gaussian_cosine)], dim=1)
+
+
 def angular_terms(Rca: float, ShfZ: Tensor, EtaA: Tensor, Zeta: Tensor,
                   ShfA: Tensor, vectors12: Tensor) -> Tensor:
     """Compute the angular subAEV terms of the center atom given neighbor pairs.
@@ -154,6 +292,37 @@ def angular_terms(Rca: float, ShfZ: Tensor, EtaA: Tensor, Zeta: Tensor,
     return ret.flatten(start_dim=1)
 
 
+def angular_terms_acos_free(Rca: float, cos_ShfZ: Tensor, sin_ShfZ: Tensor, EtaA: Tensor,
+                            Zeta: Tensor, ShfA: Tensor, vectors12: Tensor) -> Tensor:
+    r"""Compute the angular subAEV terms like :func:`angular_terms` without
+    calling ``acos`` and ``cos`` for every triplet.
+
+    With :math:`\cos\theta = 0.95 \cos\theta_{ijk}` (``acos`` returns
+    angles in :math:`[0, \pi]`, so :math:`\sin\theta \geq 0`) the shifted
+    cosine is expanded as
+
+    :math::
+    \cos(\theta - \theta_s) = \cos\theta \cos\theta_s +
+    \sqrt{1 - \cos^2\theta} \sin\theta_s
+
+    where ``cos_ShfZ`` and ``sin_ShfZ`` are precomputed from ``ShfZ``.
+    """
+    vectors12 = vectors12.view(2, -1, 3, 1, 1, 1, 1)
+    distances12 = vectors12.norm(2, dim=-5)
+    cos_angles = vectors12.prod(0).sum(
+        1) / torch.clamp(distances12.prod(0), min=1e-10)
+    # the same 0.95 factor as in angular_terms, which also keeps the square
+    # root away from zero
+    cos_angles = 0.95 * cos_angles
+    sin_angles = torch.sqrt(1 - cos_angles ** 2)
+
+    fcj12 = cutoff_cosine(distances12, Rca)
+    factor1 = ((1 + cos_angles * cos_ShfZ + sin_angles * sin_ShfZ) / 2) ** Zeta
+    factor2 = torch.exp(-EtaA * (distances12.sum(0) / 2 - ShfA) ** 2)
+    ret = 2 * factor1 * factor2 * fcj12.prod(0)
+    return ret.flatten(start_dim=1)
+
+
 def compute_shifts(cell: Tensor, pbc: Tensor, cutoff: float) -> Tensor:
     """Compute the shifts of unit cell along the given cell vectors to make it
     large enough to contain all pairs of neighbor atoms with PBC under
@@ -163,6 +332,8 @@ def compute_shifts(cell: Tensor, pbc: Tensor, cutoff: float) -> Tensor:
         cell (:class:`torch.Tensor`): tensor of shape (3, 3) of the three
         vectors defining unit cell:
             tensor([[x1, y1, z1], [x2, y2, z2], [x3, y3, z3]])
+            or of shape (molecules, 3, 3) with one cell per molecule, the
+            shifts then cover the cells of all the molecules.
         cutoff (float): the cutoff inside which atoms are considered pairs
         pbc (:class:`torch.Tensor`): boolean vector of size 3 storing
             if pbc is enabled for that direction.
@@ -171,8 +342,8 @@ def compute_shifts(cell: Tensor, pbc: Tensor, cutoff: float) -> Tensor:
         :class:`torch.Tensor`: long tensor of shifts. the center cell and
             symmetric cells are not included.
     """
-    reciprocal_cell = cell.inverse().t()
-    inv_distances = reciprocal_cell.norm(2, -1)
+    reciprocal_cell = cell.inverse().transpose(-2, -1)
+    inv_distances = reciprocal_cell.norm(2, -1).reshape(-1, 3).max(0).values
     num_repeats = torch.ceil(cutoff * inv_distances).to(torch.long)
     num_repeats = torch.where(pbc, num_repeats, num_repeats.new_zeros(()))
     r1 = torch.arange(1, num_repeats[0].item() + 1, device=cell.device)
@@ -206,7 +377,8 @@ def neighbor_pairs(padding_mask: Tensor, coordinates: Tensor, cell: Tensor,
         coordinates (:class:`torch.Tensor`): tensor of shape
             (molecules, atoms, 3) for atom coordinates.
         cell (:class:`torch.Tensor`): tensor of shape (3, 3) of the three vectors
-            defining unit cell: tensor([[x1, y1, z1], [x2, y2, z2], [x3, y3, z3]])
+            defining unit cell: tensor([[x1, y1, z1], [x2, y2, z2], [x3, y3, z3]]),
+            or of shape (molecules, 3, 3) with one cell per molecule
         cutoff (float): the cutoff inside which atoms are considered pairs
         shifts (:class:`torch.Tensor`): tensor of shape (?, 3) storing shifts
     """
@@ -250,11 +422,172 @@ def neighbor_pairs(padding_mask: Tensor, coordinates: Tensor, cell: Tensor,
     return molecule_index + atom_index12, shifts
 
 
-def neighbor_pairs_nopbc(padding_mask: Tensor, coordinates: Tensor, cutoff: float) -> Tensor:
+def pair_shift_values(shifts: Tensor, cell: Tensor, atom_index12: Tensor, num_atoms: int) -> Tensor:
+    """Cartesian shifts of the pairs from their integer ``shifts`` of shape
+    (pairs, 3), with the cell of shape (3, 3) or with the cells of their
+    molecules if ``cell`` has shape (molecules, 3, 3). ``atom_index12``
+    indexes the flattened ``(molecules * num_atoms)`` atoms."""
+    shifts = shifts.to(cell.dtype)
+    if cell.dim() == 2:
+        return shifts @ cell
+    molecule_index = torch.div(atom_index12[0], num_atoms, rounding_mode="floor")
+    return torch.bmm(shifts.unsqueeze(1), cell.index_select(0, molecule_index)).squeeze(1)
+
+
+def minimum_image_holds(cell: Tensor, pbc: Tensor, cutoff: float) -> Tensor:
+    """:func:`minimum_image_applies` as a boolean scalar tensor, which
+    does not synchronize with the device."""
+    heights = 1 / cell.detach().inverse().transpose(-2, -1).norm(2, -1)
+    heights = torch.where(pbc, heights, torch.full_like(heights, math.inf))
+    return (2 * cutoff < heights).all()
+
+
+def minimum_image_applies(cell: Tensor, pbc: Tensor, cutoff: float) -> bool:
+    """Check whether the minimum image convention finds all pairs of
+    neighbors, i.e. whether the cutoff is smaller than half of the
+    shortest height of the unit cell along the periodic directions.
+    Then no atom has more than one image of another atom (or of itself)
+    within the cutoff.
+
+    Arguments:
+        cell (:class:`torch.Tensor`): tensor of shape (3, 3) of the three
+            vectors defining unit cell, or of shape (molecules, 3, 3), then
+            the convention must apply to all of the cells
+        pbc (:class:`torch.Tensor`): boolean vector of size 3 storing
+            if pbc is enabled for that direction.
+        cutoff (float): the cutoff inside which atoms are considered pairs
+    """
+    return bool(minimum_image_holds(cell, pbc, cutoff))
+
+
+def neighbor_pairs_minimum_image(padding_mask: Tensor, coordinates: Tensor, cell: Tensor,
+                                 pbc: Tensor, cutoff: float) -> Tuple[Tensor, Tensor]:
+    """Compute pairs of atoms that are neighbors using the minimum image
+    convention
+
+    Each pair is only checked once, with the image of the second atom
+    whose fractional displacement lies in [-0.5, 0.5] along every
+    periodic direction. This is only correct for orthorhombic and
+    triclinic cells when :func:`minimum_image_applies`, in which case
+    the result contains the same pairs and shifts as
+    :func:`neighbor_pairs` without enumerating the shifted cells.
+
+    Arguments:
+        padding_mask (:class:`torch.Tensor`): boolean tensor of shape
+            (molecules, atoms) for padding mask. 1 == is padding.
+        coordinates (:class:`torch.Tensor`): tensor of shape
+            (molecules, atoms, 3) for atom coordinates.
+        cell (:class:`torch.Tensor`): tensor of shape (3, 3) of the three vectors
+            defining unit cell: tensor([[x1, y1, z1], [x2, y2, z2], [x3, y3, z3]]),
+            or of shape (molecules, 3, 3) with one cell per molecule
+        pbc (:class:`torch.Tensor`): boolean vector of size 3 storing
+            if pbc is enabled for that direction.
+        cutoff (float): the cutoff inside which atoms are considered pairs
+    """
+    coordinates = coordinates.detach().masked_fill(
+        padding_mask.unsqueeze(-1), math.nan)
+    cell = cell.detach()
+    num_atoms = padding_mask.shape[1]
+    num_mols = padding_mask.shape[0]
+    p12_all = torch.triu_indices(num_atoms, num_atoms, 1, device=cell.device)
+
+    pair_coordinates = coordinates.index_select(
+        1, p12_all.view(-1)).view(num_mols, 2, -1, 3)
+    vec = pair_coordinates[:, 0, ...] - pair_coordinates[:, 1, ...]
+    shifts = -torch.round(vec @ cell.inverse())
+    shifts = torch.where(pbc, shifts, shifts.new_zeros(()))
+    distances = (vec + shifts @ cell).norm(2, -1)
+    in_cutoff = (distances <= cutoff).nonzero()
+    molecule_index, pair_index = in_cutoff.unbind(1)
+    atom_index12 = p12_all[:, pair_index] + molecule_index * num_atoms
+    shifts = shifts[molecule_index, pair_index].to(torch.long)
+
+    # compute_shifts only has the shifts whose first nonzero component is
+    # positive, the pairs with the opposite shift are stored reversed there.
+    # The orientation matters because the charge AEV uses the charge of the
+    # second atom of a pair.
+    first_nonzero = shifts.gather(
+        1, (shifts != 0).to(torch.int8).argmax(1, keepdim=True)).squeeze(1)
+    reverse = first_nonzero < 0
+    atom_index12 = torch.where(reverse, atom_index12.flip(0), atom_index12)
+    shifts = torch.where(reverse.unsqueeze(1), -shifts, shifts)
+    return atom_index12, shifts
+
+
+def neighbor_pairs_nopbc_centers(padding_mask: Tensor, coordinates: Tensor, center_mask: Tensor,
+                                 cutoff: float) -> Tensor:
+    """Compute pairs of atoms that are neighbors and of which at least one
+    is a center atom (doesn't use PBC)
+
+    Only the distances between the center atoms and all the atoms of their
+    molecule are computed, so the cost is proportional to
+    ``centers * atoms``. The returned pairs, including their order, are the
+    ones of :func:`neighbor_pairs_nopbc_all_pairs` with a center atom.
+
+    Arguments:
+        padding_mask (:class:`torch.Tensor`): boolean tensor of shape
+            (molecules, atoms) for padding mask. 1 == is padding.
+        coordinates (:class:`torch.Tensor`): tensor of shape
+            (molecules, atoms, 3) for atom coordinates.
+        center_mask (:class:`torch.Tensor`): boolean tensor of shape
+            (molecules, atoms), 1 == is a center atom.
+        cutoff (float): the cutoff inside which atoms are considered pairs
+    """
+    coordinates = coordinates.detach().masked_fill(
+        padding_mask.unsqueeze(-1), math.nan)
+    current_device = coordinates.device
+    num_atoms = padding_mask.shape[1]
+    num_mols = padding_mask.shape[0]
+    flat_coordinates = coordinates.flatten(0, 1)
+    flat_center_mask = center_mask.flatten()
+
+    centers = (center_mask & ~padding_mask).flatten().nonzero().flatten()
+    molecule_start = torch.div(centers, num_atoms, rounding_mode="floor") * num_atoms
+    others = molecule_start.unsqueeze(1) + torch.arange(num_atoms, device=current_device)
+    centers = centers.unsqueeze(1).expand_as(others)
+    # pairs of two centers are only kept once, from the smaller index
+    keep = (others != centers) & (~flat_center_mask[others] | (others > centers))
+
+    distances = (flat_coordinates.index_select(0, centers.flatten()) -
+                 flat_coordinates.index_select(0, others.flatten())).norm(2, -1)
+    in_cutoff = (keep.flatten() & (distances <= cutoff)).nonzero().flatten()
+    atom_index1 = centers.flatten().index_select(0, in_cutoff)
+    atom_index2 = others.flatten().index_select(0, in_cutoff)
+    atom_index12 = torch.stack([torch.minimum(atom_index1, atom_index2),
+                                torch.maximum(atom_index1, atom_index2)])
+
+    # restore the ordering of the all-pairs search
+    pair_order = (atom_index12[0] * (num_mols * num_atoms) + atom_index12[1]).argsort()
+    return atom_index12.index_select(1, pair_order)
+
+
+def neighbor_pairs_nopbc(padding_mask: Tensor, coordinates: Tensor, cutoff: float,
+                         cell_list_threshold: int = CELL_LIST_THRESHOLD) -> Tensor:
     """Compute pairs of atoms that are neighbors (doesn't use PBC)
 
     This function bypasses the calculation of shifts and duplication
-    of atoms in order to make calculations faster
+    of atoms in order to make calculations faster. Molecules with at
+    least ``cell_list_threshold`` atoms are searched with a linked cell
+    list (see :func:`neighbor_pairs_nopbc_cell_list`), smaller ones
+    with the all-pairs search.
+
+    Arguments:
+        padding_mask (:class:`torch.Tensor`): boolean tensor of shape
+            (molecules, atoms) for padding mask. 1 == is padding.
+        coordinates (:class:`torch.Tensor`): tensor of shape
+            (molecules, atoms, 3) for atom coordinates.
+        cutoff (float): the cutoff inside which atoms are considered pairs
+        cell_list_threshold (int): number of atoms from which the cell
+            list search is used. A negative value disables it.
+    """
+    if cell_list_threshold >= 0 and padding_mask.shape[1] >= cell_list_threshold:
+        return neighbor_pairs_nopbc_cell_list(padding_mask, coordinates, cutoff)
+    return neighbor_pairs_nopbc_all_pairs(padding_mask, coordinates, cutoff)
+
+
+def neighbor_pairs_nopbc_all_pairs(padding_mask: Tensor, coordinates: Tensor, cutoff: float) -> Tensor:
+    """Compute pairs of atoms that are neighbors by checking all
+    ``A * (A - 1) / 2`` pairs of every molecule (doesn't use PBC)
 
     Arguments:
         padding_mask (:class:`torch.Tensor`): boolean tensor of shape
@@ -283,6 +616,207 @@ def neighbor_pairs_nopbc(padding_mask: Tensor, coordinates: Tensor, cutoff: floa
     return atom_index12
 
 
+def neighbor_pairs_packed(coordinates: Tensor, molecule_offsets: Tensor, cutoff: float) -> Tensor:
+    """Compute pairs of atoms that are neighbors in a packed batch of
+    molecules of different sizes (doesn't use PBC)
+
+    Only the ``A_m * (A_m - 1) / 2`` pairs inside of every molecule ``m``
+    are checked, so there is no padding. The pairs are sorted by their
+    first atom and then by their second atom.
+
+    Arguments:
+        coordinates (:class:`torch.Tensor`): tensor of shape (atoms, 3) of
+            the atoms of all the molecules one after the other.
+        molecule_offsets (:class:`torch.Tensor`): long tensor of shape
+            (molecules + 1) with the index of the first atom of every
+            molecule followed by the total number of atoms.
+        cutoff (float): the cutoff inside which atoms are considered pairs
+    """
+    coordinates = coordinates.detach()
+    current_device = coordinates.device
+    num_atoms = coordinates.shape[0]
+    sizes = molecule_offsets[1:] - molecule_offsets[:-1]
+    # every atom is paired with the following atoms of its molecule
+    molecule_end = torch.repeat_interleave(molecule_offsets[1:], sizes, output_size=num_atoms)
+    atom_index = torch.arange(num_atoms, device=current_device)
+    num_partners = molecule_end - atom_index - 1
+    num_pairs = int(num_partners.sum())
+    first = torch.repeat_interleave(atom_index, num_partners, output_size=num_pairs)
+    second = torch.arange(num_pairs, device=current_device) - \
+        torch.repeat_interleave(cumsum_from_zero(num_partners), num_partners, output_size=num_pairs) + \
+        first + 1
+    distances = (coordinates.index_select(0, first) - coordinates.index_select(0, second)).norm(2, -1)
+    in_cutoff = (distances <= cutoff).nonzero().flatten()
+    return torch.stack([first.index_select(0, in_cutoff), second.index_select(0, in_cutoff)])
+
+
+def environment_grid(coordinates: Tensor, cell_size: float) -> Tuple[Tensor, Tensor, Tensor, Tensor]:
+    """Sort the atoms of a static environment into a grid of cubic cells
+    for :func:`environment_pairs`
+
+    The bounding box of the atoms is divided into cells with an edge of
+    ``cell_size`` and padded by one empty cell on every side, like in
+    :func:`neighbor_pairs_nopbc_cell_list`.
+
+    Arguments:
+        coordinates (:class:`torch.Tensor`): tensor of shape (atoms, 3) of
+            the coordinates of the environment.
+        cell_size (float): the edge of the cells, at least the cutoff of
+            the queries.
+
+    Returns:
+        tuple: the lower corner of the grid, the number of cells along
+        each direction, ``cell_start`` the index in ``sorted_atoms`` of the
+        first atom of every cell (followed by the number of atoms) and
+        ``sorted_atoms`` the atoms sorted by cell.
+    """
+    coordinates = coordinates.detach()
+    lower_corner = coordinates.min(dim=0)[0] - cell_size
+    cell_index = torch.floor((coordinates - lower_corner) / cell_size).to(torch.long)
+    grid = cell_index.max(dim=0)[0] + 2
+    cell_key = (cell_index[:, 0] * grid[1] + cell_index[:, 1]) * grid[2] + cell_index[:, 2]
+    sorted_key, sorted_atoms = cell_key.sort()
+    cell_count = torch.bincount(sorted_key, minlength=int(grid.prod()))
+    cell_start = torch.cat([cumsum_from_zero(cell_count), cell_count.sum().view(1)])
+    return lower_corner, grid, cell_start, sorted_atoms
+
+
+def environment_pairs(coordinates: Tensor, environment_coordinates: Tensor, lower_corner: Tensor,
+                      grid: Tensor, cell_start: Tensor, sorted_atoms: Tensor, cell_size: float,
+                      cutoff: float) -> Tensor:
+    """Find the pairs of query atoms and environment atoms within ``cutoff``
+    with an :func:`environment_grid`
+
+    Only the environment atoms of the 27 cells around every query atom are
+    checked, the pairs of environment atoms are never enumerated. The
+    environment may have moved since the grid was built, as long as no
+    atom moved more than ``cell_size - cutoff``.
+
+    Arguments:
+        coordinates (:class:`torch.Tensor`): tensor of shape (atoms, 3) of
+            the query atoms.
+        environment_coordinates (:class:`torch.Tensor`): tensor of shape
+            (environment atoms, 3) of the current environment coordinates.
+
+    Returns:
+        :class:`torch.Tensor`: long tensor of shape (2, pairs) of the index
+        of the query atom and of the environment atom of every pair.
+    """
+    current_device = coordinates.device
+    coordinates = coordinates.detach()
+    cell_index = torch.floor((coordinates - lower_corner) / cell_size).to(torch.long)
+    # atoms outside of the grid are more than a cell away from the environment
+    cell_index = torch.minimum(cell_index.clamp(min=0), grid - 1)
+    r = torch.arange(-1, 2, device=current_device)
+    offsets = torch.cartesian_prod(r, r, r)
+    neighbor_cells = cell_index.unsqueeze(1) + offsets
+    inside = ((neighbor_cells >= 0) & (neighbor_cells < grid)).all(-1).flatten()
+    neighbor_keys = ((neighbor_cells[..., 0] * grid[1] + neighbor_cells[..., 1]) * grid[2]
+                     + neighbor_cells[..., 2]).flatten().clamp(min=0, max=int(grid.prod()) - 1)
+    neighbor_count = (cell_start.index_select(0, neighbor_keys + 1) -
+                      cell_start.index_select(0, neighbor_keys)) * inside
+    candidate_owner = torch.repeat_interleave(neighbor_count)
+    local_index = torch.arange(candidate_owner.shape[0], device=current_device) - \
+        cumsum_from_zero(neighbor_count).index_select(0, candidate_owner)
+    environment_index = sorted_atoms.index_select(
+        0, cell_start.index_select(0, neighbor_keys).index_select(0, candidate_owner) + local_index)
+    atom_index = torch.div(candidate_owner, offsets.shape[0], rounding_mode="floor")
+
+    distances = (coordinates.index_select(0, atom_index) -
+                 environment_coordinates.detach().index_select(0, environment_index)).norm(2, -1)
+    in_cutoff = (distances <= cutoff).nonzero().flatten()
+    return torch.stack([atom_index, environment_index]).index_select(1, in_cutoff)
+
+
+def neighbors_padded(padding_mask: Tensor, coordinates: Tensor, cutoff: float, angular_cutoff: float,
+                     capacity: int, angular_capacity: int, cell: Optional[Tensor] = None,
+                     pbc: Optional[Tensor] = None) -> Tuple[Tensor, Tensor, Tensor, Tensor, Tensor, Tensor]:
+    """Compute a padded neighbor list with a fixed number of slots per atom
+
+    Unlike the other neighbor searches all the shapes only depend on the
+    shape of the input and on the capacities, there is no ``nonzero`` and
+    no synchronization with the host, so the computation can be captured
+    as a static graph. All the pairs of atoms of a molecule are checked,
+    with the minimum image convention if a cell is given (see
+    :func:`minimum_image_applies`), and the closest neighbors of every atom
+    are kept in ``capacity`` slots, the closest ones within
+    ``angular_cutoff`` in the first ``angular_capacity`` of them.
+
+    Arguments:
+        padding_mask (:class:`torch.Tensor`): boolean tensor of shape
+            (molecules, atoms) for padding mask. 1 == is padding.
+        coordinates (:class:`torch.Tensor`): tensor of shape
+            (molecules, atoms, 3) for atom coordinates.
+        cutoff (float): the cutoff inside which atoms are considered pairs
+        angular_cutoff (float): the cutoff of the angular neighbors
+        capacity (int): the number of neighbor slots of every atom, at
+            most ``atoms``
+        angular_capacity (int): the number of angular neighbor slots of
+            every atom, at most ``capacity``
+        cell (:class:`torch.Tensor`, optional): tensor of shape (3, 3) of
+            the three vectors defining unit cell, or (molecules, 3, 3)
+        pbc (:class:`torch.Tensor`, optional): boolean vector of size 3
+            storing if pbc is enabled for that direction.
+
+    Returns:
+        tuple: ``neighbor_index``, the long tensor of shape
+        (molecules, atoms, capacity) of the index of the neighbors in their
+        molecule, sorted by increasing distance, ``shift_values`` the
+        cartesian shifts of the neighbors (same shape with a last dimension
+        of 3), ``neighbor_is_second`` whether the neighbor is the second atom
+        of the pair in the other neighbor searches (the charge AEV uses the
+        charge of that atom), ``mask`` whether the slot holds a neighbor
+        within ``cutoff``, ``angular_mask`` of shape
+        (molecules, atoms, angular_capacity) whether the slot holds a
+        neighbor within ``angular_cutoff``, and ``neighbor_counts``, the long
+        tensor of the largest numbers of neighbors within ``cutoff`` and
+        within ``angular_cutoff`` of an atom. Some neighbors did not fit if
+        they are larger than the capacities.
+    """
+    coordinates = coordinates.detach()
+    num_atoms = padding_mask.shape[1]
+    atom_index = torch.arange(num_atoms, device=coordinates.device)
+    # vectors from the first to the second atom of every pair
+    vec = coordinates.unsqueeze(1) - coordinates.unsqueeze(2)
+    if cell is None:
+        shift_values = torch.zeros_like(vec)
+        first_shift = torch.zeros_like(vec[..., 0])
+    else:
+        assert pbc is not None
+        cell = cell.detach()
+        if cell.dim() == 3:
+            cell = cell.unsqueeze(1)
+        # same shifts as neighbor_pairs_minimum_image for the pairs (i, j)
+        shifts = torch.round(vec @ cell.inverse())
+        shifts = torch.where(pbc, shifts, shifts.new_zeros(()))
+        shift_values = -(shifts @ cell)
+        # first nonzero component of the shift, which sets the orientation
+        first_shift = shifts.gather(
+            -1, (shifts != 0).to(torch.int8).argmax(-1, keepdim=True)).squeeze(-1)
+        vec = vec + shift_values
+    distances = vec.norm(2, -1)
+    upper = atom_index.unsqueeze(1) < atom_index.unsqueeze(0)
+    neighbor_is_second = (upper & (first_shift >= 0)) | (~upper & (first_shift > 0))
+
+    is_pair = ~(padding_mask.unsqueeze(1) | padding_mask.unsqueeze(2)) & \
+        (atom_index.unsqueeze(1) != atom_index.unsqueeze(0))
+    in_cutoff = is_pair & (distances <= cutoff)
+    in_angular_cutoff = is_pair & (distances <= angular_cutoff)
+    # a zero column keeps the maximum defined without atoms
+    neighbor_counts = torch.stack([in_cutoff.sum(-1).flatten(), in_angular_cutoff.sum(-1).flatten()])
+    neighbor_counts = torch.cat([neighbor_counts, neighbor_counts.new_zeros(2, 1)], 1).amax(1)
+
+    capacity = min(capacity, num_atoms)
+    angular_capacity = min(angular_capacity, capacity)
+    sort_key = torch.where(in_cutoff, distances, torch.full_like(distances, math.inf))
+    sorted_distances, neighbor_index = sort_key.topk(capacity, dim=-1, largest=False)
+    mask = sorted_distances <= cutoff
+    angular_mask = sorted_distances[..., :angular_capacity] <= angular_cutoff
+    shift_values = shift_values.gather(2, neighbor_index.unsqueeze(-1).expand(-1, -1, -1, 3))
+    neighbor_is_second = neighbor_is_second.gather(2, neighbor_index)
+    return neighbor_index, shift_values, neighbor_is_second, mask, angular_mask, neighbor_counts
+
+
 def triu_index(num_species: int) -> Tensor:
     species1, species2 = torch.triu_indices(num_species, num_species).unbind(0)
     pair_index = torch.arange(species1.shape[0], dtype=torch.long)
@@ -292,13 +826,40 @@ def triu_index(num_species: int) -> Tensor:
     return ret
 
 
-def cumsum_from_zero(input_: Tensor) -> Tensor:
-    cumsum = torch.zeros_like(input_)
-    torch.cumsum(input_[:-1], dim=0, out=cumsum[1:])
-    return cumsum
-
+def pruned_aev_index(num_species: int, species_subset: Sequence[int],
+                     radial_shape: Sequence[int], radial_channels: Sequence[Tensor],
+                     angular_shape: Sequence[int], angular_channels: Sequence[Tensor]) -> Tensor:
+    """Return the positions in the full AEV of the entries of an AEV
+    restricted to ``species_subset`` (in this order) and to the selected
+    values of the constants.
 
-def triple_by_molecule(atom_index12: Tensor) -> Tuple[Tensor, Tensor, Tensor]:
+    The shapes are the numbers of values of (EtaR, ShfR) and
+    (EtaA, Zeta, ShfA, ShfZ) of the full AEV and the channels the indices
+    of the kept values of each of these constants.
+    """
+    radial_sublength = int(torch.tensor(radial_shape).prod())
+    angular_sublength = int(torch.tensor(angular_shape).prod())
+    radial_length = num_species * radial_sublength
+    subset = torch.tensor(species_subset, dtype=torch.long)
+
+    # position of every kept channel in the sub-AEV of a single species
+    radial_sub_index = radial_channels[0].view(-1, 1) * radial_shape[1] + \
+        radial_channels[1].view(1, -1)
+    angular_sub_index = torch.zeros(1, dtype=torch.long)
+    for size, channels in zip(angular_shape, angular_channels):
+        angular_sub_index = (angular_sub_index.view(-1, 1) * size + channels.view(1, -1)).flatten()
+
+    radial_index = (subset.view(-1, 1) * radial_sublength + radial_sub_index.view(1, -1)).flatten()
+    full_triu_index = triu_index(num_species)
+    species1, species2 = torch.triu_indices(len(species_subset), len(species_subset)).unbind(0)
+    pairs = full_triu_index[subset[species1], subset[species2]]
+    angular_index = (pairs.view(-1, 1) * angular_sublength + angular_sub_index.view(1, -1)).flatten()
+    return torch.cat([radial_index, radial_index + radial_length,
+                      angular_index + 2 * radial_length])
+
+
+def triple_by_molecule(atom_index12: Tensor,
+                       center_mask: Optional[Tensor] = None) -> Tuple[Tensor, Tensor, Tensor]:
     """Input: indices for pairs of atoms that are close to each other.
     each pair only appear once, i.e. only one of the pairs (1, 2) and
     (2, 1) exists.
@@ -308,10 +869,21 @@ def triple_by_molecule(atom_index12: Tensor) -> Tuple[Tensor, Tensor, Tensor]:
     (1, 3), (1, 4), (2, 3), (2, 4), (3, 4), then the output would have
     central atom 0, 1, 2, 3, 4 and for cental atom 0, its pairs of neighbors
     are (1, 2), (1, 3), (1, 4), (2, 3), (2, 4), (3, 4)
+
+    The triplets are enumerated from the offsets of the central atoms
+    (CSR like), so the memory is proportional to the number of triplets
+    and not to atoms * (max neighbors) ** 2.
+
+    If the boolean ``center_mask`` over the atoms is given, only the
+    triplets whose central atom is in the mask are returned.
     """
     # convert representation from pair to central-others
     ai1 = atom_index12.view(-1)
     sorted_ai1, rev_indices = ai1.sort()
+    if center_mask is not None:
+        is_center = center_mask.index_select(0, sorted_ai1).nonzero().flatten()
+        sorted_ai1 = sorted_ai1.index_select(0, is_center)
+        rev_indices = rev_indices.index_select(0, is_center)
 
     # sort and compute unique key
     uniqued_central_atom_index, counts = torch.unique_consecutive(
@@ -324,14 +896,19 @@ def triple_by_molecule(atom_index12: Tensor) -> Tuple[Tensor, Tensor, Tensor]:
     central_atom_index = uniqued_central_atom_index.index_select(
         0, pair_indices)
 
-    # do local combinations within unique key, assuming sorted
-    m = counts.max().item() if counts.numel() > 0 else 0
-    n = pair_sizes.shape[0]
-    intra_pair_indices = torch.tril_indices(
-        m, m, -1, device=ai1.device).unsqueeze(1).expand(-1, n, -1)
-    mask = (torch.arange(
-        intra_pair_indices.shape[2], device=ai1.device) < pair_sizes.unsqueeze(1)).flatten()
-    sorted_local_index12 = intra_pair_indices.flatten(1, 2)[:, mask]
+    # do local combinations within unique key, assuming sorted. The
+    # position of each triplet inside the block of its central atom is
+    # mapped to the (row, column) of the strictly lower triangle in the
+    # order of torch.tril_indices, so only the real triplets are allocated
+    local_index = torch.arange(pair_indices.shape[0], device=ai1.device) - \
+        cumsum_from_zero(pair_sizes).index_select(0, pair_indices)
+    row = torch.floor(
+        (1 + torch.sqrt(1 + 8 * local_index.to(torch.float64))) / 2).to(torch.long)
+    # guard against rounding of the square root
+    row = row - (torch.div(row * (row - 1), 2, rounding_mode="trunc") > local_index).to(torch.long)
+    row = row + (torch.div(row * (row + 1), 2, rounding_mode="trunc") <= local_index).to(torch.long)
+    column = local_index - torch.div(row * (row - 1), 2, rounding_mode="trunc")
+    sorted_local_index12 = torch.stack([row, column])
     sorted_local_index12 += cumsum_from_zero(
         counts).index_select(0, pair_indices)
 
@@ -344,80 +921,751 @@ def triple_by_molecule(atom_index12: Tensor) -> Tuple[Tensor, Tensor, Tensor]:
     return central_atom_index, local_index12 % n, sign12
 
 
+def precision_dtypes(precision: str, dtype: torch.dtype) -> Tuple[torch.dtype, torch.dtype]:
+    """Return the dtypes used to compute and to accumulate the AEV terms of
+    inputs of the given dtype under a precision policy of ``PRECISIONS``."""
+    if precision == 'native':
+        return dtype, dtype
+    if precision == 'single':
+        return torch.float32, torch.float32
+    assert precision == 'mixed', "unknown precision policy"
+    return torch.float32, torch.float64
+
+
+def cast_constants(constants: Tuple[float, Tensor, Tensor, float, Tensor, Tensor, Tensor, Tensor],
+                   dtype: torch.dtype) -> Tuple[float, Tensor, Tensor, float, Tensor, Tensor, Tensor, Tensor]:
+    Rcr, EtaR, ShfR, Rca, ShfZ, EtaA, Zeta, ShfA = constants
+    return (Rcr, EtaR.to(dtype), ShfR.to(dtype), Rca, ShfZ.to(dtype), EtaA.to(dtype),
+            Zeta.to(dtype), ShfA.to(dtype))
+
+
+def workspace_zeros(workspace: Optional[Dict[str, Tensor]], name: str, shape: List[int],
+                    like: Tensor, dtype: torch.dtype) -> Tensor:
+    """Zeros of the given shape, dtype and of the device of ``like``.
+
+    If ``workspace`` is given, the zeros are a view of its buffer ``name``
+    zeroed in place, the buffer is only allocated (or grown) when it is
+    missing or too small. The returned view is detached from the buffer so
+    that in-place operations with autograd never chain the calls."""
+    if workspace is None:
+        return like.new_zeros(shape, dtype=dtype)
+    numel = 1
+    for size in shape:
+        numel *= size
+    buffer = workspace.get(name)
+    if buffer is None or buffer.dtype != dtype or buffer.device != like.device or \
+            buffer.shape[0] < numel:
+        buffer = like.new_empty(numel, dtype=dtype)
+        workspace[name] = buffer
+    zeros = buffer.detach()[:numel].view(shape)
+    zeros.zero_()
+    return zeros
+
+
+def segment_add_(out: Tensor, index: Tensor, values: Tensor) -> Tensor:
+    """Same as ``out.index_add_(0, index, values)`` with a sorted segmented
+    reduction: the rows of ``values`` are ordered by ``index`` (skipped if
+    it is already sorted), the runs of equal indices are summed with
+    :func:`torch.segment_reduce` and added to the rows of ``out`` they
+    span. The autograd of this reduction is only first order."""
+    if index.shape[0] == 0:
+        return out
+    if not bool((index[1:] >= index[:-1]).all()):
+        index, order = index.sort(stable=True)
+        values = values.index_select(0, order)
+    first = int(index[0])
+    num_rows = int(index[-1]) - first + 1
+    lengths = torch.bincount(index - first, minlength=num_rows)
+    out.narrow(0, first, num_rows).add_(torch.segment_reduce(values, 'sum', lengths=lengths))
+    return out
+
+
+def add_rows_(out: Tensor, index: Tensor, values: Tensor, reduction: str = 'scatter') -> Tensor:
+    """Add the rows of ``values`` to the rows ``index`` of ``out`` with the
+    given reduction, one of ``REDUCTIONS``."""
+    if reduction == 'segment':
+        return segment_add_(out, index, values)
+    return out.index_add_(0, index, values)
+
+
 def compute_aev(species: Tensor, coordinates: Tensor, charges: Tensor, triu_index: Tensor,
                 constants: Tuple[float, Tensor, Tensor, float, Tensor, Tensor, Tensor, Tensor],
-                sizes: Tuple[int, int, int, int, int], cell_shifts: Optional[Tuple[Tensor, Tensor]]) -> Tensor:
-    Rcr, EtaR, ShfR, Rca, ShfZ, EtaA, Zeta, ShfA = constants
-    num_species, radial_sublength, radial_length, angular_sublength, angular_length = sizes
-    num_molecules = species.shape[0]
-    num_atoms = species.shape[1]
-    num_species_pairs = angular_length // angular_sublength
-    coordinates_ = coordinates
-    coordinates = coordinates_.flatten(0, 1)
+                sizes: Tuple[int, int, int, int, int], cell_shifts: Optional[Tuple[Tensor, Tensor]],
+                cell_list_threshold: int = CELL_LIST_THRESHOLD) -> Tensor:
+    Rcr = constants[0]
 
     # PBC calculation is bypassed if there are no shifts
     if cell_shifts is None:
-        atom_index12 = neighbor_pairs_nopbc(species == -1, coordinates_, Rcr)
-        selected_coordinates = coordinates.index_select(
-            0, atom_index12.view(-1)).view(2, -1, 3)
-        vec = selected_coordinates[0] - selected_coordinates[1]
+        atom_index12 = neighbor_pairs_nopbc(
+            species == -1, coordinates, Rcr, cell_list_threshold)
+        shift_values: Optional[Tensor] = None
     else:
         cell, shifts = cell_shifts
         atom_index12, shifts = neighbor_pairs(
-            species == -1, coordinates_, cell, shifts, Rcr)
-        shift_values = shifts.to(cell.dtype) @ cell
-        selected_coordinates = coordinates.index_select(
-            0, atom_index12.view(-1)).view(2, -1, 3)
-        vec = selected_coordinates[0] - selected_coordinates[1] + shift_values
+            species == -1, coordinates, cell, shifts, Rcr)
+        shift_values = pair_shift_values(shifts, cell, atom_index12, species.shape[1])
+
+    return compute_aev_from_neighbors(species, coordinates, charges, triu_index,
+                                      constants, sizes, atom_index12, shift_values)
+
+
+def compute_aev_from_neighbors(species: Tensor, coordinates: Tensor, charges: Tensor, triu_index: Tensor,
+                               constants: Tuple[float, Tensor, Tensor, float, Tensor, Tensor, Tensor, Tensor],
+                               sizes: Tuple[int, int, int, int, int], atom_index12: Tensor,
+                               shift_values: Optional[Tensor], filter_pairs: bool = False,
+                               angular_trig: Optional[Tuple[Tensor, Tensor]] = None,
+                               angular_chunk_size: int = 0, analytic_gradients: bool = False,
+                               center_mask: Optional[Tensor] = None,
+                               precision: str = 'native',
+                               radial_spline: Optional[Tensor] = None,
+                               workspace: Optional[Dict[str, Tensor]] = None,
+                               reduction: str = 'scatter') -> Tensor:
+    """Compute the AEVs from an already built list of neighbor pairs.
 
-    species = species.flatten()
-    species12 = species[atom_index12]
+    Arguments:
+        atom_index12 (:class:`torch.Tensor`): long tensor of shape (2, P)
+            with the pairs of atoms as indices into the flattened
+            ``(molecules * atoms)`` coordinates.
+        shift_values (:class:`torch.Tensor`, optional): tensor of shape
+            (P, 3) with the cartesian shift of the second atom of every
+            pair, ``None`` if PBC are not used.
+        filter_pairs (bool): whether ``atom_index12`` may contain pairs
+            farther than ``Rcr`` (e.g. a Verlet list) that have to be
+            discarded first.
+        angular_trig (tuple, optional): ``(cos(ShfZ), sin(ShfZ))`` to
+            compute the angular terms with :func:`angular_terms_acos_free`,
+            ``None`` to use :func:`angular_terms`.
+        angular_chunk_size (int): if positive, the angular terms are
+            computed and accumulated for at most this many triplets at a
+            time, which bounds the memory of dense environments.
+        analytic_gradients (bool): whether to compute the gradients with
+            respect to coordinates and charges with :class:`AEVFunction`
+            instead of autograd. Ignored in TorchScript.
+        center_mask (:class:`torch.Tensor`, optional): boolean tensor of
+            shape (molecules, atoms). If given, only the AEVs of these atoms
+            are computed, the other atoms only act as neighbors and their
+            AEVs are zero.
+        precision (str): one of ``PRECISIONS``, the dtypes used to compute
+            and to accumulate the terms. The pairs are always selected and
+            the AEVs returned in the dtype of ``coordinates``.
+        radial_spline (:class:`torch.Tensor`, optional): a
+            :func:`radial_spline_table` to interpolate the radial and charge
+            radial terms from, ``None`` to evaluate them.
+        workspace (dict, optional): buffers reused across the calls for the
+            accumulation of the terms, see :func:`workspace_zeros`.
+        reduction (str): one of ``REDUCTIONS``, how the terms are summed
+            into the AEVs, see :func:`add_rows_`.
+    """
+    if center_mask is not None:
+        center_mask = center_mask.flatten()
+    atom_index12, shift_values = select_pairs(coordinates, atom_index12, shift_values,
+                                              constants[0], filter_pairs, center_mask)
+
+    input_dtype = coordinates.dtype
+    compute_dtype, accumulate_dtype = precision_dtypes(precision, input_dtype)
+    if precision != 'native':
+        coordinates = coordinates.to(compute_dtype)
+        charges = charges.to(compute_dtype)
+        if shift_values is not None:
+            shift_values = shift_values.to(compute_dtype)
+        constants = cast_constants(constants, compute_dtype)
+        if angular_trig is not None:
+            angular_trig = (angular_trig[0].to(compute_dtype), angular_trig[1].to(compute_dtype))
+    if radial_spline is not None:
+        radial_spline = radial_spline.to(compute_dtype)
+
+    if analytic_gradients and not torch.jit.is_scripting():
+        return aev_with_analytic_gradients(species, coordinates, charges, triu_index, constants,
+                                           sizes, atom_index12, shift_values, angular_trig,
+                                           angular_chunk_size, center_mask,
+                                           accumulate_dtype, radial_spline,
+                                           workspace, reduction).to(input_dtype)
 
-    distances = vec.norm(2, -1)
+    Rcr, EtaR, ShfR, Rca, ShfZ, EtaA, Zeta, ShfA = constants
+    num_species, radial_sublength, radial_length, angular_sublength, angular_length = sizes
+    num_molecules = species.shape[0]
+    num_atoms = species.shape[1]
+    num_species_pairs = angular_length // angular_sublength
+    coordinates = coordinates.flatten(0, 1)
+    charges = charges.flatten()
+    assert charges.shape[0] == coordinates.shape[0], "there must be one charge per atom"
 
-    # compute radial aev
-    radial_terms_ = radial_terms(Rcr, EtaR, ShfR, distances)
-    radial_aev = radial_terms_.new_zeros(
-        (num_molecules * num_atoms * num_species, radial_sublength))
-    index12 = atom_index12 * num_species + species12.flip(0)
-    radial_aev.index_add_(0, index12[0], radial_terms_)
-    radial_aev.index_add_(0, index12[1], radial_terms_)
-    radial_aev = radial_aev.reshape(num_molecules, num_atoms, radial_length)
+    vec = pair_vectors(coordinates, atom_index12, shift_values)
+    species12 = species.flatten()[atom_index12]
+    distances = vec.norm(2, -1)
 
-    # compute charge radial
-    # get the second pairs charges
+    radial_charge_aev = accumulate_radial_charge(Rcr, EtaR, ShfR, atom_index12, species12,
+                                                 distances, charges, num_species, center_mask,
+                                                 accumulate_dtype, radial_spline, workspace,
+                                                 reduction)
+
+    even_closer_indices, central_atom_index, pair_index12, sign12 = angular_triplets(
+        atom_index12, distances, Rca, center_mask)
+    angular_aev = accumulate_angular(Rca, ShfZ, EtaA, Zeta, ShfA, triu_index,
+                                     vec.index_select(0, even_closer_indices),
+                                     species12.index_select(1, even_closer_indices),
+                                     central_atom_index, pair_index12, sign12,
+                                     coordinates.shape[0], num_species_pairs, angular_sublength,
+                                     angular_trig, angular_chunk_size, accumulate_dtype,
+                                     workspace, reduction)
+
+    return torch.cat([radial_charge_aev.view(num_molecules, num_atoms, 2 * radial_length),
+                      angular_aev.view(num_molecules, num_atoms, angular_length)],
+                     dim=-1).to(input_dtype)
+
+
+def compute_aev_padded(species: Tensor, coordinates: Tensor, charges: Tensor, triu_index: Tensor,
+                       constants: Tuple[float, Tensor, Tensor, float, Tensor, Tensor, Tensor, Tensor],
+                       sizes: Tuple[int, int, int, int, int], neighbor_index: Tensor,
+                       shift_values: Tensor, neighbor_is_second: Tensor, mask: Tensor,
+                       angular_mask: Tensor, angular_trig: Optional[Tuple[Tensor, Tensor]] = None,
+                       precision: str = 'native') -> Tensor:
+    """Compute the AEVs from a padded neighbor list of :func:`neighbors_padded`.
+
+    The terms of every slot and of every pair of angular slots are
+    computed, the empty ones masked out, and summed into the species blocks
+    with one-hot contractions instead of ``index_add_``, so that all the
+    shapes are static.
+    """
+    Rcr, EtaR, ShfR, Rca, ShfZ, EtaA, Zeta, ShfA = constants
+    num_species, radial_sublength, radial_length, angular_sublength, angular_length = sizes
+    num_molecules, num_atoms, capacity = neighbor_index.shape
+    angular_capacity = angular_mask.shape[-1]
+    num_species_pairs = angular_length // angular_sublength
+    input_dtype = coordinates.dtype
+    compute_dtype, accumulate_dtype = precision_dtypes(precision, input_dtype)
+    if precision != 'native':
+        coordinates = coordinates.to(compute_dtype)
+        charges = charges.to(compute_dtype)
+        shift_values = shift_values.to(compute_dtype)
+        Rcr, EtaR, ShfR, Rca, ShfZ, EtaA, Zeta, ShfA = cast_constants(constants, compute_dtype)
+        if angular_trig is not None:
+            angular_trig = (angular_trig[0].to(compute_dtype), angular_trig[1].to(compute_dtype))
+
+    # flat index of the neighbors and their vectors from the center atoms,
+    # the empty slots get a vector longer than the cutoff
+    molecule_start = torch.arange(num_molecules, device=species.device).view(-1, 1, 1) * num_atoms
+    flat_index = (neighbor_index + molecule_start).flatten()
+    flat_coordinates = coordinates.flatten(0, 1)
+    vec = flat_coordinates.index_select(0, flat_index).view(num_molecules, num_atoms, capacity, 3) + \
+        shift_values - coordinates.unsqueeze(2)
+    vec = torch.where(mask.unsqueeze(-1), vec, torch.full_like(vec, 2 * Rcr))
+    distances = vec.norm(2, -1)
+    flat_charges = charges.flatten()
+    neighbor_charges = torch.where(neighbor_is_second, flat_charges.index_select(0, flat_index).view_as(mask),
+                                   flat_charges.view(num_molecules, num_atoms, 1).expand_as(mask))
+    neighbor_species = species.flatten().index_select(0, flat_index).view_as(mask).clamp(min=0)
+
+    radial_charge_terms_ = radial_charge_terms(Rcr, EtaR, ShfR, distances.flatten(),
+                                               neighbor_charges.flatten())
+    radial_charge_terms_ = radial_charge_terms_.view(-1, capacity, 2, radial_sublength).to(accumulate_dtype)
+    species_one_hot = torch.nn.functional.one_hot(neighbor_species, num_species).to(accumulate_dtype) * \
+        mask.unsqueeze(-1)
+    radial_charge_aev = torch.einsum('nks,nkcr->ncsr', species_one_hot.view(-1, capacity, num_species),
+                                     radial_charge_terms_)
+
+    # the angular neighbors are the closest ones, in the first slots
+    slots = torch.triu_indices(angular_capacity, angular_capacity, 1, device=species.device)
+    angular_vec = vec[:, :, :angular_capacity].reshape(-1, angular_capacity, 3)
+    vectors12 = angular_vec.index_select(1, slots.flatten()).view(-1, 2, slots.shape[1], 3)
+    vectors12 = vectors12.transpose(0, 1).reshape(2, -1, 3)
+    if angular_trig is None:
+        angular_terms_ = angular_terms(Rca, ShfZ, EtaA, Zeta, ShfA, vectors12)
+    else:
+        cos_ShfZ, sin_ShfZ = angular_trig
+        angular_terms_ = angular_terms_acos_free(Rca, cos_ShfZ, sin_ShfZ, EtaA, Zeta, ShfA, vectors12)
+    angular_terms_ = angular_terms_.view(-1, slots.shape[1], angular_sublength).to(accumulate_dtype)
+    angular_species = neighbor_species[:, :, :angular_capacity].reshape(-1, angular_capacity)
+    species_pair = triu_index[angular_species.index_select(1, slots[0]),
+                              angular_species.index_select(1, slots[1])]
+    angular_mask = angular_mask.reshape(-1, angular_capacity)
+    pair_mask = angular_mask.index_select(1, slots[0]) & angular_mask.index_select(1, slots[1])
+    pair_one_hot = torch.nn.functional.one_hot(species_pair, num_species_pairs).to(accumulate_dtype) * \
+        pair_mask.unsqueeze(-1)
+    angular_aev = torch.einsum('ntp,ntc->npc', pair_one_hot, angular_terms_)
+
+    return torch.cat([radial_charge_aev.reshape(num_molecules, num_atoms, 2 * radial_length),
+                      angular_aev.reshape(num_molecules, num_atoms, angular_length)],
+                     dim=-1).to(input_dtype)
+
+
+def compute_aev_dense(species: Tensor, coordinates: Tensor, charges: Tensor, triu_index: Tensor,
+                      constants: Tuple[float, Tensor, Tensor, float, Tensor, Tensor, Tensor, Tensor],
+                      sizes: Tuple[int, int, int, int, int],
+                      angular_trig: Optional[Tuple[Tensor, Tensor]] = None) -> Tensor:
+    """Compute the AEVs of small molecules from all their pairs and triplets
+
+    Every pair and every triplet of atoms of a molecule is evaluated and
+    the ones out of the cutoffs are masked, without neighbor list, index
+    arithmetic nor scatter. The number of operations does not depend on
+    the number of atoms, which makes this the fastest way for a few tens
+    of atoms, where the call is dominated by the overhead of every
+    operation, but the cost grows as ``atoms ** 3``. The AEVs are the ones
+    of :func:`compute_aev` without PBC.
+    """
+    Rcr, EtaR, ShfR, Rca, ShfZ, EtaA, Zeta, ShfA = constants
+    num_species, radial_sublength, radial_length, angular_sublength, angular_length = sizes
+    num_molecules, num_atoms = species.shape
+    num_species_pairs = angular_length // angular_sublength
+    atom_index = torch.arange(num_atoms, device=species.device)
+    is_atom = species != -1
+    is_pair = is_atom.unsqueeze(1) & is_atom.unsqueeze(2) & \
+        (atom_index.unsqueeze(1) != atom_index.unsqueeze(0))
+
+    # vec[m, i, j] goes from atom i to atom j, the pairs that are not in the
+    # cutoff get a vector longer than it so that all the terms stay finite
+    vec = coordinates.unsqueeze(1) - coordinates.unsqueeze(2)
+    vec = torch.where(is_pair.unsqueeze(-1), vec, torch.full_like(vec, 2 * Rcr))
+    distances = vec.norm(2, -1)
+    in_cutoff = is_pair & (distances <= Rcr)
+
+    # radial terms, with the charge of the second atom of every pair
+    charges = charges.view(num_molecules, num_atoms)
+    second_charges = torch.where(atom_index.unsqueeze(1) < atom_index.unsqueeze(0),
+                                 charges.unsqueeze(1), charges.unsqueeze(2))
+    radial_charge_terms_ = radial_charge_terms(Rcr, EtaR, ShfR, distances.flatten(),
+                                               second_charges.flatten())
+    radial_charge_terms_ = radial_charge_terms_.view(num_molecules, num_atoms, num_atoms, -1) * \
+        in_cutoff.unsqueeze(-1)
+    species_one_hot = torch.nn.functional.one_hot(species.clamp(min=0), num_species).to(vec.dtype)
+    # (molecules, atoms, 2 * sublength, species) -> (molecules, atoms, channel, species, sublength)
+    radial_charge_aev = radial_charge_terms_.transpose(-1, -2) @ species_one_hot.unsqueeze(1)
+    radial_charge_aev = radial_charge_aev.view(
+        num_molecules, num_atoms, 2, radial_sublength, num_species).transpose(-1, -2)
+
+    # angular terms of the triplets of the atom i with the neighbors j < k
+    neighbor12 = torch.triu_indices(num_atoms, num_atoms, 1, device=species.device)
+    vec12 = torch.stack([vec.index_select(2, neighbor12[0]), vec.index_select(2, neighbor12[1])])
+    in_angular_cutoff = is_pair & (distances <= Rca)
+    is_triplet = in_angular_cutoff.index_select(2, neighbor12[0]) & \
+        in_angular_cutoff.index_select(2, neighbor12[1])
+    if angular_trig is None:
+        angular_terms_ = angular_terms(Rca, ShfZ, EtaA, Zeta, ShfA, vec12)
+    else:
+        angular_terms_ = angular_terms_acos_free(Rca, angular_trig[0], angular_trig[1],
+                                                 EtaA, Zeta, ShfA, vec12)
+    angular_terms_ = angular_terms_.view(num_molecules, num_atoms, -1, angular_sublength) * \
+        is_triplet.unsqueeze(-1)
+    species_pair_one_hot = torch.nn.functional.one_hot(
+        triu_index[species.clamp(min=0).index_select(1, neighbor12[0]),
+                   species.clamp(min=0).index_select(1, neighbor12[1])],
+        num_species_pairs).to(vec.dtype)
+    angular_aev = angular_terms_.transpose(-1, -2) @ species_pair_one_hot.unsqueeze(1)
+
+    return torch.cat([radial_charge_aev.reshape(num_molecules, num_atoms, 2 * radial_length),
+                      angular_aev.transpose(-1, -2).reshape(num_molecules, num_atoms, angular_length)],
+                     dim=-1)
+
+
+def select_pairs(coordinates: Tensor, atom_index12: Tensor, shift_values: Optional[Tensor],
+                 Rcr: float, filter_pairs: bool,
+                 center_mask: Optional[Tensor]) -> Tuple[Tensor, Optional[Tensor]]:
+    """Keep the pairs that contribute to the AEVs: the pairs within ``Rcr``
+    if ``filter_pairs`` and the pairs with an atom of the flattened
+    ``center_mask`` if given."""
+    if filter_pairs or center_mask is not None:
+        vec = pair_vectors(coordinates.detach().flatten(0, 1), atom_index12, shift_values)
+        in_cutoff = vec.norm(2, -1) <= Rcr
+        if center_mask is not None:
+            in_cutoff = in_cutoff & (center_mask.index_select(0, atom_index12[0]) |
+                                     center_mask.index_select(0, atom_index12[1]))
+        in_cutoff = in_cutoff.nonzero().flatten()
+        atom_index12 = atom_index12.index_select(1, in_cutoff)
+        if shift_values is not None:
+            shift_values = shift_values.index_select(0, in_cutoff)
+    return atom_index12, shift_values
+
+
+def pair_vectors(coordinates: Tensor, atom_index12: Tensor, shift_values: Optional[Tensor]) -> Tensor:
+    """Vectors from the second to the first atom of every pair, the
+    coordinates are flattened to the shape ``(molecules * atoms, 3)``."""
+    selected_coordinates = coordinates.index_select(
+        0, atom_index12.view(-1)).view(2, -1, 3)
+    vec = selected_coordinates[0] - selected_coordinates[1]
+    if shift_values is not None:
+        vec = vec + shift_values
+    return vec
+
+
+def accumulate_radial_charge(Rcr: float, EtaR: Tensor, ShfR: Tensor, atom_index12: Tensor,
+                             species12: Tensor, distances: Tensor, charges: Tensor,
+                             num_species: int, center_mask: Optional[Tensor] = None,
+                             accumulate_dtype: Optional[torch.dtype] = None,
+                             radial_spline: Optional[Tensor] = None,
+                             workspace: Optional[Dict[str, Tensor]] = None,
+                             reduction: str = 'scatter') -> Tensor:
+    """Sum the radial and charge radial terms of the pairs into the AEVs of
+    both of their atoms (only the atoms in ``center_mask`` if given). The
+    charges are the ones of the second atoms of the pairs. Returns a tensor
+    of shape ``(atoms, 2 * radial_length)`` with the radial block of every
+    atom followed by its charge block, summed in ``accumulate_dtype`` (the
+    dtype of the terms by default). The terms are interpolated from
+    ``radial_spline`` if given. The sums reuse the buffers of ``workspace``
+    if given and are done with ``reduction``, see :func:`add_rows_`."""
+    num_atoms = charges.shape[0]
     selected_charges = charges.index_select(0, atom_index12[1])
-    charge_terms_ = charge_terms(Rcr, EtaR, ShfR, distances, selected_charges)
-
-    charge_aev = radial_terms_.new_zeros(
-        (num_molecules * num_atoms * num_species, radial_sublength))
+    if radial_spline is None:
+        radial_charge_terms_ = radial_charge_terms(
+            Rcr, EtaR, ShfR, distances, selected_charges)
+    else:
+        radial_charge_terms_ = tabulated_radial_charge_terms(
+            Rcr, radial_spline, distances, selected_charges)
+    radial_sublength = radial_charge_terms_.shape[1] // 2
+    if accumulate_dtype is not None:
+        radial_charge_terms_ = radial_charge_terms_.to(accumulate_dtype)
+    radial_charge_aev = workspace_zeros(workspace, 'radial_charge',
+                                        [num_atoms * num_species, 2 * radial_sublength],
+                                        radial_charge_terms_, radial_charge_terms_.dtype)
+    index12 = atom_index12 * num_species + species12.flip(0)
+    if center_mask is None:
+        add_rows_(radial_charge_aev, index12[0], radial_charge_terms_, reduction)
+        add_rows_(radial_charge_aev, index12[1], radial_charge_terms_, reduction)
+    else:
+        for end in range(2):
+            is_center = center_mask.index_select(0, atom_index12[end]).nonzero().flatten()
+            add_rows_(radial_charge_aev, index12[end].index_select(0, is_center),
+                      radial_charge_terms_.index_select(0, is_center), reduction)
+    # (atoms, species, channel, sublength) -> (atoms, channel, species, sublength)
+    radial_charge_aev = radial_charge_aev.view(
+        num_atoms, num_species, 2, radial_sublength).transpose(1, 2)
+    return radial_charge_aev.reshape(num_atoms, 2 * num_species * radial_sublength)
+
+
+def accumulate_charge(basis: Tensor, atom_index12: Tensor, species12: Tensor, charges: Tensor,
+                      num_species: int, center_mask: Optional[Tensor] = None,
+                      accumulate_dtype: Optional[torch.dtype] = None,
+                      workspace: Optional[Dict[str, Tensor]] = None,
+                      reduction: str = 'scatter') -> Tensor:
+    """Sum the charge radial terms of the pairs into the AEVs of both of
+    their atoms like :func:`accumulate_radial_charge`, from the
+    :func:`radial_basis` values of the pairs. Returns the charge block of
+    shape ``(atoms, radial_length)``."""
+    num_atoms = charges.shape[0]
+    gaussian, gaussian_cosine = basis.chunk(2, dim=1)
+    radial_sublength = gaussian.shape[1]
+    charge_terms_ = torch.addcmul(0.5 * gaussian,
+                                  charges.index_select(0, atom_index12[1]).unsqueeze(1),
+                                  gaussian_cosine)
+    if accumulate_dtype is not None:
+        charge_terms_ = charge_terms_.to(accumulate_dtype)
+    charge_aev = workspace_zeros(workspace, 'charge', [num_atoms * num_species, radial_sublength],
+                                 charge_terms_, charge_terms_.dtype)
     index12 = atom_index12 * num_species + species12.flip(0)
-    charge_aev.index_add_(0, index12[0], charge_terms_)
-    charge_aev.index_add_(0, index12[1], charge_terms_)
-    charge_aev = charge_aev.reshape(num_molecules, num_atoms, radial_length)
+    for end in range(2):
+        if center_mask is None:
+            add_rows_(charge_aev, index12[end], charge_terms_, reduction)
+        else:
+            is_center = center_mask.index_select(0, atom_index12[end]).nonzero().flatten()
+            add_rows_(charge_aev, index12[end].index_select(0, is_center),
+                      charge_terms_.index_select(0, is_center), reduction)
+    return charge_aev.view(num_atoms, num_species * radial_sublength)
+
 
+def angular_triplets(atom_index12: Tensor, distances: Tensor, Rca: float,
+                     center_mask: Optional[Tensor] = None) -> Tuple[Tensor, Tensor, Tensor, Tensor]:
+    """Find the pairs within ``Rca`` and the triplets they form, see
+    :func:`triple_by_molecule`. The pair indices of the triplets refer to
+    the returned ``even_closer_indices``."""
     # Rca is usually much smaller than Rcr, using neighbor list with cutoff=Rcr is a waste of resources
     # Now we will get a smaller neighbor list that only cares about atoms with distances <= Rca
     even_closer_indices = (distances <= Rca).nonzero().flatten()
-    atom_index12 = atom_index12.index_select(1, even_closer_indices)
-    species12 = species12.index_select(1, even_closer_indices)
-    vec = vec.index_select(0, even_closer_indices)
+    central_atom_index, pair_index12, sign12 = triple_by_molecule(
+        atom_index12.index_select(1, even_closer_indices), center_mask)
+    return even_closer_indices, central_atom_index, pair_index12, sign12
 
-    # compute angular aev
-    central_atom_index, pair_index12, sign12 = triple_by_molecule(atom_index12)
+
+def triplet_vectors(vec: Tensor, species12: Tensor, pair_index12: Tensor, sign12: Tensor,
+                    triu_index: Tensor) -> Tuple[Tensor, Tensor]:
+    """Vectors from the central atom to both neighbors of every triplet and
+    the index of the species pair of the neighbors."""
     species12_small = species12[:, pair_index12]
-    vec12 = vec.index_select(0, pair_index12.view(-1)
+    vec12 = vec.index_select(0, pair_index12.reshape(-1)
                              ).view(2, -1, 3) * sign12.unsqueeze(-1)
     species12_ = torch.where(
         sign12 == 1, species12_small[1], species12_small[0])
-    angular_terms_ = angular_terms(Rca, ShfZ, EtaA, Zeta, ShfA, vec12)
-    angular_aev = angular_terms_.new_zeros(
-        (num_molecules * num_atoms * num_species_pairs, angular_sublength))
-    index = central_atom_index * num_species_pairs + \
-        triu_index[species12_[0], species12_[1]]
-    angular_aev.index_add_(0, index, angular_terms_)
-    angular_aev = angular_aev.reshape(num_molecules, num_atoms, angular_length)
-    return torch.cat([radial_aev, charge_aev, angular_aev], dim=-1)
+    return vec12, triu_index[species12_[0], species12_[1]]
+
+
+def accumulate_angular(Rca: float, ShfZ: Tensor, EtaA: Tensor, Zeta: Tensor, ShfA: Tensor,
+                       triu_index: Tensor, vec: Tensor, species12: Tensor,
+                       central_atom_index: Tensor, pair_index12: Tensor, sign12: Tensor,
+                       num_atoms: int, num_species_pairs: int, angular_sublength: int,
+                       angular_trig: Optional[Tuple[Tensor, Tensor]],
+                       angular_chunk_size: int,
+                       accumulate_dtype: Optional[torch.dtype] = None,
+                       workspace: Optional[Dict[str, Tensor]] = None,
+                       reduction: str = 'scatter') -> Tensor:
+    """Sum the angular terms of the triplets into the AEVs of their central
+    atoms. Returns a tensor of shape ``(atoms, angular_length)`` summed in
+    ``accumulate_dtype`` (the dtype of ``vec`` by default) with
+    ``reduction``, reusing the buffers of ``workspace`` if given."""
+    if accumulate_dtype is None:
+        accumulate_dtype = vec.dtype
+    angular_aev = workspace_zeros(workspace, 'angular',
+                                  [num_atoms * num_species_pairs, angular_sublength],
+                                  vec, accumulate_dtype)
+    num_triplets = central_atom_index.shape[0]
+    chunk_size = angular_chunk_size if angular_chunk_size > 0 else max(num_triplets, 1)
+    for start in range(0, num_triplets, chunk_size):
+        end = min(start + chunk_size, num_triplets)
+        vec12, species_pair_index = triplet_vectors(
+            vec, species12, pair_index12[:, start:end], sign12[:, start:end], triu_index)
+        if angular_trig is None:
+            angular_terms_ = angular_terms(Rca, ShfZ, EtaA, Zeta, ShfA, vec12)
+        else:
+            cos_ShfZ, sin_ShfZ = angular_trig
+            angular_terms_ = angular_terms_acos_free(
+                Rca, cos_ShfZ, sin_ShfZ, EtaA, Zeta, ShfA, vec12)
+        index = central_atom_index[start:end] * num_species_pairs + species_pair_index
+        add_rows_(angular_aev, index, angular_terms_.to(accumulate_dtype), reduction)
+    return angular_aev.view(num_atoms, num_species_pairs * angular_sublength)
+
+
+def radial_charge_backward(Rcr: float, EtaR: Tensor, ShfR: Tensor, atom_index12: Tensor,
+                           species12: Tensor, distances: Tensor, charges: Tensor,
+                           num_species: int, grad_aev: Tensor,
+                           center_mask: Optional[Tensor] = None,
+                           accumulate_dtype: Optional[torch.dtype] = None,
+                           radial_spline: Optional[Tensor] = None) -> Tuple[Tensor, Tensor]:
+    """Gradients of :func:`accumulate_radial_charge` with respect to the
+    distances of the pairs and the charges, given the gradient of its
+    output ``grad_aev``. The gradients of the charges are summed in
+    ``accumulate_dtype`` (the dtype of ``charges`` by default)."""
+    num_atoms = charges.shape[0]
+    radial_sublength = EtaR.numel() * ShfR.numel()
+    grad_aev = grad_aev.reshape(num_atoms, 2, num_species, radial_sublength).transpose(1, 2)
+    grad_aev = grad_aev.reshape(num_atoms * num_species, 2 * radial_sublength)
+    index12 = atom_index12 * num_species + species12.flip(0)
+    if center_mask is None:
+        grad_terms = grad_aev.index_select(0, index12[0]) + grad_aev.index_select(0, index12[1])
+    else:
+        grad_terms = grad_aev.index_select(0, index12[0]) * \
+            center_mask.index_select(0, atom_index12[0]).unsqueeze(1) + \
+            grad_aev.index_select(0, index12[1]) * \
+            center_mask.index_select(0, atom_index12[1]).unsqueeze(1)
+    grad_radial, grad_charge = grad_terms.split(radial_sublength, dim=1)
+
+    selected_charges = charges.index_select(0, atom_index12[1]).view(-1, 1)
+    if radial_spline is None:
+        basis, d_basis = radial_basis(Rcr, EtaR, ShfR, distances)
+    else:
+        basis = interpolate_radial_spline(radial_spline, Rcr, distances)
+        d_basis = interpolate_radial_spline(radial_spline, Rcr, distances, derivative=True)
+    gaussian_cosine = basis[:, radial_sublength:]
+    d_gaussian, d_gaussian_cosine = d_basis.split(radial_sublength, dim=1)
+
+    d_radial = d_gaussian_cosine + 0.5 * d_gaussian
+    d_charge = 0.5 * d_gaussian + selected_charges * d_gaussian_cosine
+    grad_distances = (grad_radial * d_radial).sum(1) + (grad_charge * d_charge).sum(1)
+    grad_selected_charges = (grad_charge * gaussian_cosine).sum(1)
+    if accumulate_dtype is None:
+        accumulate_dtype = charges.dtype
+    grad_charges = charges.new_zeros(num_atoms, dtype=accumulate_dtype).index_add_(
+        0, atom_index12[1], grad_selected_charges.to(accumulate_dtype))
+    return grad_distances, grad_charges.to(charges.dtype)
+
+
+def angular_terms_backward(Rca: float, cos_ShfZ: Tensor, sin_ShfZ: Tensor, EtaA: Tensor, Zeta: Tensor,
+                           ShfA: Tensor, vectors12: Tensor, grad_terms: Tensor) -> Tensor:
+    """Gradient of :func:`angular_terms` (and :func:`angular_terms_acos_free`)
+    with respect to ``vectors12``, given the gradient of the terms. The
+    derivative of the angle is expanded like in
+    :func:`angular_terms_acos_free`."""
+    vectors12_ = vectors12.view(2, -1, 3, 1, 1, 1, 1)
+    distances12 = vectors12_.norm(2, dim=-5)
+    distances_prod = distances12.prod(0)
+    cos_angles = vectors12_.prod(0).sum(1) / torch.clamp(distances_prod, min=1e-10)
+    cos_theta = 0.95 * cos_angles
+    sin_theta = torch.sqrt(1 - cos_theta ** 2)
+
+    base = (1 + cos_theta * cos_ShfZ + sin_theta * sin_ShfZ) / 2
+    factor1 = base ** Zeta
+    # derivative with respect to cos_angles
+    d_factor1 = Zeta * base ** (Zeta - 1) * 0.475 * \
+        (cos_ShfZ - cos_theta / sin_theta * sin_ShfZ)
+    mean_distances = distances12.sum(0) / 2 - ShfA
+    factor2 = torch.exp(-EtaA * mean_distances ** 2)
+    fcj12 = cutoff_cosine(distances12, Rca).flatten(start_dim=1)
+    d_fcj12 = -0.5 * (math.pi / Rca) * torch.sin(distances12 * (math.pi / Rca)).flatten(start_dim=1)
+
+    # factor1 only depends on (Zeta, ShfZ) and factor2 on (EtaA, ShfA), so
+    # the gradient is first contracted with factor2 over (EtaA, ShfA), which
+    # avoids temporaries with all the channels. The cutoff functions only
+    # depend on the triplet and are factored out of the sums.
+    num_EtaA, num_Zeta, num_ShfA, num_ShfZ = EtaA.shape[0], Zeta.shape[1], ShfA.shape[2], cos_ShfZ.shape[3]
+    grad_terms = grad_terms.view(-1, num_EtaA, num_Zeta, num_ShfA, num_ShfZ)
+    factor2 = factor2.view(-1, num_EtaA, num_ShfA)
+    # derivative of factor2 with respect to each of the two distances
+    d_factor2 = (-EtaA * mean_distances).view(-1, num_EtaA, num_ShfA) * factor2
+    grad_factor1 = torch.einsum('tezas,tea->tzs', grad_terms, factor2)
+    grad_factor1_d2 = torch.einsum('tezas,tea->tzs', grad_terms, d_factor2)
+    factor1 = factor1.view(-1, num_Zeta, num_ShfZ)
+    sum_d_factor1 = (grad_factor1 * d_factor1.view(-1, num_Zeta, num_ShfZ)).sum((1, 2))
+    sum_factor12 = (grad_factor1 * factor1).sum((1, 2))
+    sum_d_factor2 = (grad_factor1_d2 * factor1).sum((1, 2))
+
+    grad_cos = 2 * sum_d_factor1 * fcj12[0] * fcj12[1]
+    grad_d1 = 2 * fcj12[1] * (sum_d_factor2 * fcj12[0] + sum_factor12 * d_fcj12[0])
+    grad_d2 = 2 * fcj12[0] * (sum_d_factor2 * fcj12[1] + sum_factor12 * d_fcj12[1])
+
+    vector1, vector2 = vectors12.unbind(0)
+    distance1 = distances12[0].view(-1, 1)
+    distance2 = distances12[1].view(-1, 1)
+    distances_prod = distances_prod.view(-1, 1)
+    cos_angles = cos_angles.view(-1, 1)
+    # the clamp of the product of the distances stops the gradient
+    unclamped = (distances_prod > 1e-10).to(vectors12.dtype)
+    d_cos1 = vector2 / torch.clamp(distances_prod, min=1e-10) - \
+        unclamped * cos_angles * vector1 / distance1 ** 2
+    d_cos2 = vector1 / torch.clamp(distances_prod, min=1e-10) - \
+        unclamped * cos_angles * vector2 / distance2 ** 2
+    grad_vector1 = grad_cos.unsqueeze(1) * d_cos1 + grad_d1.unsqueeze(1) * vector1 / distance1
+    grad_vector2 = grad_cos.unsqueeze(1) * d_cos2 + grad_d2.unsqueeze(1) * vector2 / distance2
+    return torch.stack([grad_vector1, grad_vector2])
+
+
+def angular_backward(Rca: float, ShfZ: Tensor, EtaA: Tensor, Zeta: Tensor, ShfA: Tensor,
+                     triu_index: Tensor, vec: Tensor, species12: Tensor,
+                     central_atom_index: Tensor, pair_index12: Tensor, sign12: Tensor,
+                     num_species_pairs: int, angular_sublength: int,
+                     angular_trig: Optional[Tuple[Tensor, Tensor]], angular_chunk_size: int,
+                     grad_aev: Tensor) -> Tensor:
+    """Gradient of :func:`accumulate_angular` with respect to the pair
+    vectors ``vec``, given the gradient of its output ``grad_aev``."""
+    if angular_trig is None:
+        # cos(angles - ShfZ) is evaluated at the dtype of the vectors, so the
+        # expanded derivative needs the trig of ShfZ at that dtype as well
+        ShfZ = ShfZ.to(vec.dtype)
+        cos_ShfZ, sin_ShfZ = torch.cos(ShfZ), torch.sin(ShfZ)
+    else:
+        cos_ShfZ, sin_ShfZ = angular_trig
+    grad_aev = grad_aev.reshape(-1, angular_sublength)
+    grad_vec = torch.zeros_like(vec)
+    num_triplets = central_atom_index.shape[0]
+    chunk_size = angular_chunk_size if angular_chunk_size > 0 else max(num_triplets, 1)
+    for start in range(0, num_triplets, chunk_size):
+        end = min(start + chunk_size, num_triplets)
+        chunk_pair_index12 = pair_index12[:, start:end]
+        chunk_sign12 = sign12[:, start:end]
+        vec12, species_pair_index = triplet_vectors(
+            vec, species12, chunk_pair_index12, chunk_sign12, triu_index)
+        index = central_atom_index[start:end] * num_species_pairs + species_pair_index
+        grad_vec12 = angular_terms_backward(Rca, cos_ShfZ, sin_ShfZ, EtaA, Zeta, ShfA, vec12,
+                                            grad_aev.index_select(0, index))
+        grad_vec12 = grad_vec12 * chunk_sign12.unsqueeze(-1)
+        grad_vec.index_add_(0, chunk_pair_index12.reshape(-1), grad_vec12.view(-1, 3))
+    return grad_vec
+
+
+class AEVFunction(torch.autograd.Function):
+    """AEVs with analytic gradients with respect to coordinates and charges.
+
+    The forward pass is the same as :func:`compute_aev_from_neighbors`, but
+    only the inputs and the integer pair and triplet indices are kept for
+    the backward pass. The distances, terms and their derivatives are
+    recomputed there, so the intermediates of the radial, charge and angular
+    stages are not stored until the backward pass. The backward pass is
+    written with differentiable operations, so it can be differentiated
+    again.
+    """
+
+    @staticmethod
+    def forward(ctx, coordinates, charges, species, triu_index, constants, sizes,
+                atom_index12, shift_values, angular_trig, angular_chunk_size, center_mask,
+                accumulate_dtype, radial_spline, workspace, reduction):
+        Rcr, EtaR, ShfR, Rca, ShfZ, EtaA, Zeta, ShfA = constants
+        num_species, radial_sublength, radial_length, angular_sublength, angular_length = sizes
+        num_molecules, num_atoms = species.shape
+        num_species_pairs = angular_length // angular_sublength
+        flat_coordinates = coordinates.flatten(0, 1)
+        flat_charges = charges.flatten()
+        assert flat_charges.shape[0] == flat_coordinates.shape[0], "there must be one charge per atom"
+
+        vec = pair_vectors(flat_coordinates, atom_index12, shift_values)
+        species12 = species.flatten()[atom_index12]
+        distances = vec.norm(2, -1)
+        radial_charge_aev = accumulate_radial_charge(Rcr, EtaR, ShfR, atom_index12, species12,
+                                                     distances, flat_charges, num_species,
+                                                     center_mask, accumulate_dtype, radial_spline,
+                                                     workspace, reduction)
+        even_closer_indices, central_atom_index, pair_index12, sign12 = angular_triplets(
+            atom_index12, distances, Rca, center_mask)
+        angular_aev = accumulate_angular(Rca, ShfZ, EtaA, Zeta, ShfA, triu_index,
+                                         vec.index_select(0, even_closer_indices),
+                                         species12.index_select(1, even_closer_indices),
+                                         central_atom_index, pair_index12, sign12,
+                                         flat_coordinates.shape[0], num_species_pairs,
+                                         angular_sublength, angular_trig, angular_chunk_size,
+                                         accumulate_dtype, workspace, reduction)
+
+        ctx.save_for_backward(coordinates, charges, species, triu_index, atom_index12,
+                              shift_values, even_closer_indices, central_atom_index,
+                              pair_index12, sign12, center_mask, radial_spline)
+        ctx.constants = constants
+        ctx.sizes = sizes
+        ctx.angular_trig = angular_trig
+        ctx.angular_chunk_size = angular_chunk_size
+        ctx.accumulate_dtype = accumulate_dtype
+        return torch.cat([radial_charge_aev.view(num_molecules, num_atoms, 2 * radial_length),
+                          angular_aev.view(num_molecules, num_atoms, angular_length)], dim=-1)
+
+    @staticmethod
+    def backward(ctx, grad_aev):
+        (coordinates, charges, species, triu_index, atom_index12, shift_values,
+         even_closer_indices, central_atom_index, pair_index12, sign12, center_mask,
+         radial_spline) = ctx.saved_tensors
+        Rcr, EtaR, ShfR, Rca, ShfZ, EtaA, Zeta, ShfA = ctx.constants
+        num_species, radial_sublength, radial_length, angular_sublength, angular_length = ctx.sizes
+        num_species_pairs = angular_length // angular_sublength
+        flat_coordinates = coordinates.flatten(0, 1)
+        flat_charges = charges.flatten()
+        grad_aev = grad_aev.reshape(flat_coordinates.shape[0], -1).to(flat_coordinates.dtype)
+
+        vec = pair_vectors(flat_coordinates, atom_index12, shift_values)
+        species12 = species.flatten()[atom_index12]
+        distances = vec.norm(2, -1)
+
+        grad_distances, grad_charges = radial_charge_backward(
+            Rcr, EtaR, ShfR, atom_index12, species12, distances, flat_charges,
+            num_species, grad_aev[:, :2 * radial_length], center_mask, ctx.accumulate_dtype,
+            radial_spline)
+        grad_vec = grad_distances.unsqueeze(1) * vec / \
+            torch.clamp(distances, min=1e-10).unsqueeze(1)
+
+        grad_closer_vec = angular_backward(Rca, ShfZ, EtaA, Zeta, ShfA, triu_index,
+                                           vec.index_select(0, even_closer_indices),
+                                           species12.index_select(1, even_closer_indices),
+                                           central_atom_index, pair_index12, sign12,
+                                           num_species_pairs, angular_sublength, ctx.angular_trig,
+                                           ctx.angular_chunk_size, grad_aev[:, 2 * radial_length:])
+        grad_vec = grad_vec.index_add(0, even_closer_indices, grad_closer_vec)
+
+        grad_vec = grad_vec.to(ctx.accumulate_dtype)
+        grad_coordinates = flat_coordinates.new_zeros(flat_coordinates.shape, dtype=ctx.accumulate_dtype)
+        grad_coordinates = grad_coordinates.index_add(0, atom_index12[0], grad_vec)
+        grad_coordinates = grad_coordinates.index_add(0, atom_index12[1], -grad_vec)
+        return (grad_coordinates.to(coordinates.dtype).view_as(coordinates),
+                grad_charges.view_as(charges), None, None, None, None, None, None, None, None,
+                None, None, None, None, None)
+
+
+@torch.jit.unused
+def aev_with_analytic_gradients(species: Tensor, coordinates: Tensor, charges: Tensor, triu_index: Tensor,
+                                constants: Tuple[float, Tensor, Tensor, float, Tensor, Tensor, Tensor, Tensor],
+                                sizes: Tuple[int, int, int, int, int], atom_index12: Tensor,
+                                shift_values: Optional[Tensor],
+                                angular_trig: Optional[Tuple[Tensor, Tensor]],
+                                angular_chunk_size: int, center_mask: Optional[Tensor],
+                                accumulate_dtype: torch.dtype,
+                                radial_spline: Optional[Tensor],
+                                workspace: Optional[Dict[str, Tensor]],
+                                reduction: str) -> Tensor:
+    if shift_values is not None:
+        shift_values = shift_values.detach()
+    return AEVFunction.apply(coordinates, charges, species, triu_index, constants, sizes,
+                             atom_index12, shift_values, angular_trig, angular_chunk_size,
+                             center_mask, accumulate_dtype, radial_spline, workspace,
+                             reduction)
 
 
 def jit_unused_if_no_cuaev(condition=has_cuaev):
@@ -450,6 +1698,97 @@ class AEVComputer(torch.nn.Module):
             equation (4) in the `ANI paper`_.
         num_species (int): Number of supported atom types.
         use_cuda_extension (bool): Whether to use cuda extension for faster calculation (needs cuaev installed).
+        cell_list_threshold (int): Number of atoms per molecule from which
+            the neighbor search without PBC uses a linked cell list instead of
+            checking all pairs. A negative value always checks all pairs.
+        verlet_skin (float): If positive, the computer becomes stateful and
+            keeps a Verlet neighbor list built with the cutoff
+            ``Rcr + verlet_skin``. The list is only rebuilt once an atom has
+            moved more than ``verlet_skin / 2`` since the last build (or the
+            species or the cell changed), otherwise only the distances of the
+            cached pairs are recomputed. Use :meth:`reset_neighbor_list` when
+            switching to an unrelated system.
+        acos_free_angular (bool): Whether to compute the angular terms with
+            :func:`angular_terms_acos_free`, which avoids the ``acos`` and
+            ``cos`` calls per triplet.
+        angular_chunk_size (int): If positive, the maximum number of
+            triplets whose angular terms are computed at a time.
+        analytic_gradients (bool): Whether to compute the gradients with
+            respect to coordinates and charges with :class:`AEVFunction`,
+            which recomputes the intermediates in the backward pass instead
+            of storing them. Gradients with respect to the cell are not
+            computed in this mode. TorchScript always uses autograd.
+        precision (str): Precision policy, one of ``'native'`` (compute in
+            the dtype of the coordinates), ``'single'`` (compute and
+            accumulate in float32) or ``'mixed'`` (compute the terms in
+            float32 and accumulate them in float64). The neighbor search and
+            the returned AEVs always use the dtype of the coordinates.
+        radial_spline_intervals (int): If positive, the radial and charge
+            radial terms are interpolated from cubic splines tabulated on
+            this many intervals of [0, Rcr] at construction (see
+            :func:`radial_spline_table`) instead of evaluated for every
+            pair. The bound of the interpolation error is stored in
+            ``radial_spline_error``.
+        cache_geometry (bool): If true, the computer keeps the AEVs and the
+            radial Gaussians of the pairs of the last call. A following call
+            with the same coordinates tensor, neither modified in place nor
+            requiring gradients, and the same species, cell, pbc and centers
+            only recomputes the charge channel for the new charges. Ignored
+            in TorchScript.
+        species_subset (list of int): If given, only the AEV blocks of these
+            species (and of their pairs) are computed and emitted, in this
+            order. All the atoms must be of one of these species.
+        channels (dict): Indices of the values of the constants ``'EtaR'``,
+            ``'ShfR'``, ``'EtaA'``, ``'Zeta'``, ``'ShfA'`` and ``'ShfZ'`` to
+            keep, the constants that are not in the dict keep all their
+            values. Only the channels made of the kept values are computed
+            and emitted. The position of every emitted entry in the full
+            AEV is given by the buffer ``aev_index``.
+        neighbor_capacity (int): If positive, the AEVs are computed from the
+            static-shape padded neighbor list of :func:`neighbors_padded`
+            with this many neighbor slots per atom, and
+            ``angular_capacity`` angular slots (``neighbor_capacity`` if not
+            positive). The calls do not synchronize with the device: the
+            numbers of neighbors and whether the minimum image convention
+            applies are recorded, and :meth:`check_padded_neighbors` must
+            be called outside of the hot loop to find out whether some
+            neighbors did not fit (and grow the capacities). This mode
+            checks all the pairs of atoms, needs the minimum image
+            convention with PBC and does not support Verlet lists, centers,
+            splines, the geometry cache or the analytic gradients.
+        reuse_buffers (bool): If true, the buffers in which the terms are
+            summed are kept in ``workspace`` and reused (and grown when
+            needed) by the following calls instead of allocated every call,
+            see :func:`workspace_zeros`. Use :meth:`clear_workspace` to free
+            them.
+        reduction (str): How the terms are summed into the AEVs, one of
+            ``'scatter'`` (``index_add_``) or ``'segment'`` (sorted by
+            destination and summed per segment, see :func:`segment_add_`).
+            The autograd of ``'segment'`` is only first order, the
+            analytic gradients can be differentiated again.
+        small_system_threshold (int): Number of atoms per molecule up to
+            which the AEVs without PBC are computed with
+            :func:`compute_aev_dense`, which has fewer operations for small
+            ghost systems (see ``SMALL_SYSTEM_THRESHOLD``). Molecules of
+            fewer than 3 atoms, without triplets, keep the pairs. Only used
+            with the default options, without centers, Verlet lists,
+            splines, the geometry cache, precision policy, analytic
+            gradients, angular chunks, reused buffers or the ``'segment'``
+            reduction. It computes the species and channels of
+            ``species_subset`` and ``channels`` like the other paths. A
+            negative value disables it.
+        validate_padded (bool): If true, every call with the padded neighbor
+            list checks at once that the minimum image convention applies
+            and that all the neighbors fit, otherwise grows the capacities
+            and repeats the call. This synchronizes with the device.
+
+    A static environment (e.g. the atoms of a frozen or restrained receptor)
+    can be given once with :meth:`set_environment`. The following calls then
+    take the mobile atoms only and return their AEVs, the ones of a system
+    made of the mobile atoms followed by the environment. The environment is
+    kept in a grid and only the pairs of mobile atoms and the pairs of a
+    mobile and an environment atom are searched. The environment does not
+    support PBC, centers, Verlet lists or the padded neighbor list.
 
     .. _ANI paper:
         http://pubs.rsc.org/en/Content/ArticleLanding/2017/SC/C6SC05720A#!divAbstract
@@ -466,13 +1805,72 @@ class AEVComputer(torch.nn.Module):
     sizes: Final[Tuple[int, int, int, int, int]]
     triu_index: Tensor
     use_cuda_extension: Final[bool]
-
-    def __init__(self, Rcr, Rca, EtaR, ShfR, EtaA, Zeta, ShfA, ShfZ, num_species, use_cuda_extension=False):
+    cell_list_threshold: Final[int]
+    small_system_threshold: Final[int]
+    verlet_skin: Final[float]
+    neighbor_cutoff: Final[float]
+    acos_free_angular: Final[bool]
+    angular_chunk_size: Final[int]
+    analytic_gradients: Final[bool]
+    precision: Final[str]
+    radial_spline_intervals: Final[int]
+    radial_spline_error: Final[float]
+    cache_geometry: Final[bool]
+    prune_species: Final[bool]
+    padded_neighbors: Final[bool]
+    validate_padded: Final[bool]
+    neighbor_capacity: int
+    angular_capacity: int
+    environment_tolerance: float
+    reuse_buffers: Final[bool]
+    reduction: Final[str]
+    workspace: Dict[str, Tensor]
+    __jit_ignored_attributes__ = ['geometry_cache']
+
+    def __init__(self, Rcr, Rca, EtaR, ShfR, EtaA, Zeta, ShfA, ShfZ, num_species, use_cuda_extension=False,
+                 cell_list_threshold=CELL_LIST_THRESHOLD, verlet_skin=0.0, acos_free_angular=False,
+                 angular_chunk_size=0, analytic_gradients=False, precision='native',
+                 radial_spline_intervals=0, cache_geometry=False, species_subset=None,
+                 channels=None, neighbor_capacity=0, angular_capacity=0, reuse_buffers=False,
+                 reduction='scatter', small_system_threshold=SMALL_SYSTEM_THRESHOLD,
+                 validate_padded=False):
         super().__init__()
+        # keep only the selected values of the constants and species
+        channels = {} if channels is None else channels
+        assert set(channels) <= {'EtaR', 'ShfR', 'EtaA', 'Zeta', 'ShfA', 'ShfZ'}, \
+            "unknown constant in channels"
+        kept: Dict[str, Tensor] = {}
+        for name, values in [('EtaR', EtaR), ('ShfR', ShfR), ('EtaA', EtaA),
+                             ('Zeta', Zeta), ('ShfA', ShfA), ('ShfZ', ShfZ)]:
+            kept[name] = torch.as_tensor(channels.get(name, range(values.numel())),
+                                         dtype=torch.long).flatten()
+        aev_index = pruned_aev_index(
+            num_species, range(num_species) if species_subset is None else species_subset,
+            [EtaR.numel(), ShfR.numel()], [kept['EtaR'], kept['ShfR']],
+            [EtaA.numel(), Zeta.numel(), ShfA.numel(), ShfZ.numel()],
+            [kept['EtaA'], kept['Zeta'], kept['ShfA'], kept['ShfZ']])
+        EtaR, ShfR, EtaA, Zeta, ShfA, ShfZ = [
+            values.flatten()[kept[name].to(values.device)]
+            for name, values in [('EtaR', EtaR), ('ShfR', ShfR), ('EtaA', EtaA),
+                                 ('Zeta', Zeta), ('ShfA', ShfA), ('ShfZ', ShfZ)]]
+        species_map = torch.arange(num_species, dtype=torch.long)
+        self.prune_species = species_subset is not None
+        if species_subset is not None:
+            assert len(set(species_subset)) == len(species_subset), "species_subset has duplicates"
+            species_map = torch.full((num_species,), -1, dtype=torch.long)
+            species_map[torch.tensor(species_subset, dtype=torch.long)] = \
+                torch.arange(len(species_subset))
+            num_species = len(species_subset)
+
         self.Rcr = Rcr
         self.Rca = Rca
         assert Rca <= Rcr, "Current implementation of AEVComputer assumes Rca <= Rcr"
         self.num_species = num_species
+        self.cell_list_threshold = cell_list_threshold
+        self.small_system_threshold = small_system_threshold
+        self.verlet_skin = verlet_skin
+        # cutoff of the neighbor search, the angular pairs are a subset
+        self.neighbor_cutoff = self.Rcr + max(verlet_skin, 0.0)
 
         # cuda aev
         if use_cuda_extension:
@@ -488,6 +1886,57 @@ class AEVComputer(torch.nn.Module):
         self.register_buffer('Zeta', Zeta.view(1, -1, 1, 1))
         self.register_buffer('ShfA', ShfA.view(1, 1, -1, 1))
         self.register_buffer('ShfZ', ShfZ.view(1, 1, 1, -1))
+        self.acos_free_angular = acos_free_angular
+        self.angular_chunk_size = angular_chunk_size
+        self.analytic_gradients = analytic_gradients
+        assert precision in PRECISIONS, "precision must be one of {}".format(PRECISIONS)
+        self.precision = precision
+        self.radial_spline_intervals = radial_spline_intervals
+        if radial_spline_intervals > 0:
+            spline = radial_spline_table(Rcr, self.EtaR, self.ShfR, radial_spline_intervals)
+            self.radial_spline_error = radial_spline_error_bound(
+                Rcr, self.EtaR, self.ShfR, radial_spline_intervals)
+        else:
+            spline = torch.zeros((0, 4, 0), dtype=torch.float64, device=self.EtaR.device)
+            self.radial_spline_error = 0.0
+        self.register_buffer('radial_spline', spline)
+        self.register_buffer('species_map', species_map.to(self.EtaR.device), persistent=False)
+        self.register_buffer('aev_index', aev_index.to(self.EtaR.device), persistent=False)
+
+        # Static environment, see set_environment, and its grid
+        device = self.EtaR.device
+        self.register_buffer('environment_species', torch.zeros(
+            0, dtype=torch.long, device=device), persistent=False)
+        self.register_buffer('environment_coordinates', torch.zeros(
+            (0, 3), dtype=self.EtaR.dtype, device=device), persistent=False)
+        self.register_buffer('environment_charges', torch.zeros(
+            0, dtype=self.EtaR.dtype, device=device), persistent=False)
+        self.register_buffer('environment_reference', torch.zeros(
+            (0, 3), dtype=self.EtaR.dtype, device=device), persistent=False)
+        self.register_buffer('environment_lower_corner', torch.zeros(
+            3, dtype=self.EtaR.dtype, device=device), persistent=False)
+        self.register_buffer('environment_grid_shape', torch.ones(
+            3, dtype=torch.long, device=device), persistent=False)
+        self.register_buffer('environment_cell_start', torch.zeros(
+            2, dtype=torch.long, device=device), persistent=False)
+        self.register_buffer('environment_sorted_atoms', torch.zeros(
+            0, dtype=torch.long, device=device), persistent=False)
+        self.cache_geometry = cache_geometry
+        self.geometry_cache = None
+        self.environment_tolerance = 0.0
+        self.reuse_buffers = reuse_buffers
+        assert reduction in REDUCTIONS, "reduction must be one of {}".format(REDUCTIONS)
+        self.reduction = reduction
+        self.workspace = {}
+        self.padded_neighbors = neighbor_capacity > 0
+        self.neighbor_capacity = neighbor_capacity
+        self.angular_capacity = angular_capacity if angular_capacity > 0 else neighbor_capacity
+        self.validate_padded = validate_padded
+        if self.padded_neighbors:
+            assert verlet_skin <= 0 and radial_spline_intervals <= 0 and not cache_geometry \
+                and not analytic_gradients, "unsupported option with padded neighbors"
+        self.register_buffer('cos_ShfZ', torch.cos(self.ShfZ))
+        self.register_buffer('sin_ShfZ', torch.sin(self.ShfZ))
 
         # The length of radial subaev of a single species
         self.radial_sublength = self.EtaR.numel() * self.ShfR.numel()
@@ -516,6 +1965,36 @@ class AEVComputer(torch.nn.Module):
         self.register_buffer('default_cell', default_cell)
         self.register_buffer('default_shifts', default_shifts)
 
+        # State of the Verlet neighbor list, an empty verlet_coordinates
+        # means that the list has to be built on the next call.
+        self.register_buffer('verlet_index12', torch.zeros(
+            (2, 0), dtype=torch.long, device=self.EtaR.device), persistent=False)
+        self.register_buffer('verlet_shifts', torch.zeros(
+            (0, 3), dtype=torch.long, device=self.EtaR.device), persistent=False)
+        self.register_buffer('verlet_coordinates', torch.zeros(
+            0, dtype=self.EtaR.dtype, device=self.EtaR.device), persistent=False)
+
+        # Shifts of the last (cell, pbc) seen in forward, an empty
+        # shifts_cell means that nothing is cached yet.
+        self.register_buffer('shifts_cell', torch.zeros(
+            0, dtype=self.EtaR.dtype, device=self.EtaR.device), persistent=False)
+        self.register_buffer('shifts_pbc', default_pbc.clone(), persistent=False)
+        self.register_buffer('shifts', default_shifts.clone(), persistent=False)
+        self.register_buffer('shifts_minimum_image', torch.zeros(
+            (), dtype=torch.bool, device=self.EtaR.device), persistent=False)
+        self.register_buffer('verlet_species', torch.zeros(
+            0, dtype=torch.long, device=self.EtaR.device), persistent=False)
+        self.register_buffer('verlet_cell', torch.zeros(
+            0, dtype=self.EtaR.dtype, device=self.EtaR.device), persistent=False)
+        self.register_buffer('verlet_pbc', torch.zeros(
+            0, dtype=torch.bool, device=self.EtaR.device), persistent=False)
+        # largest numbers of neighbors and minimum image convention of the
+        # padded calls since the last check_padded_neighbors
+        self.register_buffer('padded_counts', torch.zeros(
+            2, dtype=torch.long, device=self.EtaR.device), persistent=False)
+        self.register_buffer('padded_minimum_image', torch.ones(
+            (), dtype=torch.bool, device=self.EtaR.device), persistent=False)
+
         # Should create only when use_cuda_extension is True.
         # However jit needs to know cuaev_computer's Type even when use_cuda_extension is False, because it is enabled when cuaev is available
         if has_cuaev:
@@ -541,7 +2020,8 @@ class AEVComputer(torch.nn.Module):
                        radial_eta: float, angular_eta: float,
                        radial_dist_divisions: int, angular_dist_divisions: int,
                        zeta: float, angle_sections: int, num_species: int,
-                       angular_start: float = 0.9, radial_start: float = 0.9):
+                       angular_start: float = 0.9, radial_start: float = 0.9,
+                       **kwargs):
         r""" Provides a convenient way to linearly fill cutoffs
 
         This is a user friendly constructor that builds an
@@ -551,7 +2031,8 @@ class AEVComputer(torch.nn.Module):
         default the distance shifts start at 0.9 Angstroms.
 
         To reproduce the ANI-1x AEV's the signature ``(5.2, 3.5, 16.0, 8.0, 16, 4, 32.0, 8, 4)``
-        can be used.
+        can be used. Any extra keyword arguments are passed to the
+        constructor.
         """
         # This is intended to be self documenting code that explains the way
         # the AEV parameters for ANI1x were chosen. This is not necessarily the
@@ -571,23 +2052,390 @@ class AEVComputer(torch.nn.Module):
         ShfZ = (torch.linspace(
             0, math.pi, angle_sections + 1) + angle_start)[:-1]
 
-        return cls(Rcr, Rca, EtaR, ShfR, EtaA, Zeta, ShfA, ShfZ, num_species)
+        return cls(Rcr, Rca, EtaR, ShfR, EtaA, Zeta, ShfA, ShfZ, num_species, **kwargs)
+
+    @torch.jit.export
+    def reset_neighbor_list(self):
+        """Discard the cached Verlet neighbor list, so that it is rebuilt
+        on the next call."""
+        self.verlet_coordinates = self.verlet_coordinates.new_zeros(0)
+
+    def verlet_is_valid(self, species: Tensor, coordinates: Tensor, cell: Optional[Tensor],
+                        pbc: Optional[Tensor]) -> bool:
+        """Check whether the cached Verlet neighbor list still contains all
+        the pairs within ``Rcr`` for the given input."""
+        if self.verlet_coordinates.shape != coordinates.shape:
+            return False
+        if not torch.equal(self.verlet_species, species):
+            return False
+        if cell is None:
+            if self.verlet_cell.numel() != 0:
+                return False
+        elif self.verlet_cell.shape != cell.shape or not torch.equal(self.verlet_cell, cell):
+            return False
+        if pbc is None:
+            if self.verlet_pbc.numel() != 0:
+                return False
+        elif self.verlet_pbc.shape != pbc.shape or not torch.equal(self.verlet_pbc, pbc):
+            return False
+        displacement = (coordinates - self.verlet_coordinates).norm(2, -1)
+        return displacement.numel() == 0 or bool(displacement.max() <= self.verlet_skin / 2)
+
+    def cached_shifts(self, cell: Tensor, pbc: Tensor) -> Tuple[Tensor, bool]:
+        """Return the shifts of the unit cell for ``neighbor_cutoff`` and
+        whether the minimum image convention can be used instead of them.
+        Both are only recomputed when the cell or pbc change."""
+        cell = cell.detach()
+        if self.shifts_cell.shape != cell.shape or not torch.equal(self.shifts_cell, cell) \
+                or not torch.equal(self.shifts_pbc, pbc):
+            self.shifts = compute_shifts(cell, pbc, self.neighbor_cutoff)
+            self.shifts_minimum_image = torch.tensor(
+                minimum_image_applies(cell, pbc, self.neighbor_cutoff), device=cell.device)
+            self.shifts_cell = cell.clone()
+            self.shifts_pbc = pbc.clone()
+        return self.shifts, bool(self.shifts_minimum_image)
+
+    def neighbor_search(self, species: Tensor, coordinates: Tensor,
+                        cell: Optional[Tensor], pbc: Optional[Tensor],
+                        center_mask: Optional[Tensor] = None) -> Tuple[Tensor, Optional[Tensor]]:
+        """Find the pairs of atoms within ``neighbor_cutoff`` and the
+        shifts of their second atoms, ``None`` without PBC. Without PBC and
+        with a ``center_mask``, only the pairs with a center atom are
+        searched."""
+        padding_mask = species == -1
+        if cell is None:
+            if center_mask is not None:
+                return neighbor_pairs_nopbc_centers(padding_mask, coordinates, center_mask,
+                                                    self.neighbor_cutoff), None
+            return neighbor_pairs_nopbc(padding_mask, coordinates, self.neighbor_cutoff,
+                                        self.cell_list_threshold), None
+        assert pbc is not None
+        shifts, minimum_image = self.cached_shifts(cell, pbc)
+        if minimum_image:
+            return neighbor_pairs_minimum_image(padding_mask, coordinates, cell, pbc,
+                                                self.neighbor_cutoff)
+        return neighbor_pairs(padding_mask, coordinates, cell, shifts, self.neighbor_cutoff)
+
+    def verlet_neighbors(self, species: Tensor, coordinates: Tensor,
+                         cell: Optional[Tensor], pbc: Optional[Tensor]) -> Tuple[Tensor, Optional[Tensor]]:
+        """Return the pairs of the Verlet neighbor list and their shift
+        values, rebuilding the list first if it is no longer valid. The
+        pairs include neighbors up to ``Rcr + verlet_skin``."""
+        coordinates = coordinates.detach()
+        if cell is not None:
+            cell = cell.detach()
+        if not self.verlet_is_valid(species, coordinates, cell, pbc):
+            self.verlet_index12, shifts = self.neighbor_search(
+                species, coordinates, cell, pbc)
+            if shifts is None or cell is None:
+                self.verlet_cell = coordinates.new_zeros(0)
+            else:
+                self.verlet_shifts = shifts
+                self.verlet_cell = cell.clone()
+            self.verlet_coordinates = coordinates.clone()
+            self.verlet_species = species.clone()
+            if pbc is None:
+                self.verlet_pbc = torch.zeros(0, dtype=torch.bool, device=coordinates.device)
+            else:
+                self.verlet_pbc = pbc.clone()
+
+        if cell is None:
+            return self.verlet_index12, None
+        return self.verlet_index12, pair_shift_values(self.verlet_shifts, cell, self.verlet_index12,
+                                                      species.shape[1])
 
     def constants(self):
         return self.Rcr, self.EtaR, self.ShfR, self.Rca, self.ShfZ, self.EtaA, self.Zeta, self.ShfA
 
+    @torch.jit.export
+    def set_environment(self, species: Tensor, coordinates: Tensor, charges: Tensor,
+                        rebuild_tolerance: float = 0.0):
+        """Set the static environment of the following calls
+
+        The grid of the environment is only rebuilt if the number of atoms
+        or the tolerance changed, or if an atom moved more than
+        ``rebuild_tolerance`` since the last build. A positive tolerance
+        makes the grid cells larger so that slightly moving (e.g.
+        restrained) environments can be updated cheaply every step.
+
+        Arguments:
+            species (:class:`torch.Tensor`): long tensor of shape (atoms)
+            coordinates (:class:`torch.Tensor`): tensor of shape (atoms, 3)
+            charges (:class:`torch.Tensor`): tensor of shape (atoms)
+            rebuild_tolerance (float): largest displacement of the
+                environment atoms before the grid is rebuilt
+        """
+        species = species.flatten()
+        coordinates = coordinates.detach().reshape(-1, 3)
+        assert species.shape[0] == coordinates.shape[0] == charges.numel(), \
+            "the environment needs one species, position and charge per atom"
+        if self.prune_species:
+            species = self.species_map.index_select(0, species)
+            assert not bool((species == -1).any()), \
+                "all the atoms must be of the species in species_subset"
+        rebuild = self.environment_reference.shape != coordinates.shape or \
+            rebuild_tolerance != self.environment_tolerance
+        if not rebuild:
+            displacement = (coordinates - self.environment_reference).norm(2, -1)
+            rebuild = bool((displacement > rebuild_tolerance).any())
+        if rebuild and coordinates.shape[0] > 0:
+            self.environment_lower_corner, self.environment_grid_shape, \
+                self.environment_cell_start, self.environment_sorted_atoms = \
+                environment_grid(coordinates, self.neighbor_cutoff + rebuild_tolerance)
+            self.environment_reference = coordinates.clone()
+            self.environment_tolerance = rebuild_tolerance
+        self.environment_species = species.clone()
+        self.environment_coordinates = coordinates.clone()
+        self.environment_charges = charges.detach().flatten().clone()
+
+    @torch.jit.export
+    def clear_workspace(self):
+        """Free the buffers kept with ``reuse_buffers``."""
+        self.workspace.clear()
+
+    def workspace_or_none(self) -> Optional[Dict[str, Tensor]]:
+        if self.reuse_buffers:
+            return self.workspace
+        return None
+
+    @torch.jit.export
+    def clear_environment(self):
+        """Remove the static environment set with :meth:`set_environment`."""
+        self.environment_species = self.environment_species.new_zeros(0)
+        self.environment_coordinates = self.environment_coordinates.new_zeros((0, 3))
+        self.environment_charges = self.environment_charges.new_zeros(0)
+        self.environment_reference = self.environment_reference.new_zeros((0, 3))
+
+    def environment_aev(self, species: Tensor, coordinates: Tensor, charges: Tensor) -> Tensor:
+        """Compute the AEVs of the mobile atoms of a system made of the
+        mobile atoms followed by the static environment."""
+        num_molecules, num_atoms = species.shape
+        num_environment = self.environment_species.shape[0]
+        total_atoms = num_atoms + num_environment
+        environment_coordinates = self.environment_coordinates.to(coordinates.dtype)
+        all_species = torch.cat([species, self.environment_species.expand(num_molecules, -1)], dim=1)
+        all_coordinates = torch.cat([coordinates, environment_coordinates.expand(num_molecules, -1, -1)],
+                                    dim=1)
+        all_charges = torch.cat([charges.reshape(num_molecules, num_atoms),
+                                 self.environment_charges.to(charges.dtype).expand(num_molecules, -1)],
+                                dim=1)
+
+        # pairs of mobile atoms, re-indexed into the molecules with the environment
+        padding_mask = species == -1
+        mobile_pairs = neighbor_pairs_nopbc(padding_mask, coordinates, self.neighbor_cutoff,
+                                            self.cell_list_threshold)
+        mobile_pairs = mobile_pairs + \
+            torch.div(mobile_pairs, num_atoms, rounding_mode="floor") * num_environment
+
+        # pairs of a mobile and an environment atom, from the grid
+        environment_pairs_ = environment_pairs(
+            coordinates.flatten(0, 1), self.environment_coordinates,
+            self.environment_lower_corner, self.environment_grid_shape,
+            self.environment_cell_start, self.environment_sorted_atoms,
+            self.neighbor_cutoff + self.environment_tolerance, self.neighbor_cutoff)
+        real = (~padding_mask.flatten()).index_select(0, environment_pairs_[0]).nonzero().flatten()
+        environment_pairs_ = environment_pairs_.index_select(1, real)
+        molecule_start = torch.div(environment_pairs_[0], num_atoms, rounding_mode="floor") * total_atoms
+        atom_index12 = torch.cat([
+            mobile_pairs,
+            torch.stack([molecule_start + environment_pairs_[0] % num_atoms,
+                         molecule_start + num_atoms + environment_pairs_[1]])], dim=1)
+
+        center_mask = torch.zeros((num_molecules, total_atoms), dtype=torch.bool, device=species.device)
+        center_mask[:, :num_atoms] = True
+        aev = compute_aev_from_neighbors(all_species, all_coordinates, all_charges, self.triu_index,
+                                         self.constants(), self.sizes, atom_index12, None,
+                                         angular_trig=self.angular_trig(coordinates.dtype),
+                                         angular_chunk_size=self.angular_chunk_size,
+                                         analytic_gradients=self.analytic_gradients,
+                                         center_mask=center_mask, precision=self.precision,
+                                         radial_spline=self.radial_spline_or_none(),
+                                         workspace=self.workspace_or_none(),
+                                         reduction=self.reduction)
+        return aev[:, :num_atoms]
+
+    def padded_aev(self, species: Tensor, coordinates: Tensor, charges: Tensor,
+                   cell: Optional[Tensor], pbc: Optional[Tensor]) -> Tensor:
+        """Compute the AEVs with :func:`neighbors_padded`. The numbers of
+        neighbors are only recorded for :meth:`check_padded_neighbors`,
+        unless ``validate_padded`` is set."""
+        padding_mask = species == -1
+        if self.validate_padded and cell is not None and pbc is not None:
+            assert minimum_image_applies(cell, pbc, self.Rcr), \
+                "padded neighbors need the minimum image convention"
+        neighbor_index, shift_values, neighbor_is_second, mask, angular_mask, neighbor_counts = \
+            neighbors_padded(padding_mask, coordinates, self.Rcr, self.Rca,
+                             self.neighbor_capacity, self.angular_capacity, cell, pbc)
+        if self.validate_padded:
+            if self.grow_capacity(neighbor_counts):
+                neighbor_index, shift_values, neighbor_is_second, mask, angular_mask, _ = \
+                    neighbors_padded(padding_mask, coordinates, self.Rcr, self.Rca,
+                                     self.neighbor_capacity, self.angular_capacity, cell, pbc)
+        else:
+            self.padded_counts.copy_(torch.maximum(self.padded_counts, neighbor_counts))
+            if cell is not None and pbc is not None:
+                self.padded_minimum_image.logical_and_(minimum_image_holds(cell, pbc, self.Rcr))
+        return compute_aev_padded(species, coordinates, charges, self.triu_index,
+                                  self.constants(), self.sizes, neighbor_index, shift_values,
+                                  neighbor_is_second, mask, angular_mask,
+                                  angular_trig=self.angular_trig(coordinates.dtype), precision=self.precision)
+
+    def grow_capacity(self, neighbor_counts: Tensor) -> bool:
+        """Set the capacities of the padded neighbor list that are exceeded
+        by ``neighbor_counts`` to 25% more than the counts, rounded up to a
+        multiple of 8, and return whether some were exceeded."""
+        counts: List[int] = neighbor_counts.tolist()
+        neighbor_count, angular_count = counts[0], counts[1]
+        overflow = False
+        if neighbor_count > self.neighbor_capacity:
+            self.neighbor_capacity = (int(neighbor_count * 1.25) + 7) // 8 * 8
+            overflow = True
+        if angular_count > self.angular_capacity:
+            self.angular_capacity = (int(angular_count * 1.25) + 7) // 8 * 8
+            overflow = True
+        return overflow
+
+    @torch.jit.export
+    def check_padded_neighbors(self) -> bool:
+        """Check the padded calls since the last check, outside of the hot
+        loop. Raises if the minimum image convention did not apply and
+        returns whether some neighbors did not fit, in which case the
+        capacities are grown and the AEVs of these calls lack neighbors and
+        should be recomputed."""
+        minimum_image = bool(self.padded_minimum_image)
+        counts = self.padded_counts.clone()
+        self.padded_minimum_image.fill_(True)
+        self.padded_counts.zero_()
+        assert minimum_image, "padded neighbors need the minimum image convention"
+        return self.grow_capacity(counts)
+
+    @torch.jit.unused
+    def cached_aev(self, species: Tensor, coordinates: Tensor, charges: Tensor,
+                   cell: Optional[Tensor], pbc: Optional[Tensor],
+                   center_mask: Optional[Tensor]) -> Optional[Tensor]:
+        """Return the AEVs with only the charge channel recomputed if the
+        geometry is the one of the cached call, ``None`` otherwise."""
+        if self.geometry_cache is None or coordinates.requires_grad:
+            return None
+        _, key, inputs, aev, atom_index12, species12, basis = self.geometry_cache
+        if key != (coordinates.data_ptr(), coordinates._version, coordinates.shape,
+                   coordinates.dtype, coordinates.device):
+            return None
+        for cached, current in zip(inputs, (species, cell, pbc, center_mask)):
+            if (cached is None) != (current is None):
+                return None
+            if cached is not None and (cached.shape != current.shape or
+                                       not torch.equal(cached, current)):
+                return None
+
+        _, accumulate_dtype = precision_dtypes(self.precision, coordinates.dtype)
+        flat_center_mask = None if center_mask is None else center_mask.flatten()
+        charge_aev = accumulate_charge(basis, atom_index12, species12,
+                                       charges.flatten().to(basis.dtype), self.num_species,
+                                       flat_center_mask, accumulate_dtype,
+                                       self.workspace_or_none(), self.reduction)
+        charge_aev = charge_aev.to(coordinates.dtype).view(
+            species.shape[0], species.shape[1], self.radial_length)
+        return torch.cat([aev[..., :self.radial_length], charge_aev,
+                          aev[..., 2 * self.radial_length:]], dim=-1)
+
+    @torch.jit.unused
+    def store_geometry(self, species: Tensor, coordinates: Tensor, aev: Tensor,
+                       cell: Optional[Tensor], pbc: Optional[Tensor],
+                       center_mask: Optional[Tensor], atom_index12: Tensor,
+                       shift_values: Optional[Tensor], filter_pairs: bool):
+        """Cache the AEVs and the radial basis of the pairs of a call for
+        :meth:`cached_aev`."""
+        flat_center_mask = None if center_mask is None else center_mask.flatten()
+        atom_index12, shift_values = select_pairs(coordinates, atom_index12, shift_values,
+                                                  self.Rcr, filter_pairs, flat_center_mask)
+        compute_dtype, _ = precision_dtypes(self.precision, coordinates.dtype)
+        flat_coordinates = coordinates.detach().flatten(0, 1).to(compute_dtype)
+        if shift_values is not None:
+            shift_values = shift_values.detach().to(compute_dtype)
+        distances = pair_vectors(flat_coordinates, atom_index12, shift_values).norm(2, -1)
+        radial_spline = self.radial_spline_or_none()
+        if radial_spline is None:
+            basis, _ = radial_basis(self.Rcr, self.EtaR.to(compute_dtype),
+                                    self.ShfR.to(compute_dtype), distances)
+        else:
+            basis = interpolate_radial_spline(radial_spline.to(compute_dtype), self.Rcr, distances)
+        # the coordinates are kept alive, otherwise a new tensor could be
+        # allocated at their address with the same version and match the key
+        key = (coordinates.data_ptr(), coordinates._version, coordinates.shape,
+               coordinates.dtype, coordinates.device)
+        inputs = tuple(None if tensor is None else tensor.detach().clone()
+                       for tensor in (species, cell, pbc, center_mask))
+        self.geometry_cache = (coordinates, key, inputs, aev.detach(), atom_index12,
+                               species.flatten()[atom_index12], basis)
+
+    @torch.jit.export
+    def reset_geometry_cache(self):
+        """Discard the geometry cached by ``cache_geometry``."""
+        if not torch.jit.is_scripting():
+            self.geometry_cache = None
+
+    def radial_spline_or_none(self) -> Optional[Tensor]:
+        if self.radial_spline_intervals > 0:
+            return self.radial_spline
+        return None
+
+    def angular_trig(self, dtype: torch.dtype) -> Optional[Tuple[Tensor, Tensor]]:
+        if not self.acos_free_angular:
+            return None
+        if self.cos_ShfZ.dtype == dtype:
+            return self.cos_ShfZ, self.sin_ShfZ
+        # the acos path evaluates cos(angles - ShfZ) at the dtype of the
+        # coordinates, so the trig of ShfZ has to be at that dtype too
+        ShfZ = self.ShfZ.to(dtype)
+        return torch.cos(ShfZ), torch.sin(ShfZ)
+
+    def center_mask(self, species: Tensor, centers: Optional[Tensor]) -> Optional[Tensor]:
+        """Convert ``centers``, either a boolean mask shaped like ``species``
+        or the indices of the center atoms in every molecule, to a mask."""
+        if centers is None:
+            return None
+        if centers.dtype == torch.bool:
+            assert centers.shape == species.shape, "the center mask must have the shape of species"
+            return centers
+        center_mask = torch.zeros(species.shape[1], dtype=torch.bool, device=species.device)
+        center_mask[centers.flatten()] = True
+        return center_mask.unsqueeze(0).expand_as(species)
+
+    def is_small_system(self, species: Tensor, cell: Optional[Tensor],
+                        centers: Optional[Tensor]) -> bool:
+        """Whether the AEVs are computed with :func:`compute_aev_dense`."""
+        # molecules of fewer than 3 atoms have no triplets, the pairs are faster
+        num_atoms = species.shape[1]
+        return num_atoms >= 3 and num_atoms <= self.small_system_threshold and \
+            cell is None and centers is None and self.verlet_skin <= 0.0 and not self.cache_geometry and \
+            self.radial_spline_intervals <= 0 and self.precision == 'native' and \
+            not self.analytic_gradients and self.angular_chunk_size <= 0 and \
+            not self.reuse_buffers and self.reduction == 'scatter'
+
+    def pruned_species(self, species: Tensor) -> Tensor:
+        """Map the species to their indices in ``species_subset``."""
+        if not self.prune_species:
+            return species
+        pruned = self.species_map.index_select(0, species.clamp(min=0).flatten()).view_as(species)
+        assert not bool(((pruned == -1) & (species != -1)).any()), \
+            "all the atoms must be of the species in species_subset"
+        return pruned.masked_fill(species == -1, -1)
+
     def forward(self, input_: Tuple[Tensor, Tensor, Tensor],
                 cell: Optional[Tensor] = None,
-                pbc: Optional[Tensor] = None) -> SpeciesAEV:
+                pbc: Optional[Tensor] = None,
+                centers: Optional[Tensor] = None) -> SpeciesAEV:
         """Compute AEVs
 
         Arguments:
             input_ (tuple): Can be one of the following two cases:
 
                 If you don't care about periodic boundary conditions at all,
-                then input can be a tuple of two tensors: species, coordinates.
-                species must have shape ``(N, A)``, coordinates must have shape
-                ``(N, A, 3)`` where ``N`` is the number of molecules in a batch,
+                then input can be a tuple of three tensors: species, coordinates
+                and charges. species must have shape ``(N, A)``, coordinates must
+                have shape ``(N, A, 3)`` and charges ``(N, A)`` (or flattened to
+                ``(N * A)``) where ``N`` is the number of molecules in a batch,
                 and ``A`` is the number of atoms.
 
                 .. warning::
@@ -610,9 +2458,18 @@ class AEVComputer(torch.nn.Module):
                             [x2, y2, z2],
                             [x3, y3, z3]])
 
+                or a tensor of shape (N, 3, 3) with one cell per molecule, e.g.
+                the frames of an NPT trajectory,
+
                 and pbc is boolean vector of size 3 storing if pbc is enabled
                 for that direction.
 
+            centers (:class:`torch.Tensor`, optional): The atoms whose AEVs
+                are needed, either as a boolean mask of shape ``(N, A)`` or
+                as a 1D tensor of atom indices used for every molecule. Only
+                the pairs and triplets centered on these atoms are computed
+                and the AEVs of all the other atoms are zero.
+
         Returns:
             NamedTuple: Species and AEVs. species are the species from the input
             unchanged, and AEVs is a tensor of shape ``(N, A, self.aev_length())``
@@ -621,6 +2478,8 @@ class AEVComputer(torch.nn.Module):
         assert species.dim() == 2
         assert species.shape == coordinates.shape[:-1]
         assert coordinates.shape[-1] == 3
+        input_species = species
+        species = self.pruned_species(species)
 
         if self.use_cuda_extension:
             assert (
@@ -628,17 +2487,106 @@ class AEVComputer(torch.nn.Module):
             # if use_cuda_extension is enabled after initialization
             if not self.cuaev_enabled:
                 self.init_cuaev_computer()
+            assert centers is None, "cuaev currently does not support centers"
             aev = self.compute_cuaev(species, coordinates)
-            return SpeciesAEV(species, aev)
+            return SpeciesAEV(input_species, aev)
 
-        if cell is None and pbc is None:
-            aev = compute_aev(species, coordinates, charges, self.triu_index,
-                              self.constants(), self.sizes, None)
-        else:
+        center_mask = self.center_mask(species, centers)
+        if cell is not None or pbc is not None:
             assert (cell is not None and pbc is not None)
-            cutoff = max(self.Rcr, self.Rca)
-            shifts = compute_shifts(cell, pbc, cutoff)
-            aev = compute_aev(species, coordinates, charges, self.triu_index,
-                              self.constants(), self.sizes, (cell, shifts))
+            assert cell.shape == (3, 3) or cell.shape == (species.shape[0], 3, 3), \
+                "cell must have shape (3, 3) or (N, 3, 3)"
+
+        if self.environment_species.shape[0] > 0:
+            assert cell is None and centers is None and self.verlet_skin <= 0.0 and \
+                not self.padded_neighbors, "unsupported option with a static environment"
+            return SpeciesAEV(input_species, self.environment_aev(species, coordinates, charges))
+
+        if self.padded_neighbors:
+            assert centers is None, "padded neighbors do not support centers"
+            return SpeciesAEV(input_species, self.padded_aev(species, coordinates, charges, cell, pbc))
+
+        if self.is_small_system(species, cell, centers):
+            return SpeciesAEV(input_species, compute_aev_dense(
+                species, coordinates, charges, self.triu_index, self.constants(), self.sizes,
+                angular_trig=self.angular_trig(coordinates.dtype)))
+
+        if self.cache_geometry and not torch.jit.is_scripting():
+            aev = self.cached_aev(species, coordinates, charges, cell, pbc, center_mask)
+            if aev is not None:
+                return SpeciesAEV(input_species, aev)
+
+        if self.verlet_skin > 0.0:
+            atom_index12, shift_values = self.verlet_neighbors(
+                species, coordinates, cell, pbc)
+            filter_pairs = True
+        else:
+            atom_index12, shifts = self.neighbor_search(
+                species, coordinates, cell, pbc, center_mask)
+            shift_values: Optional[Tensor] = None
+            if shifts is not None and cell is not None:
+                shift_values = pair_shift_values(shifts, cell, atom_index12, species.shape[1])
+            filter_pairs = False
+        aev = compute_aev_from_neighbors(species, coordinates, charges, self.triu_index,
+                                         self.constants(), self.sizes, atom_index12,
+                                         shift_values, filter_pairs=filter_pairs,
+                                         angular_trig=self.angular_trig(coordinates.dtype),
+                                         angular_chunk_size=self.angular_chunk_size,
+                                         analytic_gradients=self.analytic_gradients,
+                                         center_mask=center_mask,
+                                         precision=self.precision,
+                                         radial_spline=self.radial_spline_or_none(),
+                                         workspace=self.workspace_or_none(),
+                                         reduction=self.reduction)
+
+        if self.cache_geometry and not coordinates.requires_grad and not torch.jit.is_scripting():
+            self.store_geometry(species, coordinates, aev, cell, pbc, center_mask,
+                                atom_index12, shift_values, filter_pairs)
+        return SpeciesAEV(input_species, aev)
+
+    @torch.jit.export
+    def forward_packed(self, species: Tensor, coordinates: Tensor, charges: Tensor,
+                       molecule_offsets: Tensor) -> SpeciesAEV:
+        """Compute the AEVs of a packed batch of molecules of different sizes
+
+        The atoms of all the molecules are given one after the other
+        without padding, and the pairs are only searched inside of every
+        molecule with :func:`neighbor_pairs_packed`. The AEVs are the same
+        as the ones of the padded batch. PBC, centers, Verlet lists, the
+        padded neighbor list, the static environment and the geometry
+        cache are not supported.
+
+        Arguments:
+            species (:class:`torch.Tensor`): long tensor of shape (atoms)
+            coordinates (:class:`torch.Tensor`): tensor of shape (atoms, 3)
+            charges (:class:`torch.Tensor`): tensor of shape (atoms)
+            molecule_offsets (:class:`torch.Tensor`): long tensor of shape
+                (molecules + 1) with the index of the first atom of every
+                molecule followed by the total number of atoms.
 
-        return SpeciesAEV(species, aev)
+        Returns:
+            NamedTuple: Species and AEVs, the AEVs are a packed tensor of
+            shape ``(atoms, L)`` with the AEV length ``L`` of :meth:`forward`.
+        """
+        assert species.dim() == 1 and coordinates.shape == (species.shape[0], 3), \
+            "packed species and coordinates must have shapes (atoms) and (atoms, 3)"
+        assert charges.numel() == species.shape[0], "there must be one charge per atom"
+        assert int(molecule_offsets[0]) == 0 and int(molecule_offsets[-1]) == species.shape[0], \
+            "molecule_offsets must go from 0 to the number of atoms"
+        assert not self.use_cuda_extension and self.verlet_skin <= 0.0 and \
+            not self.padded_neighbors and self.environment_species.shape[0] == 0, \
+            "unsupported option with packed molecules"
+        atom_index12 = neighbor_pairs_packed(coordinates, molecule_offsets, self.Rcr)
+        # a single "molecule" of all the atoms, the pairs never cross molecules
+        aev = compute_aev_from_neighbors(self.pruned_species(species).unsqueeze(0),
+                                         coordinates.unsqueeze(0), charges.flatten(),
+                                         self.triu_index, self.constants(), self.sizes,
+                                         atom_index12, None,
+                                         angular_trig=self.angular_trig(coordinates.dtype),
+                                         angular_chunk_size=self.angular_chunk_size,
+                                         analytic_gradients=self.analytic_gradients,
+                                         precision=self.precision,
+                                         radial_spline=self.radial_spline_or_none(),
+                                         workspace=self.workspace_or_none(),
+                                         reduction=self.reduction)
+        return SpeciesAEV(species, aev.squeeze(0))
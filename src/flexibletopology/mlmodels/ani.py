@@ -26,7 +26,7 @@ class Ani(nn.Module):
 
     """
 
-    def __init__(self, platform: str = '', consts_file: str = ''):
+    def __init__(self, platform: str = '', consts_file: str = '', **aev_kwargs):
         """Constructor for the ANI model.  Read the parameters onfiguration
         file and create and instance of "AEVComputer".
 
@@ -40,6 +40,13 @@ class Ani(nn.Module):
         file including ANI parameters. You can find example files in
         `resources/ani_params`. Defaults to ''.
 
+        aev_kwargs: Extra options of the "AEVComputer", e.g.
+        ``verlet_skin`` to reuse the neighbor list across MD steps.
+        All the atoms are given the species 0, so
+        ``species_subset=[0]`` only computes and returns the blocks
+        of that species, and ``channels`` keeps the AEV channels of
+        the given shifts only.
+
         """
         super().__init__()
 
@@ -55,39 +62,83 @@ class Ani(nn.Module):
                     cuda_consts.update({key: value.to(self.device)})
                 else:
                     cuda_consts.update({key: value})
-            self.aev_computer = AEVComputer(**cuda_consts)
+            self.aev_computer = AEVComputer(**cuda_consts, **aev_kwargs)
         else:
-            self.aev_computer = AEVComputer(**consts)
+            self.aev_computer = AEVComputer(**consts, **aev_kwargs)
 
-    def forward(self, coordinates: Tensor, charges: Tensor) -> Tensor:
+    def forward(self, coordinates: Tensor, charges: Tensor,
+                centers: Optional[Tensor] = None) -> Tensor:
         """Calls the ANI model to calculate AEVs.
 
         The coordinates must be in ``(N, 3)`` shape and charges are in
-        the shape of ``(N)`` where "N" is the number of inputs.
+        the shape of ``(N)`` where "N" is the number of inputs. A batch
+        of ``B`` replicas of the same atoms can be evaluated in one
+        call with coordinates of shape ``(B, N, 3)`` and charges of
+        shape ``(B, N)``.
 
         Args:
             coordinates (Tensor): The coordinates of the molecule in 3D
             charges (Tensor): The partial charge on atoms
+            centers (Tensor, optional): Indices of the atoms whose AEVs
+            are returned, e.g. the ghost atoms. Only their neighborhoods
+            are evaluated. Defaults to all the atoms.
 
         Returns:
             Tensor: The radial and angular AEVs with the shape
-            ``(N, M)`` where ``(N)`` is the number of atoms and ``M``
-            depends on the TorcANI model parameters.
+            ``(N, M)`` (or ``(B, N, M)`` for a batch) where ``(N)``
+            is the number of atoms (or of centers) and ``M`` depends
+            on the TorcANI model parameters.
 
         """
-        assert len(coordinates.shape) == 2, "coordinates should be rank 2 array"
-        assert coordinates.shape[1] == 3, "coordinates are not of 3 dimensions"
-        assert len(charges) == 1, "charges are not of 1 dimensions"
-        assert coordinates.shape[0] == charges.shape[0], "coordinates and charges must have the same number of atoms"
+        batched = coordinates.dim() == 3
+        if not batched:
+            coordinates = coordinates.unsqueeze(0)
+            charges = charges.unsqueeze(0)
+
+        assert coordinates.dim() == 3, "coordinates should be rank 2 or 3 array"
+        assert coordinates.shape[-1] == 3, "coordinates are not of 3 dimensions"
+        assert charges.dim() == 2, "charges should have one dimension less than coordinates"
+        assert coordinates.shape[:-1] == charges.shape, "coordinates and charges must have the same number of atoms"
 
-        species = torch.zeros((1, coordinates.shape[0]),
+        species = torch.zeros((coordinates.shape[0], coordinates.shape[1]),
                               dtype=torch.int64,
                               device=coordinates.device)
         _, aev_signals = self.aev_computer((species,
-                                            coordinates.unsqueeze(0),
-                                            charges))
+                                            coordinates,
+                                            charges),
+                                           centers=centers)
+        if centers is not None:
+            aev_signals = aev_signals.index_select(1, centers)
+
+        if batched:
+            return aev_signals
+        return aev_signals.squeeze(0)
+
+    @torch.jit.export
+    def set_environment(self, coordinates: Tensor, charges: Tensor,
+                        rebuild_tolerance: float = 0.0):
+        """Set a static environment, e.g. the receptor atoms.
+
+        The following calls take the ghost atoms only and return
+        their AEVs in the presence of the environment. The grid of
+        the environment is only rebuilt when an atom moved more than
+        ``rebuild_tolerance`` since it was built.
 
-        return aev_signals.squeeze()
+        Args:
+            coordinates (Tensor): The coordinates of the environment, ``(E, 3)``
+            charges (Tensor): The partial charges of the environment, ``(E)``
+            rebuild_tolerance (float, optional): Defaults to 0.
+
+        """
+        species = torch.zeros(coordinates.shape[0], dtype=torch.int64,
+                              device=coordinates.device)
+        self.aev_computer.set_environment(species, coordinates, charges,
+                                          rebuild_tolerance)
+
+    @torch.jit.export
+    def clear_environment(self):
+        """Remove the static environment."""
+        self.aev_computer.clear_environment()
 
 
 class AniGSG(nn.Module):
@@ -114,13 +165,27 @@ class AniGSG(nn.Module):
         self.aev_computer = torchani.AEVComputer(**consts)
 
     def forward(self, coordinates: Tensor, signals: Tensor) -> Tensor:
+        """Calculate the GSG features of the atoms with their AEVs
+        added to the signals.
+
+        Coordinates of shape ``(N, 3)`` and signals of shape ``(N, F)``
+        give the features of one molecule. A batch of ``B`` replicas is
+        evaluated in one call with coordinates of shape ``(B, N, 3)``
+        and signals of shape ``(B, N, F)``, the features then have a
+        leading batch dimension.
+        """
+        batched = coordinates.dim() == 3
+        if not batched:
+            coordinates = coordinates.unsqueeze(0)
+            signals = signals.unsqueeze(0)
 
-        species = torch.ones((1, coordinates.shape[0]), dtype=torch.int64)
-        _, aev_signals = self.aev_computer((species,
-                                            coordinates.unsqueeze(0)))
+        species = torch.ones((coordinates.shape[0], coordinates.shape[1]),
+                             dtype=torch.int64, device=coordinates.device)
+        _, aev_signals = self.aev_computer((species, coordinates))
 
-        signals = torch.cat((aev_signals.squeeze(0),
-                             signals), 1)
+        signals = torch.cat((aev_signals, signals), -1)
 
         features = self.gsg_model(coordinates, signals)
-        return features
+        if batched:
+            return features
+        return features.squeeze(0)
@@ -4,14 +4,44 @@ import numpy as np
 from torch import Tensor
 from typing import Tuple, Optional, NamedTuple, List
 
-from flexibletopology.utils.stats import adjacency_matrix, skew, kurtosis
+from flexibletopology.utils.stats import (adjacency_matrix, sparse_adjacency_matrix,
+                                          central_moments)
+
+# Ways of computing the graph wavelets: 'squaring' multiplies the lazy
+# random walk by itself, 'spectral' diagonalizes it once, 'matrix_free'
+# only applies it to the signals and 'sparse' does so with a sparse
+# random walk, see GSG.
+WAVELET_METHODS = ('squaring', 'spectral', 'matrix_free', 'sparse')
 
 
 class GSG(nn.Module):
+    """Geometric scattering graph features of a molecule.
+
+    The positions of shape ``(N, 3)`` and signals of shape ``(N, F)``
+    give the features of one graph. Inputs with a leading batch
+    dimension, ``(B, N, 3)`` and ``(B, N, F)``, give the features of
+    ``B`` graphs of the same size in one call.
+
+    The wavelets are computed with one of ``WAVELET_METHODS``:
+    ``'squaring'`` (the default) squares the lazy random walk ``P``
+    ``max_wavelet_scale`` times, ``'spectral'`` diagonalizes the symmetric
+    matrix ``D^-1/2 A D^-1/2`` that ``P`` is similar to once and forms all
+    the dyadic powers from its eigenvalues, see :meth:`spectral_wavelet`.
+    ``'matrix_free'`` never forms the ``(J, N, N)`` wavelets, it applies
+    ``P`` to the signals ``2^J`` times instead, see
+    :meth:`matrix_free_wavelet_signals`. It costs ``O(N^2 F 2^J)``
+    instead of ``O(N^3 J)`` and is the fastest for large graphs with few
+    signals ``F``. ``'sparse'`` does the same with the nonzero entries of
+    the adjacency matrix and of ``P`` only, see
+    :func:`~flexibletopology.utils.stats.sparse_adjacency_matrix`, so the
+    cost and the memory are linear in the number of atoms. Unlike the
+    dense methods, it gives finite features for isolated atoms.
+    """
 
     def __init__(self, max_wavelet_scale: int = 4, radial_cutoff: float = 0.52,
                  sm_operators: Tuple[bool, bool, bool] = (True, True, True),
-                 sd_params: Optional[List[List[float]]] = None):
+                 sd_params: Optional[List[List[float]]] = None,
+                 wavelet_method: str = 'squaring'):
 
         super().__init__()
         self.is_trainable = False
@@ -19,76 +49,207 @@ class GSG(nn.Module):
         self.radial_cutoff = radial_cutoff
         self.sm_operators = sm_operators
         self.sd_params = sd_params
+        assert wavelet_method in WAVELET_METHODS, \
+            "wavelet_method must be one of {}".format(WAVELET_METHODS)
+        self.wavelet_method = wavelet_method
 
     def lazy_random_walk(self, adj_mat: Tensor) -> Tensor:
 
         # calcuate degree matrix
-        degree_mat = torch.sum(adj_mat, dim=0)
+        degree_mat = torch.sum(adj_mat, dim=-2)
 
         # calcuate A/D
-        adj_degree = torch.div(adj_mat, degree_mat)
+        adj_degree = torch.div(adj_mat, degree_mat.unsqueeze(-2))
 
         # sets NAN vlaues to zero
         # adj_degree = np.nan_to_num(adj_degree)
 
-        identity = torch.zeros_like(adj_degree)
-        identity.fill_diagonal_(1.0)
+        identity = torch.eye(adj_degree.shape[-1], dtype=adj_degree.dtype,
+                             device=adj_degree.device)
 
         return 1/2 * (identity + adj_degree)
 
     # calcuate the graph wavelets based on the paper
     def graph_wavelet(self, probability_mat: Tensor) -> Tensor:
 
-        wavelets = []
+        # the wavelets P^(2^j) - P^(2^(j+1)) from the successive squares of P
+        powers = [probability_mat]
         for j in range(self.max_wavelet_scale):
-            wavelet = torch.matrix_power(probability_mat, int(2 ** j)) \
-                - torch.matrix_power(probability_mat, int(2*(2 ** j)))
-
-            wavelets.append(wavelet)
+            powers.append(torch.matmul(powers[-1], powers[-1]))
+
+        return torch.stack(powers[:-1], dim=-3) - torch.stack(powers[1:], dim=-3)
+
+    def sparse_lazy_random_walk(self, edge_index: Tensor, adj: Tensor,
+                                num_nodes: int) -> Tensor:
+        # the entries of P = 1/2 (I + A / D) at the edges of the sparse
+        # adjacency matrix, the diagonal 1/2 is left out
+        degree = torch.zeros(num_nodes, dtype=adj.dtype,
+                             device=adj.device).index_add(0, edge_index[1], adj)
+
+        return 0.5 * adj / degree.index_select(0, edge_index[1])
+
+    def random_walk_step(self, probability_mat: Tensor, signals: Tensor,
+                         edge_index: Optional[Tensor]) -> Tensor:
+        if edge_index is None:
+            return torch.matmul(probability_mat, signals)
+
+        # P X with the entries of P at the edges, for the (nodes, F) signals
+        return 0.5 * signals + torch.zeros_like(signals).index_add(
+            0, edge_index[0], probability_mat.unsqueeze(-1) *
+            signals.index_select(0, edge_index[1]))
+
+    def matrix_free_wavelet_signals(self, probability_mat: Tensor, signals: Tensor,
+                                    edge_index: Optional[Tensor] = None) -> Tensor:
+        """The wavelets applied to the ``(..., N, F)`` signals,
+        ``(P^(2^j) - P^(2^(j+1))) X`` of shape ``(..., J, N, F)``, from the
+        products ``P^k X`` without forming the powers of ``P``.
+
+        With ``edge_index``, ``probability_mat`` holds the entries of
+        ``P`` at those edges instead, see :meth:`sparse_lazy_random_walk`.
+        """
+        shape = signals.shape
+        walk_edges = edge_index
+        if edge_index is not None:
+            signals = signals.reshape(-1, shape[-1])
+            if not (probability_mat.requires_grad or signals.requires_grad):
+                # a sparse matrix product is faster than index_add, but not
+                # its backward pass
+                num_nodes = signals.shape[0]
+                diagonal = torch.arange(num_nodes, device=signals.device)
+                probability_mat = torch.sparse_coo_tensor(
+                    torch.cat([edge_index, torch.stack([diagonal, diagonal])], dim=1),
+                    torch.cat([probability_mat, torch.full([num_nodes], 0.5,
+                                                           dtype=probability_mat.dtype,
+                                                           device=signals.device)]),
+                    [num_nodes, num_nodes]).coalesce()
+                walk_edges = None
+
+        walked_signals = self.random_walk_step(probability_mat, signals, walk_edges)
+        powers = [walked_signals]
+        for j in range(self.max_wavelet_scale):
+            for step in range(1 << j):
+                walked_signals = self.random_walk_step(probability_mat, walked_signals,
+                                                       walk_edges)
+            powers.append(walked_signals)
+
+        wavelet_signals = torch.stack(powers[:-1], dim=-3) - torch.stack(powers[1:], dim=-3)
+        if edge_index is not None:
+            wavelet_signals = wavelet_signals.reshape(
+                [self.max_wavelet_scale] + list(shape)).movedim(0, -3)
+
+        return wavelet_signals
+
+    def wavelet_moments(self, coefficients: Tensor) -> Tensor:
+        # the moments over the nodes of the (..., J, N, F) coefficients
+        mean, var, skewness, kurtosis = central_moments(coefficients, dim=-2)
+
+        return torch.stack([mean, var, skewness, kurtosis], dim=-3).flatten(-3).unsqueeze(-1)
+
+    def matrix_free_features(self, probability_mat: Tensor, signals: Tensor,
+                             edge_index: Optional[Tensor] = None) -> List[Tensor]:
+        # the first and second order features of the 'matrix_free' and the
+        # 'sparse' methods
+        wavelet_signals = torch.abs(self.matrix_free_wavelet_signals(probability_mat,
+                                                                     signals, edge_index))
+        features = []
+        if self.sm_operators[1]:
+            features.append(self.wavelet_moments(wavelet_signals))
 
-        return torch.stack(wavelets)
+        if self.sm_operators[2]:
+            # all the wavelets applied to the first order signals of the scales
+            # but the last one side by side, then the pairs (i, a) with a < i
+            num_scales = wavelet_signals.shape[-3]
+            num_signals = wavelet_signals.shape[-1]
+            stacked_signals = wavelet_signals.narrow(-3, 0, num_scales - 1)
+            stacked_signals = stacked_signals.transpose(-3, -2).flatten(-2)
+            coefficients = torch.abs(self.matrix_free_wavelet_signals(probability_mat,
+                                                                      stacked_signals,
+                                                                      edge_index))
+            coefficients = coefficients.reshape(
+                list(coefficients.shape[:-1]) + [num_scales - 1, num_signals])
+            coefficients = coefficients.transpose(-3, -2).flatten(-4, -3)
+            scales = torch.tril_indices(num_scales, num_scales, -1,
+                                        device=signals.device)
+            coefficients = coefficients.index_select(
+                -3, scales[0] * (num_scales - 1) + scales[1])
+            features.append(self.wavelet_moments(coefficients))
+
+        return features
 
     def zero_order_feature(self, signals) -> Tensor:
         # zero order feature calcuated using signal of the graph.
-        features = []
+        mean, var, skewness, kurtosis = central_moments(signals, dim=-2)
 
-        features.append(torch.mean(signals, dim=0))
-        features.append(torch.var(signals, dim=0, unbiased=False))
-        features.append(skew(signals, dim=0, bias=False))
-        features.append(kurtosis(signals, dim=0, bias=False))
-
-        return torch.stack(features).reshape(-1, 1)
+        return torch.stack([mean, var, skewness, kurtosis], dim=-2).flatten(-2).unsqueeze(-1)
 
     def first_order_feature(self, wavelets: Tensor, signals: Tensor) -> Tensor:
 
-        wavelet_signals = torch.abs(torch.matmul(wavelets, signals))
-        features = []
-        features.append(torch.mean(wavelet_signals, dim=1))
-        features.append(torch.var(wavelet_signals, dim=1, unbiased=False))
-        features.append(skew(wavelet_signals, dim=1, bias=False))
-        features.append(kurtosis(wavelet_signals, dim=1, bias=False))
+        wavelet_signals = torch.abs(torch.matmul(wavelets, signals.unsqueeze(-3)))
 
-        return torch.stack(features).reshape(-1, 1)
+        return self.wavelet_moments(wavelet_signals)
 
     def second_order_feature(self, wavelets: Tensor, signals: Tensor) -> Tensor:
-        wavelet_signals = torch.abs(torch.matmul(wavelets, signals))
-        coefficents = []
-        for i in range(1, len(wavelets)):
-            coefficents.append(torch.einsum('ij,ajt ->ait', wavelets[i],
-                                            wavelet_signals[0:i]))
-
-        coefficents = torch.abs(torch.cat(coefficents, dim=0))
-
-        features = []
-
-        features.append(torch.mean(coefficents, dim=1))
-        features.append(torch.var(coefficents, dim=1, unbiased=False))
-        features.append(skew(coefficents, dim=1, bias=False))
-        features.append(kurtosis(coefficents, dim=1, bias=False))
-
-        return torch.stack(features).reshape(-1, 1)
+        wavelet_signals = torch.abs(torch.matmul(wavelets, signals.unsqueeze(-3)))
+        # the wavelet i applied to the first order signals of the scales a < i,
+        # all the pairs (i, a) in one batched product
+        scales = torch.tril_indices(wavelets.shape[-3], wavelets.shape[-3], -1,
+                                    device=wavelets.device)
+        coefficents = torch.abs(torch.matmul(wavelets.index_select(-3, scales[0]),
+                                             wavelet_signals.index_select(-3, scales[1])))
+
+        return self.wavelet_moments(coefficents)
+
+    def spectral_wavelet(self, adj_mat: Tensor) -> Tensor:
+        """Graph wavelets of the lazy random walk of a symmetric adjacency
+        matrix from one eigendecomposition.
+
+        With ``S = D^-1/2 A D^-1/2 = V diag(l) V^T`` the lazy random walk
+        is ``P = D^1/2 V diag(m) V^T D^-1/2`` with ``m = (1 + l) / 2``, so
+        every wavelet ``P^(2^j) - P^(2^(j+1))`` only needs the powers of
+        the eigenvalues. The eigenvectors are not differentiated, the
+        gradient with respect to ``S`` is added as the Frechet derivative
+        ``V (G o V^T dS V) V^T`` of the matrix function, where ``G`` holds
+        the divided differences of ``m^(2^j) - m^(2^(j+1))``. Unlike the
+        gradient of ``eigh``, it stays finite for repeated eigenvalues. It
+        is only a first order gradient.
+        """
+        degree = torch.sum(adj_mat, dim=-2)
+        sqrt_degree = torch.sqrt(degree)
+        sym_mat = adj_mat / (sqrt_degree.unsqueeze(-1) * sqrt_degree.unsqueeze(-2))
+        eigenvalues, eigenvectors = torch.linalg.eigh(sym_mat.detach())
+        lazy_eigenvalues = 0.5 * (1 + eigenvalues)
+
+        # powers m^(2^j) and their divided differences
+        # (m_a^n - m_b^n) / (m_a - m_b), from the ones of n / 2
+        powers = [lazy_eigenvalues]
+        divided_differences = [torch.ones_like(sym_mat)]
+        for j in range(self.max_wavelet_scale):
+            divided_differences.append(divided_differences[-1] *
+                                       (powers[-1].unsqueeze(-1) + powers[-1].unsqueeze(-2)))
+            powers.append(powers[-1] * powers[-1])
+        spectra = torch.stack(powers[:-1], dim=-2) - torch.stack(powers[1:], dim=-2)
+        # d m / d l = 1 / 2
+        differences = 0.5 * (torch.stack(divided_differences[:-1], dim=-3) -
+                             torch.stack(divided_differences[1:], dim=-3))
+
+        eigenvectors = eigenvectors.unsqueeze(-3)
+        transposed = eigenvectors.transpose(-1, -2)
+        sym_wavelets = torch.matmul(eigenvectors * spectra.unsqueeze(-2), transposed)
+        if sym_mat.requires_grad:
+            # zero valued, only carries the gradient with respect to sym_mat
+            sym_change = (sym_mat - sym_mat.detach()).unsqueeze(-3)
+            sym_wavelets = sym_wavelets + torch.matmul(
+                torch.matmul(eigenvectors, differences * torch.matmul(
+                    torch.matmul(transposed, sym_change), eigenvectors)), transposed)
+
+        return sqrt_degree.unsqueeze(-1).unsqueeze(-3) * sym_wavelets / \
+            sqrt_degree.unsqueeze(-2).unsqueeze(-3)
 
     def wavelets(self, adj_mat: Tensor) -> Tensor:
+        # the 'matrix_free' and 'sparse' methods only form them here, by squaring
+
+        if self.wavelet_method == 'spectral':
+            return self.spectral_wavelet(adj_mat)
 
         probability_mat = self.lazy_random_walk(adj_mat)
 
@@ -101,12 +262,6 @@ class GSG(nn.Module):
 
     def forward(self, positions: Tensor, signals: Tensor) -> Tensor:
 
-        adj_mat = adjacency_matrix(positions, self.radial_cutoff)
-
-        probability_mat = self.lazy_random_walk(adj_mat)
-
-        wavelets = self.graph_wavelet(probability_mat)
-
         gsg_features = []
         if self.sd_params is not None:
             signals = self.standardize(signals)
@@ -114,10 +269,27 @@ class GSG(nn.Module):
         if self.sm_operators[0]:
             gsg_features.append(self.zero_order_feature(signals))
 
+        if self.wavelet_method == 'sparse':
+            edge_index, adj = sparse_adjacency_matrix(positions, self.radial_cutoff)
+            probability_mat = self.sparse_lazy_random_walk(edge_index, adj,
+                                                           positions.numel() // 3)
+            gsg_features.extend(self.matrix_free_features(probability_mat, signals,
+                                                          edge_index))
+            return torch.cat(gsg_features, dim=-2)
+
+        adj_mat = adjacency_matrix(positions, self.radial_cutoff)
+
+        if self.wavelet_method == 'matrix_free':
+            gsg_features.extend(self.matrix_free_features(self.lazy_random_walk(adj_mat),
+                                                          signals))
+            return torch.cat(gsg_features, dim=-2)
+
+        wavelets = self.wavelets(adj_mat)
+
         if self.sm_operators[1]:
             gsg_features.append(self.first_order_feature(wavelets, signals))
 
         if self.sm_operators[2]:
             gsg_features.append(self.second_order_feature(wavelets, signals))
 
-        return torch.cat(gsg_features, dim=0)
+        return torch.cat(gsg_features, dim=-2)
@@ -0,0 +1,91 @@
+"""Neighbor searches shared by the AEVs and the graph features."""
+
+import math
+
+import torch
+from torch import Tensor
+
+
+def cumsum_from_zero(input_: Tensor) -> Tensor:
+    cumsum = torch.zeros_like(input_)
+    torch.cumsum(input_[:-1], dim=0, out=cumsum[1:])
+    return cumsum
+
+
+def neighbor_pairs_nopbc_cell_list(padding_mask: Tensor, coordinates: Tensor, cutoff: float) -> Tensor:
+    """Compute pairs of atoms that are neighbors with a linked cell list
+    (doesn't use PBC)
+
+    The bounding box of every molecule is divided into cubic cells with
+    an edge of ``cutoff``, so the neighbors of an atom can only be in its
+    own cell or in one of the 26 adjacent cells. Only those candidates are
+    checked, which makes the search linear in the number of atoms instead
+    of quadratic. The grid is padded by one empty cell on every side so
+    that adjacent cells never fall outside of it.
+
+    The returned pairs, including their order, are the same as the ones
+    of :func:`~flexibletopology.mlmodels.aev.neighbor_pairs_nopbc_all_pairs`.
+
+    Arguments:
+        padding_mask (:class:`torch.Tensor`): boolean tensor of shape
+            (molecules, atoms) for padding mask. 1 == is padding.
+        coordinates (:class:`torch.Tensor`): tensor of shape
+            (molecules, atoms, 3) for atom coordinates.
+        cutoff (float): the cutoff inside which atoms are considered pairs
+    """
+    coordinates = coordinates.detach()
+    current_device = coordinates.device
+    num_atoms = padding_mask.shape[1]
+    num_mols = padding_mask.shape[0]
+    total_atoms = num_mols * num_atoms
+
+    # Step 1: assign the real atoms to cells, the cell index of each
+    # direction starts from 1 because of the padding cells
+    real_atoms = (~padding_mask).flatten().nonzero().flatten()
+    if real_atoms.shape[0] == 0:
+        return torch.zeros((2, 0), dtype=torch.long, device=current_device)
+    flat_coordinates = coordinates.flatten(0, 1)
+    real_coordinates = flat_coordinates.index_select(0, real_atoms)
+    molecule_index = torch.div(real_atoms, num_atoms, rounding_mode="floor")
+    lower_corner = coordinates.masked_fill(
+        padding_mask.unsqueeze(-1), math.inf).min(dim=1)[0]
+    cell_index = torch.floor(
+        (real_coordinates - lower_corner.index_select(0, molecule_index)) / cutoff).to(torch.long) + 1
+    grid = cell_index.max(dim=0)[0] + 2
+    num_cells = num_mols * int(grid.prod().item())
+    cell_key = ((molecule_index * grid[0] + cell_index[:, 0]) * grid[1]
+                + cell_index[:, 1]) * grid[2] + cell_index[:, 2]
+
+    # Step 2: sort the atoms by cell, the atoms of cell k are then
+    # sorted_atoms[cell_start[k]:cell_start[k] + cell_count[k]]
+    sorted_key, sorted_order = cell_key.sort()
+    sorted_atoms = real_atoms.index_select(0, sorted_order)
+    cell_count = torch.bincount(sorted_key, minlength=num_cells)
+    cell_start = cumsum_from_zero(cell_count)
+
+    # Step 3: gather the atoms of the 27 cells around each atom
+    r = torch.arange(-1, 2, device=current_device)
+    offsets = torch.cartesian_prod(r, r, r)
+    key_offsets = (offsets[:, 0] * grid[1] + offsets[:, 1]) * grid[2] + offsets[:, 2]
+    neighbor_keys = (cell_key.unsqueeze(1) + key_offsets).flatten()
+    neighbor_count = cell_count.index_select(0, neighbor_keys)
+    candidate_owner = torch.repeat_interleave(neighbor_count)
+    local_index = torch.arange(candidate_owner.shape[0], device=current_device) - \
+        cumsum_from_zero(neighbor_count).index_select(0, candidate_owner)
+    atom_index2 = sorted_atoms.index_select(
+        0, cell_start.index_select(0, neighbor_keys).index_select(0, candidate_owner) + local_index)
+    atom_index1 = real_atoms.index_select(
+        0, torch.div(candidate_owner, offsets.shape[0], rounding_mode="floor"))
+
+    # Step 4: keep each pair once and find all pairs within cutoff
+    is_upper = (atom_index1 < atom_index2).nonzero().flatten()
+    atom_index12 = torch.stack([atom_index1, atom_index2]).index_select(1, is_upper)
+    pair_coordinates = flat_coordinates.index_select(
+        0, atom_index12.view(-1)).view(2, -1, 3)
+    distances = (pair_coordinates[0] - pair_coordinates[1]).norm(2, -1)
+    in_cutoff = (distances <= cutoff).nonzero().flatten()
+    atom_index12 = atom_index12.index_select(1, in_cutoff)
+
+    # Step 5: restore the ordering of the all-pairs search
+    pair_order = (atom_index12[0] * total_atoms + atom_index12[1]).argsort()
+    return atom_index12.index_select(1, pair_order)
@@ -2,21 +2,58 @@ import sys
 import torch
 import numpy as np
 from torch import Tensor
-from typing import List
+from typing import List, Tuple
+
+from flexibletopology.utils.neighbors import neighbor_pairs_nopbc_cell_list
 
 
 def distance_matrix(x: Tensor) -> Tensor:
-    return torch.norm(x[:, None] - x, dim=2, p=2)
+    # positions of shape (..., N, 3), e.g. a batch of replicas
+    return torch.norm(x[..., :, None, :] - x[..., None, :, :], dim=-1, p=2)
 
 
 def adjacency_matrix(positions: Tensor, radial_cutoff: float) -> Tensor:
     dist = distance_matrix(positions)
-    dist = torch.where(dist > radial_cutoff,
-                       torch.tensor(0.0, dtype=dist.dtype,
-                                    device=positions.device),
-                       0.5 * torch.cos(np.pi * dist/radial_cutoff) + 0.5)
-    dist.fill_diagonal_(0.0)
-    return dist
+    adj = (0.5 * torch.cos(dist * (np.pi / radial_cutoff)) + 0.5).masked_fill(
+        dist > radial_cutoff, 0.0)
+    torch.diagonal(adj, dim1=-2, dim2=-1).fill_(0.0)
+    return adj
+
+
+def sparse_adjacency_matrix(positions: Tensor, radial_cutoff: float) -> Tuple[Tensor, Tensor]:
+    """The nonzero entries of :func:`adjacency_matrix` in COO format.
+
+    The pairs within ``radial_cutoff`` are found with a linked cell list,
+    so the cost and the memory are linear in the number of atoms. The
+    atoms of positions of shape ``(..., N, 3)`` are numbered one graph
+    after the other. Returns the ``(2, E)`` indices of the entries, both
+    ``(i, j)`` and ``(j, i)`` of every pair, and their ``(E,)`` values,
+    which are differentiable with respect to the positions.
+    """
+    coordinates = positions.reshape(-1, positions.shape[-2], 3)
+    padding_mask = torch.zeros(coordinates.shape[:2], dtype=torch.bool,
+                               device=positions.device)
+    atom_index12 = neighbor_pairs_nopbc_cell_list(padding_mask, coordinates, radial_cutoff)
+    flat_coordinates = coordinates.reshape(-1, 3)
+    dist = (flat_coordinates.index_select(0, atom_index12[0]) -
+            flat_coordinates.index_select(0, atom_index12[1])).norm(2, -1)
+    adj = 0.5 * torch.cos(dist * (np.pi / radial_cutoff)) + 0.5
+    return torch.cat([atom_index12, atom_index12.flip(0)], dim=1), torch.cat([adj, adj])
+
+
+def central_moments(a: Tensor, dim: int = 0) -> Tuple[Tensor, Tensor, Tensor, Tensor]:
+    """The mean and the second, third and fourth central moments of ``a``
+    along ``dim``.
+
+    The same as ``a.mean(dim)``, ``a.var(dim, unbiased=False)``,
+    ``skew(a, dim)`` and ``kurtosis(a, dim)``, but the values are centered
+    once and the moments share the centered values and their square.
+    """
+    mean = a.mean(dim, keepdim=True)
+    centered = a - mean
+    squared = centered * centered
+    return (mean.squeeze(dim), squared.mean(dim), (squared * centered).mean(dim),
+            (squared * squared).mean(dim))
 
 
 def moment(a: Tensor, moment: int = 1, dim: int = 0) -> Tensor:
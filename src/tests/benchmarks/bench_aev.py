@@ -0,0 +1,371 @@
+"""Benchmarks of the AEV computation in `flexibletopology.mlmodels.aev`.
+
+Run from the `src` directory, e.g.
+
+    python tests/benchmarks/bench_aev.py angular precision radial_spline
+    python tests/benchmarks/bench_aev.py scaling --atoms 10 100 1000 --json aev.json
+    python tests/benchmarks/bench_aev.py scaling --json new.json --compare aev.json
+    python tests/benchmarks/bench_aev.py reduction --atoms 1000 5000 --threads 1 8
+
+With `--compare` the timings are checked against a previous JSON file and
+the script exits with an error if any of them got slower than allowed by
+`--tolerance`.
+"""
+import argparse
+import inspect
+import json
+import platform
+import sys
+import time
+
+import torch
+
+from flexibletopology.mlmodels.aev import (PRECISIONS, REDUCTIONS, AEVComputer,
+                                           angular_terms,
+                                           angular_terms_acos_free,
+                                           radial_charge_terms,
+                                           radial_spline_table,
+                                           radial_spline_error_bound,
+                                           tabulated_radial_charge_terms)
+
+REPEATS = 20
+
+
+def aev_computer(**kwargs):
+    return AEVComputer.cover_linearly(5.2, 3.5, 16.0, 8.0, 16, 4, 32.0, 8, 1,
+                                      **kwargs)
+
+
+def torchani_computer(computer):
+    """Build the `torchani.AEVComputer` with the constants of `computer`,
+    or return None if torchani is not installed."""
+    try:
+        import torchani
+    except ImportError:
+        return None
+    constants = (computer.Rcr, computer.Rca, computer.EtaR.flatten(),
+                 computer.ShfR.flatten(), computer.EtaA.flatten(),
+                 computer.Zeta.flatten(), computer.ShfA.flatten(),
+                 computer.ShfZ.flatten())
+    if hasattr(torchani.AEVComputer, 'from_constants'):
+        Rcr, Rca, EtaR, ShfR, EtaA, Zeta, ShfA, ShfZ = constants
+        reference = torchani.AEVComputer.from_constants(
+            Rcr, Rca, float(EtaR[0]), ShfR.tolist(), float(EtaA[0]), float(Zeta[0]),
+            ShfA.tolist(), ShfZ.tolist(), computer.num_species)
+
+        def forward(species, coordinates, cell=None, pbc=None):
+            return reference(species, coordinates, cell, pbc)
+    else:
+        reference = torchani.AEVComputer(*constants, computer.num_species)
+
+        def forward(species, coordinates, cell=None, pbc=None):
+            return reference((species, coordinates), cell, pbc).aevs
+    forward.module = reference
+    return forward
+
+
+def timeit(func, repeats=REPEATS):
+    """Return the mean wall time of `func` in milliseconds after one
+    warm up call."""
+    func()
+    start = time.perf_counter()
+    for _ in range(repeats):
+        func()
+    return (time.perf_counter() - start) / repeats * 1e3
+
+
+def bench_angular(num_triplets=(1000, 10000, 100000), dtype=torch.float32):
+    """Time the forward and backward pass of the acos and the acos free
+    angular terms."""
+    computer = aev_computer(acos_free_angular=True)
+    constants = (computer.EtaA.to(dtype), computer.Zeta.to(dtype),
+                 computer.ShfA.to(dtype))
+    cos_ShfZ, sin_ShfZ = computer.angular_trig(dtype)
+    methods = {
+        'acos': lambda v: angular_terms(computer.Rca, computer.ShfZ.to(dtype),
+                                        *constants, v),
+        'acos_free': lambda v: angular_terms_acos_free(computer.Rca, cos_ShfZ, sin_ShfZ,
+                                                       *constants, v),
+    }
+
+    results = []
+    for num in num_triplets:
+        vectors12 = ((torch.rand(2, num, 3, dtype=dtype) - 0.5) * 4).requires_grad_()
+        for name, method in methods.items():
+            forward = timeit(lambda: method(vectors12))
+            backward = timeit(lambda: method(vectors12).sum().backward())
+            results.append({'benchmark': 'angular', 'method': name,
+                            'num_triplets': num, 'forward_ms': forward,
+                            'forward_backward_ms': backward})
+    return results
+
+
+def random_system(num_atoms, density=0.1, dtype=torch.float64):
+    box = (num_atoms / density) ** (1 / 3)
+    coordinates = torch.rand(1, num_atoms, 3, dtype=dtype) * box
+    species = torch.zeros(1, num_atoms, dtype=torch.long)
+    charges = torch.rand(1, num_atoms, dtype=dtype) - 0.5
+    return species, coordinates, charges
+
+
+def bench_precision(num_atoms=(100, 1000), analytic_gradients=(False, True)):
+    """Accuracy and time of the precision policies against float64.
+
+    The energy is a fixed random linear readout of the AEVs, the forces
+    and the charge derivatives are its gradients.
+    """
+    results = []
+    for num in num_atoms:
+        species, coordinates, charges = random_system(num)
+        readout = None
+        for analytic in analytic_gradients:
+            reference = None
+            for precision in PRECISIONS:
+                computer = aev_computer(precision=precision,
+                                        analytic_gradients=analytic)
+                if readout is None:
+                    readout = torch.randn(computer.aev_length + computer.radial_length,
+                                          dtype=torch.float64)
+
+                def energy_and_gradients():
+                    coords = coordinates.clone().requires_grad_()
+                    chrgs = charges.clone().requires_grad_()
+                    _, aevs = computer((species, coords, chrgs))
+                    energy = (aevs @ readout).sum()
+                    forces, charge_grads = torch.autograd.grad(energy, (coords, chrgs))
+                    return energy.detach(), -forces, charge_grads
+
+                values = energy_and_gradients()
+                if reference is None:
+                    reference = values
+                errors = [float((value - ref).abs().max())
+                          for value, ref in zip(values, reference)]
+                results.append({'benchmark': 'precision', 'precision': precision,
+                                'analytic_gradients': analytic, 'num_atoms': num,
+                                'energy_error': errors[0],
+                                'relative_energy_error': errors[0] / float(reference[0].abs()),
+                                'max_force_error': errors[1],
+                                'max_charge_derivative_error': errors[2],
+                                'forward_backward_ms': timeit(energy_and_gradients, 5)})
+    return results
+
+
+def bench_radial_spline(num_pairs=(10000, 100000), num_intervals=(250, 1000, 4000),
+                        dtype=torch.float32):
+    """Time and error of the radial and charge radial terms evaluated and
+    interpolated from splines of several resolutions."""
+    computer = aev_computer()
+    Rcr, EtaR, ShfR = computer.Rcr, computer.EtaR.to(dtype), computer.ShfR.to(dtype)
+    results = []
+    for num in num_pairs:
+        distances = (torch.rand(num, dtype=dtype) * Rcr).requires_grad_()
+        charges = torch.rand(num, dtype=dtype) * 2 - 1
+        expected = radial_charge_terms(Rcr, EtaR, ShfR, distances, charges)
+        results.append({'benchmark': 'radial_spline', 'method': 'evaluated',
+                        'num_pairs': num,
+                        'forward_ms': timeit(lambda: radial_charge_terms(
+                            Rcr, EtaR, ShfR, distances, charges)),
+                        'forward_backward_ms': timeit(lambda: radial_charge_terms(
+                            Rcr, EtaR, ShfR, distances, charges).sum().backward())})
+        for intervals in num_intervals:
+            table = radial_spline_table(Rcr, computer.EtaR, computer.ShfR, intervals).to(dtype)
+            terms = tabulated_radial_charge_terms(Rcr, table, distances, charges)
+            results.append({'benchmark': 'radial_spline', 'method': 'spline',
+                            'num_pairs': num, 'num_intervals': intervals,
+                            'error_bound': radial_spline_error_bound(
+                                Rcr, computer.EtaR, computer.ShfR, intervals),
+                            'max_error': float((terms - expected).detach().abs().max()),
+                            'forward_ms': timeit(lambda: tabulated_radial_charge_terms(
+                                Rcr, table, distances, charges)),
+                            'forward_backward_ms': timeit(lambda: tabulated_radial_charge_terms(
+                                Rcr, table, distances, charges).sum().backward())})
+    return results
+
+
+def bench_scaling(atoms=(10, 100, 500, 1000, 2000, 5000), periodic=(False, True),
+                  cutoffs=((5.2, 3.5), (6.0, 4.0)), dtypes=('float32', 'float64'),
+                  threads=(1, torch.get_num_threads()), repeats=3):
+    """Time the forward and the forward and backward passes of
+    `AEVComputer` (forces and charge derivatives) and of
+    `torchani.AEVComputer`, and the largest difference of their radial and
+    angular AEVs."""
+    results = []
+    default_threads = torch.get_num_threads()
+    for num_threads in sorted(set(threads)):
+        torch.set_num_threads(num_threads)
+        for Rcr, Rca in cutoffs:
+            computer = AEVComputer.cover_linearly(Rcr, Rca, 16.0, 8.0, 16, 4, 32.0, 8, 1)
+            reference = torchani_computer(computer)
+            for dtype_name in dtypes:
+                dtype = getattr(torch, dtype_name)
+                for num in atoms:
+                    species, coordinates, charges = random_system(num, dtype=dtype)
+                    charges = charges.flatten()
+                    for pbc_on in periodic:
+                        cell = pbc = None
+                        if pbc_on:
+                            cell = torch.eye(3, dtype=dtype) * (num / 0.1) ** (1 / 3)
+                            pbc = torch.ones(3, dtype=torch.bool)
+                        inputs = (species, coordinates, charges)
+
+                        def forward():
+                            with torch.no_grad():
+                                return computer(inputs, cell, pbc).aevs
+
+                        def backward():
+                            coords = coordinates.clone().requires_grad_()
+                            chrgs = charges.clone().requires_grad_()
+                            aevs = computer((species, coords, chrgs), cell, pbc).aevs
+                            return torch.autograd.grad(aevs.sum(), (coords, chrgs))
+
+                        result = {'benchmark': 'scaling', 'num_atoms': num,
+                                  'pbc': pbc_on, 'Rcr': Rcr, 'Rca': Rca,
+                                  'dtype': dtype_name, 'threads': num_threads,
+                                  'forward_ms': timeit(forward, repeats),
+                                  'forward_backward_ms': timeit(backward, repeats)}
+                        if reference is not None:
+                            reference.module.to(dtype)
+
+                            def reference_forward():
+                                with torch.no_grad():
+                                    return reference(species, coordinates, cell, pbc)
+
+                            def reference_backward():
+                                coords = coordinates.clone().requires_grad_()
+                                aevs = reference(species, coords, cell, pbc)
+                                return torch.autograd.grad(aevs.sum(), coords)
+
+                            aevs, expected = forward(), reference_forward()
+                            radial_length = computer.radial_length
+                            result.update({
+                                'torchani_forward_ms': timeit(reference_forward, repeats),
+                                'torchani_forward_backward_ms': timeit(reference_backward, repeats),
+                                'max_radial_difference': float(
+                                    (aevs[..., :radial_length] - expected[..., :radial_length]).abs().max()),
+                                'max_angular_difference': float(
+                                    (aevs[..., 2 * radial_length:] - expected[..., radial_length:]).abs().max())})
+                        results.append(result)
+    torch.set_num_threads(default_threads)
+    return results
+
+
+def bench_reduction(atoms=(1000, 5000), species=(1, 4),
+                    threads=(1, torch.get_num_threads()), repeats=5):
+    """Time the forward and the forward and backward passes of
+    `AEVComputer` with the scatter and the sorted segmented reductions of
+    the terms into the AEVs, and the largest difference of their AEVs."""
+    results = []
+    default_threads = torch.get_num_threads()
+    for num_threads in sorted(set(threads)):
+        torch.set_num_threads(num_threads)
+        for num_species in species:
+            computers = {reduction: AEVComputer.cover_linearly(
+                5.2, 3.5, 16.0, 8.0, 16, 4, 32.0, 8, num_species, reduction=reduction)
+                for reduction in REDUCTIONS}
+            for num in atoms:
+                species_, coordinates, charges = random_system(num, dtype=torch.float32)
+                species_ = torch.randint(num_species, species_.shape)
+                expected = None
+                for reduction, computer in computers.items():
+                    def forward():
+                        with torch.no_grad():
+                            return computer((species_, coordinates, charges)).aevs
+
+                    def backward():
+                        coords = coordinates.clone().requires_grad_()
+                        aevs = computer((species_, coords, charges)).aevs
+                        return torch.autograd.grad(aevs.sum(), coords)
+
+                    aevs = forward()
+                    if expected is None:
+                        expected = aevs
+                    results.append({'benchmark': 'reduction', 'reduction': reduction,
+                                    'num_atoms': num, 'num_species': num_species,
+                                    'threads': num_threads,
+                                    'max_difference': float((aevs - expected).abs().max()),
+                                    'forward_ms': timeit(forward, repeats),
+                                    'forward_backward_ms': timeit(backward, repeats)})
+    torch.set_num_threads(default_threads)
+    return results
+
+
+BENCHMARKS = {'angular': bench_angular, 'precision': bench_precision,
+              'radial_spline': bench_radial_spline, 'scaling': bench_scaling,
+              'reduction': bench_reduction}
+
+# the keys of a result that are not timings nor errors identify it
+TIMING_SUFFIX = '_ms'
+
+
+def result_key(result):
+    return tuple(sorted((name, value) for name, value in result.items()
+                        if not name.endswith(TIMING_SUFFIX) and 'error' not in name
+                        and 'difference' not in name))
+
+
+def compare(results, baseline, tolerance):
+    """Return the messages of the timings of `results` that are slower than
+    the same ones of `baseline` by more than the `tolerance` fraction."""
+    reference = {result_key(result): result for result in baseline}
+    regressions = []
+    for result in results:
+        previous = reference.get(result_key(result))
+        if previous is None:
+            continue
+        for name, value in result.items():
+            if name.endswith(TIMING_SUFFIX) and name in previous and \
+                    value > previous[name] * (1 + tolerance):
+                regressions.append('{} {}: {:.3f} ms -> {:.3f} ms'.format(
+                    dict(result_key(result)), name, previous[name], value))
+    return regressions
+
+
+def metadata():
+    try:
+        import torchani
+        torchani_version = torchani.__version__
+    except ImportError:
+        torchani_version = None
+    return {'torch': torch.__version__, 'torchani': torchani_version,
+            'python': platform.python_version(), 'machine': platform.machine(),
+            'processor': platform.processor(), 'threads': torch.get_num_threads(),
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S')}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('benchmarks', nargs='*', default=list(BENCHMARKS),
+                        choices=list(BENCHMARKS))
+    parser.add_argument('--atoms', type=int, nargs='+',
+                        help='numbers of atoms of the scaling and reduction benchmarks')
+    parser.add_argument('--threads', type=int, nargs='+',
+                        help='numbers of threads of the scaling and reduction benchmarks')
+    parser.add_argument('--json', help='write the results to this JSON file')
+    parser.add_argument('--compare', help='JSON file of previous results to compare with')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='allowed relative slowdown with --compare')
+    args = parser.parse_args()
+    options = {'atoms': args.atoms, 'threads': args.threads}
+
+    results = []
+    for name in args.benchmarks:
+        benchmark = BENCHMARKS[name]
+        parameters = inspect.signature(benchmark).parameters
+        kwargs = {option: value for option, value in options.items()
+                  if value is not None and option in parameters}
+        for result in benchmark(**kwargs):
+            print(result)
+            results.append(result)
+
+    if args.json:
+        with open(args.json, 'w') as json_file:
+            json.dump({'metadata': metadata(), 'results': results}, json_file, indent=2)
+
+    if args.compare:
+        with open(args.compare) as json_file:
+            baseline = json.load(json_file)['results']
+        regressions = compare(results, baseline, args.tolerance)
+        for regression in regressions:
+            print('slower:', regression)
+        if regressions:
+            sys.exit(1)
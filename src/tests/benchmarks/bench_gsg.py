@@ -0,0 +1,159 @@
+"""Benchmarks of the graph scattering features in `flexibletopology.mlmodels.gsg`.
+
+Run from the `src` directory, e.g.
+
+    python tests/benchmarks/bench_gsg.py wavelets
+    python tests/benchmarks/bench_gsg.py wavelets --atoms 10 50 200 --scales 2 4 6
+    python tests/benchmarks/bench_gsg.py features --atoms 50 500 --signals 5 100
+    python tests/benchmarks/bench_gsg.py features --atoms 5000 20000 --methods sparse
+    python tests/benchmarks/bench_gsg.py wavelets --json new.json --compare gsg.json
+
+`--json`, `--compare` and `--tolerance` work as in `bench_aev.py`.
+"""
+import argparse
+import inspect
+import json
+import sys
+
+import torch
+
+from bench_aev import compare, metadata, timeit
+from flexibletopology.mlmodels.gsg import WAVELET_METHODS, GSG
+from flexibletopology.utils.stats import adjacency_matrix
+
+
+def random_graph(num_atoms, dtype=torch.float64):
+    # about 20 neighbors per atom within the cutoff of 0.8
+    return torch.rand(num_atoms, 3, dtype=dtype) * (num_atoms / 20) ** (1 / 3)
+
+
+def bench_wavelets(atoms=(10, 50, 200), scales=(2, 4, 6), dtype=torch.float64,
+                   repeats=20):
+    """Time the forward and the forward and backward passes of the graph
+    wavelets of each method of `WAVELET_METHODS`, and of the matrix powers
+    of the lazy random walk they replace, and the largest difference of
+    their wavelets."""
+    results = []
+    for num_atoms in atoms:
+        positions = random_graph(num_atoms, dtype)
+        for max_wavelet_scale in scales:
+            def matrix_power(adj_mat):
+                probability_mat = gsg.lazy_random_walk(adj_mat)
+                return torch.stack([
+                    torch.matrix_power(probability_mat, 2 ** j) -
+                    torch.matrix_power(probability_mat, 2 ** (j + 1))
+                    for j in range(max_wavelet_scale)], dim=-3)
+
+            methods = {'matrix_power': matrix_power}
+            for method in ('squaring', 'spectral'):
+                gsg = GSG(max_wavelet_scale, radial_cutoff=0.8, wavelet_method=method)
+                methods[method] = gsg.wavelets
+            gsg = GSG(max_wavelet_scale, radial_cutoff=0.8)
+
+            expected = None
+            for method, wavelets in methods.items():
+                def forward():
+                    with torch.no_grad():
+                        return wavelets(adjacency_matrix(positions, 0.8))
+
+                def backward():
+                    coords = positions.clone().requires_grad_()
+                    return torch.autograd.grad(
+                        wavelets(adjacency_matrix(coords, 0.8)).sum(), coords)
+
+                values = forward()
+                if expected is None:
+                    expected = values
+                results.append({'benchmark': 'wavelets', 'method': method,
+                                'num_atoms': num_atoms,
+                                'max_wavelet_scale': max_wavelet_scale,
+                                'max_difference': float((values - expected).abs().max()),
+                                'forward_ms': timeit(forward, repeats),
+                                'forward_backward_ms': timeit(backward, repeats)})
+    return results
+
+
+def bench_features(atoms=(50, 200, 500), scales=(4,), signals=(5, 100),
+                   methods=WAVELET_METHODS, dtype=torch.float64, repeats=5):
+    """Time the forward and the forward and backward passes of `GSG` with
+    each method of `WAVELET_METHODS`, and the largest difference of their
+    features."""
+    results = []
+    for num_atoms in atoms:
+        positions = random_graph(num_atoms, dtype)
+        for num_signals in signals:
+            signals_ = torch.rand(num_atoms, num_signals, dtype=dtype)
+            for max_wavelet_scale in scales:
+                expected = None
+                for method in methods:
+                    gsg = GSG(max_wavelet_scale, radial_cutoff=0.8, wavelet_method=method)
+
+                    def forward():
+                        with torch.no_grad():
+                            return gsg(positions, signals_)
+
+                    def backward():
+                        coords = positions.clone().requires_grad_()
+                        return torch.autograd.grad(gsg(coords, signals_).sum(), coords)
+
+                    features = forward()
+                    if expected is None:
+                        expected = features
+                    results.append({'benchmark': 'features', 'method': method,
+                                    'num_atoms': num_atoms, 'num_signals': num_signals,
+                                    'max_wavelet_scale': max_wavelet_scale,
+                                    'max_difference': float((features - expected).abs().max()),
+                                    'forward_ms': timeit(forward, repeats),
+                                    'forward_backward_ms': timeit(backward, repeats)})
+    return results
+
+
+BENCHMARKS = {'wavelets': bench_wavelets, 'features': bench_features}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('benchmarks', nargs='*',
+                        help='benchmarks to run among {}, all of them by default'.format(
+                            ', '.join(BENCHMARKS)))
+    parser.add_argument('--atoms', type=int, nargs='+',
+                        help='numbers of atoms of the graphs')
+    parser.add_argument('--scales', type=int, nargs='+',
+                        help='values of max_wavelet_scale')
+    parser.add_argument('--signals', type=int, nargs='+',
+                        help='numbers of signals of the features benchmark')
+    parser.add_argument('--methods', nargs='+', choices=WAVELET_METHODS,
+                        help='wavelet methods of the features benchmark')
+    parser.add_argument('--json', help='write the results to this JSON file')
+    parser.add_argument('--compare', help='JSON file of previous results to compare with')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='allowed relative slowdown with --compare')
+    args = parser.parse_args()
+    for name in args.benchmarks:
+        if name not in BENCHMARKS:
+            parser.error('unknown benchmark {}'.format(name))
+    options = {'atoms': args.atoms, 'scales': args.scales, 'signals': args.signals,
+               'methods': args.methods}
+
+    results = []
+    for name in args.benchmarks or list(BENCHMARKS):
+        benchmark = BENCHMARKS[name]
+        parameters = inspect.signature(benchmark).parameters
+        kwargs = {option: value for option, value in options.items()
+                  if value is not None and option in parameters}
+        for result in benchmark(**kwargs):
+            print(result)
+            results.append(result)
+
+    if args.json:
+        with open(args.json, 'w') as json_file:
+            json.dump({'metadata': metadata(), 'results': results}, json_file, indent=2)
+
+    if args.compare:
+        with open(args.compare) as json_file:
+            baseline = json.load(json_file)['results']
+        regressions = compare(results, baseline, args.tolerance)
+        for regression in regressions:
+            print('slower:', regression)
+        if regressions:
+            sys.exit(1)
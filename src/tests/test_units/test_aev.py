@@ -0,0 +1,751 @@
+import pytest
+
+import torch
+
+from flexibletopology.mlmodels.aev import (AEVComputer, compute_aev,
+                                           compute_shifts,
+                                           minimum_image_applies,
+                                           neighbor_pairs,
+                                           neighbor_pairs_minimum_image,
+                                           neighbor_pairs_nopbc_all_pairs,
+                                           neighbor_pairs_nopbc_cell_list,
+                                           neighbor_pairs_nopbc_centers,
+                                           neighbor_pairs_packed,
+                                           charge_terms, radial_terms,
+                                           radial_charge_terms, angular_terms,
+                                           radial_basis,
+                                           radial_spline_table,
+                                           radial_spline_error_bound,
+                                           interpolate_radial_spline,
+                                           tabulated_radial_charge_terms,
+                                           angular_terms_acos_free,
+                                           triple_by_molecule)
+
+torch.manual_seed(11)
+
+CUTOFF = 5.2
+TOLERANCE = 1e-6
+
+
+def aev_computer(**kwargs):
+    return AEVComputer.cover_linearly(5.2, 3.5, 16.0, 8.0, 16, 4, 32.0, 8, 1,
+                                      **kwargs)
+
+
+def random_system(num_mols, num_atoms, density=0.1, dtype=torch.float64):
+    box = (num_atoms / density) ** (1 / 3)
+    coordinates = torch.rand(num_mols, num_atoms, 3, dtype=dtype) * box
+    species = torch.zeros(num_mols, num_atoms, dtype=torch.long)
+    charges = torch.rand(num_mols * num_atoms, dtype=dtype) - 0.5
+    return species, coordinates, charges
+
+
+@pytest.mark.parametrize("num_mols,num_atoms", [(1, 1), (1, 30), (3, 200)])
+def test_cell_list_pairs(num_mols, num_atoms):
+    species, coordinates, _ = random_system(num_mols, num_atoms)
+    padding_mask = torch.rand(num_mols, num_atoms) < 0.2
+
+    all_pairs = neighbor_pairs_nopbc_all_pairs(padding_mask, coordinates, CUTOFF)
+    cell_list = neighbor_pairs_nopbc_cell_list(padding_mask, coordinates, CUTOFF)
+    assert torch.equal(all_pairs, cell_list)
+
+
+def test_cell_list_aev():
+    species, coordinates, charges = random_system(1, 100)
+
+    _, ref_aevs = aev_computer(cell_list_threshold=-1)((species, coordinates, charges))
+    _, aevs = aev_computer(cell_list_threshold=0)((species, coordinates, charges))
+    assert torch.allclose(ref_aevs, aevs, atol=TOLERANCE)
+
+
+@pytest.mark.parametrize("periodic", [False, True])
+def test_verlet_list(periodic):
+    species, coordinates, charges = random_system(1, 60)
+    if periodic:
+        cell = torch.eye(3, dtype=coordinates.dtype) * 12.0
+        pbc = torch.ones(3, dtype=torch.bool)
+    else:
+        cell, pbc = None, None
+
+    reference = aev_computer()
+    verlet = aev_computer(verlet_skin=0.4)
+    for step in range(10):
+        coordinates = coordinates + (torch.rand_like(coordinates) - 0.5) * 0.1
+        _, ref_aevs = reference((species, coordinates, charges), cell, pbc)
+        _, aevs = verlet((species, coordinates, charges), cell, pbc)
+        assert torch.allclose(ref_aevs, aevs, atol=TOLERANCE)
+
+    # a molecule without atoms, twice to check the cached list
+    for step in range(2):
+        _, aevs = verlet((species[:, :0], coordinates[:, :0], charges[:0]), cell, pbc)
+        assert aevs.shape == (1, 0, ref_aevs.shape[-1])
+
+
+def test_verlet_list_pbc():
+    species, coordinates, charges = random_system(1, 60)
+    cell = torch.eye(3, dtype=coordinates.dtype) * 12.0
+    reference = aev_computer()
+    verlet = aev_computer(verlet_skin=0.4)
+    # the same coordinates and cell with another periodicity rebuild the list
+    for pbc in ([True, True, True], [True, False, True], [False, False, False]):
+        pbc = torch.tensor(pbc)
+        _, ref_aevs = reference((species, coordinates, charges), cell, pbc)
+        _, aevs = verlet((species, coordinates, charges), cell, pbc)
+        assert torch.allclose(ref_aevs, aevs, atol=TOLERANCE)
+
+
+def pair_set(atom_index12, shifts):
+    return {(int(i), int(j)) + tuple(int(s) for s in shift)
+            for i, j, shift in zip(atom_index12[0], atom_index12[1], shifts)}
+
+
+@pytest.mark.parametrize("cell", [
+    torch.diag(torch.tensor([12.0, 13.0, 14.0], dtype=torch.float64)),
+    torch.tensor([[12.0, 0.0, 0.0], [3.0, 12.5, 0.0], [-2.0, 2.5, 13.0]],
+                 dtype=torch.float64)])
+def test_minimum_image_pairs(cell):
+    _, coordinates, _ = random_system(2, 80)
+    padding_mask = torch.zeros(2, 80, dtype=torch.bool)
+    pbc = torch.ones(3, dtype=torch.bool)
+    assert minimum_image_applies(cell, pbc, CUTOFF)
+
+    shifts = compute_shifts(cell, pbc, CUTOFF)
+    ref_index12, ref_shifts = neighbor_pairs(padding_mask, coordinates, cell,
+                                             shifts, CUTOFF)
+    atom_index12, shifts = neighbor_pairs_minimum_image(padding_mask, coordinates,
+                                                        cell, pbc, CUTOFF)
+    assert pair_set(atom_index12, shifts) == pair_set(ref_index12, ref_shifts)
+    assert atom_index12.shape == ref_index12.shape
+
+
+def test_minimum_image_aev():
+    species, coordinates, charges = random_system(1, 100)
+    cell = torch.eye(3, dtype=coordinates.dtype) * 14.0
+    pbc = torch.ones(3, dtype=torch.bool)
+    computer = aev_computer()
+
+    shifts = compute_shifts(cell, pbc, CUTOFF)
+    ref_aevs = compute_aev(species, coordinates, charges, computer.triu_index,
+                           computer.constants(), computer.sizes, (cell, shifts))
+    for _ in range(2):
+        _, aevs = computer((species, coordinates, charges), cell, pbc)
+        assert torch.allclose(ref_aevs, aevs, atol=TOLERANCE)
+
+
+def test_radial_charge_terms():
+    computer = aev_computer()
+    distances = torch.rand(50, dtype=torch.float64) * CUTOFF
+    charges = torch.rand(50, dtype=torch.float64) - 0.5
+
+    fused = radial_charge_terms(CUTOFF, computer.EtaR, computer.ShfR,
+                                distances, charges)
+    ref = torch.cat([radial_terms(CUTOFF, computer.EtaR, computer.ShfR, distances),
+                     charge_terms(CUTOFF, computer.EtaR, computer.ShfR,
+                                  distances, charges)], dim=1)
+    assert torch.allclose(ref, fused, atol=TOLERANCE)
+
+
+def test_radial_charge_aev_layout():
+    species, coordinates, charges = random_system(1, 30)
+    species = torch.randint(2, species.shape)
+    computer = AEVComputer.cover_linearly(5.2, 3.5, 16.0, 8.0, 16, 4, 32.0, 8, 2)
+    _, aevs = computer((species, coordinates, charges))
+
+    # radial block of atom 0 for neighbors of species 1
+    vec = coordinates[0, 1:] - coordinates[0, 0]
+    distances = vec.norm(2, -1)
+    neighbors = ((distances <= CUTOFF) & (species[0, 1:] == 1)).nonzero().flatten()
+    ref = radial_terms(CUTOFF, computer.EtaR, computer.ShfR,
+                       distances[neighbors]).sum(0)
+    sublength = computer.radial_sublength
+    assert torch.allclose(ref, aevs[0, 0, sublength:2 * sublength], atol=TOLERANCE)
+
+
+def test_acos_free_angular_terms():
+    computer = aev_computer()
+    vectors12 = (torch.rand(2, 200, 3, dtype=torch.float64) - 0.5) * 4
+    vectors12.requires_grad_()
+    ref = angular_terms(3.5, computer.ShfZ, computer.EtaA, computer.Zeta,
+                        computer.ShfA, vectors12)
+    ref_grad, = torch.autograd.grad(ref.sum(), vectors12)
+
+    terms = angular_terms_acos_free(3.5, computer.cos_ShfZ, computer.sin_ShfZ,
+                                    computer.EtaA, computer.Zeta,
+                                    computer.ShfA, vectors12)
+    grad, = torch.autograd.grad(terms.sum(), vectors12)
+    assert torch.allclose(ref, terms, atol=TOLERANCE)
+    assert torch.allclose(ref_grad, grad, atol=TOLERANCE)
+
+
+def test_acos_free_aev_forces():
+    species, coordinates, charges = random_system(1, 40, density=0.3)
+    coordinates.requires_grad_()
+
+    _, ref_aevs = aev_computer()((species, coordinates, charges))
+    ref_forces, = torch.autograd.grad(ref_aevs.sum(), coordinates)
+    _, aevs = aev_computer(acos_free_angular=True)((species, coordinates, charges))
+    forces, = torch.autograd.grad(aevs.sum(), coordinates)
+    assert torch.allclose(ref_aevs, aevs, atol=TOLERANCE)
+    assert torch.allclose(ref_forces, forces, atol=TOLERANCE)
+
+
+@pytest.mark.parametrize("kwargs", [{}, {'small_system_threshold': -1}, {'neighbor_capacity': 64}])
+def test_acos_free_mixed_dtypes(kwargs):
+    # float32 constants with float64 coordinates, like in the OpenMM plugin
+    for num_atoms in (8, 40):
+        species, coordinates, charges = random_system(1, num_atoms, density=0.3)
+        coordinates.requires_grad_()
+        ref = aev_computer(**kwargs)
+        acos_free = aev_computer(acos_free_angular=True, **kwargs)
+        assert acos_free.cos_ShfZ.dtype == torch.float32
+
+        _, ref_aevs = ref((species, coordinates, charges))
+        ref_forces, = torch.autograd.grad(ref_aevs.sum(), coordinates)
+        _, aevs = acos_free((species, coordinates, charges))
+        forces, = torch.autograd.grad(aevs.sum(), coordinates)
+        assert torch.allclose(ref_aevs, aevs, rtol=0, atol=1e-12)
+        assert torch.allclose(ref_forces, forces, rtol=0, atol=1e-10)
+
+
+def test_triple_by_molecule():
+    atom_index12 = torch.tensor([[0, 0, 0, 0, 1, 1, 1, 2, 2, 3],
+                                 [1, 2, 3, 4, 2, 3, 4, 3, 4, 4]])
+    central_atom_index, pair_index12, sign12 = triple_by_molecule(atom_index12)
+    assert central_atom_index.tolist() == [0] * 6 + [1] * 6 + [2] * 6 + \
+        [3] * 6 + [4] * 6
+    # the two neighbors of every triplet are different pairs of its center
+    for center, pairs, signs in zip(central_atom_index, pair_index12.t(),
+                                    sign12.t()):
+        assert pairs[0] != pairs[1]
+        for pair, sign in zip(pairs, signs):
+            assert atom_index12[0 if sign == 1 else 1, pair] == center
+
+
+def test_angular_chunks():
+    species, coordinates, charges = random_system(1, 60, density=0.3)
+
+    _, ref_aevs = aev_computer()((species, coordinates, charges))
+    _, aevs = aev_computer(angular_chunk_size=100)((species, coordinates, charges))
+    assert torch.allclose(ref_aevs, aevs, atol=TOLERANCE)
+
+
+def test_batched_replicas():
+    species, coordinates, charges = random_system(4, 25)
+    charges = charges.view(4, 25)
+    computer = aev_computer()
+
+    _, aevs = computer((species, coordinates, charges))
+    for replica in range(4):
+        _, ref_aevs = computer((species[replica:replica + 1],
+                                coordinates[replica:replica + 1],
+                                charges[replica]))
+        assert torch.allclose(ref_aevs[0], aevs[replica], atol=TOLERANCE)
+
+
+@pytest.mark.parametrize("periodic", [False, True])
+@pytest.mark.parametrize("acos_free_angular", [False, True])
+def test_analytic_gradients(periodic, acos_free_angular):
+    species, coordinates, charges = random_system(2, 30, density=0.2)
+    species = torch.randint(2, species.shape)
+    coordinates.requires_grad_()
+    charges.requires_grad_()
+    if periodic:
+        cell = torch.eye(3, dtype=coordinates.dtype) * 7.0
+        pbc = torch.ones(3, dtype=torch.bool)
+    else:
+        cell, pbc = None, None
+
+    kwargs = dict(acos_free_angular=acos_free_angular, angular_chunk_size=50)
+    ref = AEVComputer.cover_linearly(5.2, 3.5, 16.0, 8.0, 16, 4, 32.0, 8, 2,
+                                     **kwargs).double()
+    analytic = AEVComputer.cover_linearly(5.2, 3.5, 16.0, 8.0, 16, 4, 32.0, 8, 2,
+                                          analytic_gradients=True,
+                                          **kwargs).double()
+
+    _, ref_aevs = ref((species, coordinates, charges), cell, pbc)
+    _, aevs = analytic((species, coordinates, charges), cell, pbc)
+    weights = torch.rand_like(aevs)
+    ref_grads = torch.autograd.grad((ref_aevs * weights).sum(), (coordinates, charges))
+    grads = torch.autograd.grad((aevs * weights).sum(), (coordinates, charges))
+    assert torch.allclose(ref_aevs, aevs, atol=TOLERANCE)
+    for ref_grad, grad in zip(ref_grads, grads):
+        assert torch.allclose(ref_grad, grad, atol=TOLERANCE)
+
+
+@pytest.mark.parametrize("acos_free_angular", [False, True])
+def test_analytic_gradients_mixed_dtypes(acos_free_angular):
+    # float32 constants with float64 coordinates, like in the OpenMM plugin
+    species, coordinates, charges = random_system(2, 30, density=0.2)
+    coordinates.requires_grad_()
+    charges.requires_grad_()
+    ref = aev_computer(acos_free_angular=acos_free_angular)
+    analytic = aev_computer(acos_free_angular=acos_free_angular, analytic_gradients=True)
+    assert ref.ShfZ.dtype == torch.float32
+
+    _, ref_aevs = ref((species, coordinates, charges))
+    _, aevs = analytic((species, coordinates, charges))
+    weights = torch.rand_like(aevs)
+    ref_grads = torch.autograd.grad((ref_aevs * weights).sum(), (coordinates, charges))
+    grads = torch.autograd.grad((aevs * weights).sum(), (coordinates, charges))
+    for ref_grad, grad in zip(ref_grads, grads):
+        assert torch.allclose(ref_grad, grad, atol=1e-10)
+
+
+def test_analytic_gradcheck():
+    species, coordinates, charges = random_system(1, 6, density=0.5)
+    species = torch.randint(2, species.shape)
+    coordinates.requires_grad_()
+    charges.requires_grad_()
+    computer = AEVComputer.cover_linearly(5.2, 3.5, 16.0, 8.0, 4, 2, 32.0, 2, 2,
+                                          analytic_gradients=True).double()
+
+    def aevs(coordinates, charges):
+        return computer((species, coordinates, charges)).aevs
+
+    assert torch.autograd.gradcheck(aevs, (coordinates, charges))
+    assert torch.autograd.gradgradcheck(aevs, (coordinates, charges))
+
+
+def test_center_pairs():
+    species, coordinates, _ = random_system(2, 80)
+    padding_mask = torch.rand(2, 80) < 0.2
+    center_mask = torch.rand(2, 80) < 0.3
+
+    all_pairs = neighbor_pairs_nopbc_all_pairs(padding_mask, coordinates, CUTOFF)
+    flat_mask = center_mask.flatten()
+    expected = all_pairs[:, flat_mask[all_pairs[0]] | flat_mask[all_pairs[1]]]
+    pairs = neighbor_pairs_nopbc_centers(padding_mask, coordinates, center_mask, CUTOFF)
+    assert torch.equal(expected, pairs)
+
+
+@pytest.mark.parametrize("periodic", [False, True])
+@pytest.mark.parametrize("analytic_gradients", [False, True])
+def test_center_aevs(periodic, analytic_gradients):
+    species, coordinates, charges = random_system(1, 60)
+    if periodic:
+        cell = torch.eye(3, dtype=coordinates.dtype) * 12.0
+        pbc = torch.ones(3, dtype=torch.bool)
+    else:
+        cell, pbc = None, None
+    centers = torch.tensor([3, 17, 42])
+    coordinates.requires_grad_()
+
+    computer = aev_computer(analytic_gradients=analytic_gradients)
+    _, ref_aevs = computer((species, coordinates, charges), cell, pbc)
+    ref_force, = torch.autograd.grad(ref_aevs[:, centers].sum(), coordinates)
+    _, aevs = computer((species, coordinates, charges), cell, pbc, centers=centers)
+    force, = torch.autograd.grad(aevs.sum(), coordinates)
+
+    others = torch.ones(60, dtype=torch.bool)
+    others[centers] = False
+    assert torch.allclose(ref_aevs[:, centers], aevs[:, centers], atol=TOLERANCE)
+    assert torch.all(aevs[:, others] == 0)
+    assert torch.allclose(ref_force, force, atol=TOLERANCE)
+
+
+@pytest.mark.parametrize("precision", ["single", "mixed"])
+@pytest.mark.parametrize("analytic_gradients", [False, True])
+def test_precision_policy(precision, analytic_gradients):
+    species, coordinates, charges = random_system(1, 80)
+    coordinates.requires_grad_()
+
+    _, ref_aevs = aev_computer()((species, coordinates, charges))
+    ref_force, = torch.autograd.grad(ref_aevs.sum(), coordinates)
+    computer = aev_computer(precision=precision, analytic_gradients=analytic_gradients)
+    _, aevs = computer((species, coordinates, charges))
+    force, = torch.autograd.grad(aevs.sum(), coordinates)
+
+    assert aevs.dtype == torch.float64 and force.dtype == torch.float64
+    assert torch.allclose(ref_aevs, aevs, rtol=1e-5, atol=1e-5)
+    assert torch.allclose(ref_force, force, rtol=1e-4, atol=1e-4)
+
+    scripted = torch.jit.script(computer)
+    assert scripted.precision == precision
+    _, scripted_aevs = scripted((species, coordinates, charges))
+    assert torch.allclose(scripted_aevs, aevs, atol=1e-5)
+
+
+@pytest.mark.parametrize("num_intervals", [100, 1000])
+def test_radial_spline_terms(num_intervals):
+    computer = aev_computer()
+    EtaR, ShfR = computer.EtaR.double(), computer.ShfR.double()
+    table = radial_spline_table(CUTOFF, EtaR, ShfR, num_intervals)
+    bound = radial_spline_error_bound(CUTOFF, EtaR, ShfR, num_intervals)
+    distances = torch.rand(5000, dtype=torch.float64) * CUTOFF
+    charges = torch.rand(5000, dtype=torch.float64) * 2 - 1
+
+    expected = radial_charge_terms(CUTOFF, EtaR, ShfR, distances, charges)
+    terms = tabulated_radial_charge_terms(CUTOFF, table, distances, charges)
+    assert (expected - terms).abs().max() <= bound
+
+    _, derivatives = radial_basis(CUTOFF, EtaR, ShfR, distances)
+    interpolated = interpolate_radial_spline(table, CUTOFF, distances, derivative=True)
+    # the error of the derivatives decreases with the cube of the spacing
+    assert torch.allclose(derivatives, interpolated, atol=1e-2 * (100 / num_intervals) ** 3)
+
+
+@pytest.mark.parametrize("analytic_gradients", [False, True])
+def test_radial_spline_aevs(analytic_gradients):
+    species, coordinates, charges = random_system(1, 60)
+    coordinates.requires_grad_()
+
+    _, ref_aevs = aev_computer()((species, coordinates, charges))
+    ref_force, = torch.autograd.grad(ref_aevs.sum(), coordinates)
+    computer = aev_computer(radial_spline_intervals=2000,
+                            analytic_gradients=analytic_gradients)
+    _, aevs = computer((species, coordinates, charges))
+    force, = torch.autograd.grad(aevs.sum(), coordinates)
+
+    assert torch.allclose(ref_aevs, aevs, atol=100 * computer.radial_spline_error)
+    assert torch.allclose(ref_force, force, atol=1e-6)
+    _, scripted_aevs = torch.jit.script(computer)((species, coordinates, charges))
+    assert torch.allclose(scripted_aevs, aevs)
+
+
+@pytest.mark.parametrize("periodic", [False, True])
+@pytest.mark.parametrize("precision", ["native", "mixed"])
+def test_geometry_cache(periodic, precision):
+    species, coordinates, charges = random_system(1, 60)
+    if periodic:
+        cell = torch.eye(3, dtype=coordinates.dtype) * 12.0
+        pbc = torch.ones(3, dtype=torch.bool)
+    else:
+        cell, pbc = None, None
+    centers = torch.tensor([1, 5, 30])
+
+    reference = aev_computer(precision=precision)
+    computer = aev_computer(precision=precision, cache_geometry=True)
+    computer((species, coordinates, charges), cell, pbc, centers=centers)
+    for step in range(3):
+        charges = (torch.rand_like(charges) - 0.5).requires_grad_()
+        _, ref_aevs = reference((species, coordinates, charges), cell, pbc, centers=centers)
+        ref_grad, = torch.autograd.grad(ref_aevs.sum(), charges)
+        _, aevs = computer((species, coordinates, charges), cell, pbc, centers=centers)
+        grad, = torch.autograd.grad(aevs.sum(), charges)
+        assert computer.geometry_cache is not None
+        assert torch.allclose(ref_aevs, aevs, atol=TOLERANCE)
+        assert torch.allclose(ref_grad, grad, atol=TOLERANCE)
+
+    # moving the atoms in place invalidates the cache
+    coordinates[0, 5] += 0.5
+    _, ref_aevs = reference((species, coordinates, charges), cell, pbc, centers=centers)
+    _, aevs = computer((species, coordinates, charges), cell, pbc, centers=centers)
+    assert torch.allclose(ref_aevs, aevs, atol=TOLERANCE)
+
+
+def test_geometry_cache_fresh_coordinates():
+    species, positions, charges = random_system(1, 60)
+    reference = aev_computer()
+    computer = aev_computer(cache_geometry=True)
+    coordinates = None
+    for step in range(20):
+        # like an MD loop, the previous coordinates are freed before new ones
+        # are allocated, likely at the same address
+        positions = positions + 0.1 * torch.randn_like(positions)
+        coordinates = None
+        coordinates = positions.clone()
+        _, ref_aevs = reference((species, coordinates, charges))
+        _, aevs = computer((species, coordinates, charges))
+        assert torch.allclose(ref_aevs, aevs, atol=TOLERANCE)
+
+
+@pytest.mark.parametrize("species_subset,channels", [
+    ([2, 0], None),
+    ([1], {'ShfR': [0, 3, 7], 'ShfA': [1, 2], 'ShfZ': [0, 5]}),
+    (None, {'ShfR': [15, 2], 'ShfZ': [4]})])
+def test_pruned_aevs(species_subset, channels):
+    num_species = 3
+    _, coordinates, charges = random_system(2, 50)
+    allowed = torch.tensor(species_subset or range(num_species))
+    species = allowed[torch.randint(len(allowed), (2, 50))]
+    species[1, -5:] = -1
+
+    full = AEVComputer.cover_linearly(5.2, 3.5, 16.0, 8.0, 16, 4, 32.0, 8, num_species)
+    pruned = AEVComputer.cover_linearly(5.2, 3.5, 16.0, 8.0, 16, 4, 32.0, 8, num_species,
+                                        species_subset=species_subset, channels=channels)
+    _, ref_aevs = full((species, coordinates, charges))
+    out_species, aevs = pruned((species, coordinates, charges))
+
+    assert torch.equal(out_species, species)
+    assert aevs.shape[-1] == pruned.aev_index.shape[0] == 2 * pruned.radial_length + pruned.angular_length
+    assert torch.allclose(ref_aevs[..., pruned.aev_index], aevs, atol=TOLERANCE)
+    _, scripted_aevs = torch.jit.script(pruned)((species, coordinates, charges))
+    assert torch.allclose(scripted_aevs, aevs)
+
+
+@pytest.mark.parametrize("periodic", [False, True])
+@pytest.mark.parametrize("acos_free_angular", [False, True])
+def test_padded_neighbors(periodic, acos_free_angular):
+    species, coordinates, charges = random_system(2, 120)
+    species[1, -10:] = -1
+    if periodic:
+        cell = torch.tensor([[11.0, 0.0, 0.0], [1.0, 11.0, 0.0], [-0.5, 1.0, 11.0]],
+                            dtype=coordinates.dtype)
+        pbc = torch.ones(3, dtype=torch.bool)
+    else:
+        cell, pbc = None, None
+    coordinates.requires_grad_()
+
+    _, ref_aevs = aev_computer(acos_free_angular=acos_free_angular)(
+        (species, coordinates, charges), cell, pbc)
+    ref_force, = torch.autograd.grad(ref_aevs.sum(), coordinates)
+    computer = aev_computer(acos_free_angular=acos_free_angular, neighbor_capacity=4,
+                            validate_padded=True)
+    _, aevs = computer((species, coordinates, charges), cell, pbc)
+    force, = torch.autograd.grad(aevs.sum(), coordinates)
+
+    # the capacities were grown from 4
+    assert computer.neighbor_capacity > 4 and computer.angular_capacity > 4
+    assert torch.allclose(ref_aevs, aevs, atol=TOLERANCE)
+    assert torch.allclose(ref_force, force, atol=TOLERANCE)
+    _, scripted_aevs = torch.jit.script(computer)((species, coordinates, charges), cell, pbc)
+    assert torch.allclose(scripted_aevs, aevs)
+
+
+@pytest.mark.parametrize("periodic", [False, True])
+def test_padded_neighbors_deferred_check(periodic):
+    species, coordinates, charges = random_system(2, 120)
+    species[1, -10:] = -1
+    if periodic:
+        cell = torch.tensor([[11.0, 0.0, 0.0], [1.0, 11.0, 0.0], [-0.5, 1.0, 11.0]],
+                            dtype=coordinates.dtype)
+        pbc = torch.ones(3, dtype=torch.bool)
+    else:
+        cell, pbc = None, None
+
+    _, ref_aevs = aev_computer()((species, coordinates, charges), cell, pbc)
+    computer = aev_computer(neighbor_capacity=4)
+    for module in [computer, torch.jit.script(computer)]:
+        module.neighbor_capacity = module.angular_capacity = 4
+        # the calls do not check the capacities, the check grows them
+        _, aevs = module((species, coordinates, charges), cell, pbc)
+        assert not torch.allclose(ref_aevs, aevs, atol=TOLERANCE)
+        assert module.check_padded_neighbors()
+        assert module.neighbor_capacity > 4 and module.angular_capacity > 4
+        _, aevs = module((species, coordinates, charges), cell, pbc)
+        assert torch.allclose(ref_aevs, aevs, atol=TOLERANCE)
+        assert not module.check_padded_neighbors()
+
+    if periodic:
+        # a cell too small for the minimum image convention is found by the check
+        computer((species, coordinates, charges), cell / 2, pbc)
+        with pytest.raises(AssertionError):
+            computer.check_padded_neighbors()
+        assert not computer.check_padded_neighbors()
+
+
+@pytest.mark.parametrize("rebuild_tolerance", [0.0, 0.5])
+def test_static_environment(rebuild_tolerance):
+    species, coordinates, charges = random_system(1, 300)
+    charges = charges.view(1, -1)
+    num_mobile = 20
+    computer = aev_computer(analytic_gradients=True)
+    reference = aev_computer()
+
+    for step in range(3):
+        # the environment moves a little, the mobile atoms a lot
+        coordinates = coordinates.clone()
+        coordinates[:, num_mobile:] += (torch.rand_like(coordinates[:, num_mobile:]) - 0.5) * 0.1
+        coordinates[:, :num_mobile] += (torch.rand_like(coordinates[:, :num_mobile]) - 0.5) * 2.0
+        computer.set_environment(species[0, num_mobile:], coordinates[0, num_mobile:],
+                                 charges[0, num_mobile:], rebuild_tolerance)
+        mobile = coordinates[:, :num_mobile].clone().requires_grad_()
+        _, aevs = computer((species[:, :num_mobile], mobile, charges[:, :num_mobile]))
+        force, = torch.autograd.grad(aevs.sum(), mobile)
+
+        full = coordinates.clone().requires_grad_()
+        _, ref_aevs = reference((species, full, charges))
+        ref_aevs = ref_aevs[:, :num_mobile]
+        ref_force, = torch.autograd.grad(ref_aevs.sum(), full)
+        assert torch.allclose(ref_aevs, aevs, atol=TOLERANCE)
+        assert torch.allclose(ref_force[:, :num_mobile], force, atol=TOLERANCE)
+
+    computer.clear_environment()
+    _, aevs = computer((species, coordinates, charges))
+    assert aevs.shape[1] == species.shape[1]
+
+
+@pytest.mark.parametrize("analytic_gradients", [False, True])
+def test_reused_buffers(analytic_gradients):
+    computer = aev_computer(reuse_buffers=True, analytic_gradients=analytic_gradients).double()
+    reference = aev_computer().double()
+    systems = [random_system(2, 40), random_system(2, 40), random_system(1, 60)]
+
+    # the gradients of earlier calls are still right after the buffers are reused
+    inputs, aevs, ref_aevs = [], [], []
+    for species, coordinates, charges in systems:
+        coordinates = coordinates.clone().requires_grad_()
+        inputs.append(coordinates)
+        aevs.append(computer((species, coordinates, charges))[1])
+        ref_aevs.append(reference((species, coordinates, charges))[1])
+    assert set(computer.workspace) == {'radial_charge', 'angular'}
+    for coordinates, aev, ref_aev in zip(inputs, aevs, ref_aevs):
+        assert torch.allclose(ref_aev, aev, atol=TOLERANCE)
+        force, = torch.autograd.grad(aev.sum(), coordinates)
+        ref_force, = torch.autograd.grad(ref_aev.sum(), coordinates)
+        assert torch.allclose(ref_force, force, atol=TOLERANCE)
+
+    scripted = torch.jit.script(aev_computer(reuse_buffers=True).double())
+    for species, coordinates, charges in systems:
+        _, aev = scripted((species, coordinates, charges))
+        assert torch.allclose(reference((species, coordinates, charges))[1], aev, atol=TOLERANCE)
+    scripted.clear_workspace()
+
+
+@pytest.mark.parametrize("periodic", [False, True])
+@pytest.mark.parametrize("analytic_gradients", [False, True])
+def test_segment_reduction(periodic, analytic_gradients):
+    species, coordinates, charges = random_system(2, 60, density=0.2)
+    species = torch.randint(2, species.shape)
+    coordinates.requires_grad_()
+    if periodic:
+        cell = torch.eye(3, dtype=coordinates.dtype) * 7.0
+        pbc = torch.ones(3, dtype=torch.bool)
+    else:
+        cell, pbc = None, None
+    centers = torch.tensor([0, 5, 17])
+
+    kwargs = dict(analytic_gradients=analytic_gradients, angular_chunk_size=100)
+    ref = AEVComputer.cover_linearly(5.2, 3.5, 16.0, 8.0, 16, 4, 32.0, 8, 2, **kwargs).double()
+    segment = AEVComputer.cover_linearly(5.2, 3.5, 16.0, 8.0, 16, 4, 32.0, 8, 2,
+                                         reduction='segment', **kwargs).double()
+    for centers_ in [None, centers]:
+        _, ref_aevs = ref((species, coordinates, charges), cell, pbc, centers=centers_)
+        _, aevs = segment((species, coordinates, charges), cell, pbc, centers=centers_)
+        weights = torch.rand_like(aevs)
+        ref_force, = torch.autograd.grad((ref_aevs * weights).sum(), coordinates)
+        force, = torch.autograd.grad((aevs * weights).sum(), coordinates)
+        assert torch.allclose(ref_aevs, aevs, atol=TOLERANCE)
+        assert torch.allclose(ref_force, force, atol=TOLERANCE)
+
+    _, ref_aevs = ref((species, coordinates.detach(), charges), cell, pbc)
+    _, aevs = torch.jit.script(segment)((species, coordinates.detach(), charges), cell, pbc)
+    assert torch.allclose(ref_aevs, aevs, atol=TOLERANCE)
+
+
+def test_packed_molecules():
+    sizes = [1, 7, 30, 12, 45]
+    molecule_offsets = torch.tensor([0] + sizes).cumsum(0)
+    molecules = [random_system(1, size) for size in sizes]
+    species = torch.cat([torch.randint(2, (size,)) for size in sizes])
+    coordinates = torch.cat([molecule[1][0] for molecule in molecules]).requires_grad_()
+    charges = torch.cat([molecule[2] for molecule in molecules])
+
+    pairs = neighbor_pairs_packed(coordinates, molecule_offsets, CUTOFF)
+    molecule = torch.repeat_interleave(torch.arange(len(sizes)), torch.tensor(sizes))
+    assert (molecule[pairs[0]] == molecule[pairs[1]]).all()
+
+    # the padded batch of the same molecules
+    padded_species = torch.full((len(sizes), max(sizes)), -1, dtype=torch.long)
+    padded_coordinates = torch.zeros(len(sizes), max(sizes), 3, dtype=coordinates.dtype)
+    padded_charges = torch.zeros(len(sizes), max(sizes), dtype=charges.dtype)
+    for index, (start, size) in enumerate(zip(molecule_offsets.tolist(), sizes)):
+        padded_species[index, :size] = species[start:start + size]
+        padded_coordinates[index, :size] = coordinates[start:start + size]
+        padded_charges[index, :size] = charges[start:start + size]
+    is_atom = padded_species != -1
+
+    ref = AEVComputer.cover_linearly(5.2, 3.5, 16.0, 8.0, 16, 4, 32.0, 8, 2).double()
+    _, ref_aevs = ref((padded_species, padded_coordinates, padded_charges))
+    ref_aevs = ref_aevs[is_atom]
+    for computer in [ref, torch.jit.script(ref)]:
+        _, aevs = computer.forward_packed(species, coordinates, charges, molecule_offsets)
+        assert aevs.shape == (sum(sizes), ref_aevs.shape[-1])
+        assert torch.allclose(ref_aevs, aevs, atol=TOLERANCE)
+
+    weights = torch.rand_like(aevs)
+    force, = torch.autograd.grad((aevs * weights).sum(), coordinates)
+    ref_force, = torch.autograd.grad((ref_aevs * weights).sum(), coordinates)
+    assert torch.allclose(ref_force, force, atol=TOLERANCE)
+
+
+@pytest.mark.parametrize("box", [7.0, 12.0])
+@pytest.mark.parametrize("kwargs", [{}, {'verlet_skin': 1.0}, {'neighbor_capacity': 64}])
+def test_per_frame_cells(box, kwargs):
+    species, coordinates, charges = random_system(3, 40, density=0.2)
+    species = torch.randint(2, species.shape)
+    cell = torch.diag_embed(box * (1 + 0.1 * torch.rand(3, 3, dtype=coordinates.dtype)))
+    cell[1, 1, 0] = 0.5
+    cell.requires_grad_()
+    pbc = torch.ones(3, dtype=torch.bool)
+    if 'neighbor_capacity' in kwargs and not minimum_image_applies(cell, pbc, CUTOFF):
+        pytest.skip("the padded neighbor list needs the minimum image convention")
+
+    computer = AEVComputer.cover_linearly(5.2, 3.5, 16.0, 8.0, 16, 4, 32.0, 8, 2, **kwargs).double()
+    ref = AEVComputer.cover_linearly(5.2, 3.5, 16.0, 8.0, 16, 4, 32.0, 8, 2).double()
+    for module in [computer, torch.jit.script(computer)]:
+        _, aevs = module((species, coordinates, charges), cell, pbc)
+        for frame in range(3):
+            _, ref_aevs = ref((species[frame:frame + 1], coordinates[frame:frame + 1],
+                               charges.view(3, -1)[frame]), cell[frame], pbc)
+            assert torch.allclose(ref_aevs[0], aevs[frame], atol=TOLERANCE)
+
+    if not kwargs:
+        # the derivatives with respect to the cells of all the frames
+        weights = torch.rand_like(aevs)
+        stress, = torch.autograd.grad((aevs * weights).sum(), cell)
+        for frame in range(3):
+            frame_cell = cell[frame].detach().requires_grad_()
+            _, ref_aevs = ref((species[frame:frame + 1], coordinates[frame:frame + 1],
+                               charges.view(3, -1)[frame]), frame_cell, pbc)
+            ref_stress, = torch.autograd.grad((ref_aevs[0] * weights[frame]).sum(), frame_cell)
+            assert torch.allclose(ref_stress, stress[frame], atol=TOLERANCE)
+
+
+@pytest.mark.parametrize("num_atoms", [3, 6, 10])
+@pytest.mark.parametrize("acos_free_angular", [False, True])
+def test_small_systems(num_atoms, acos_free_angular):
+    species, coordinates, charges = random_system(3, num_atoms)
+    species = torch.randint(2, species.shape)
+    species[1, -1] = -1
+    coordinates.requires_grad_()
+
+    kwargs = dict(acos_free_angular=acos_free_angular)
+    ref = AEVComputer.cover_linearly(5.2, 3.5, 16.0, 8.0, 16, 4, 32.0, 8, 2,
+                                     small_system_threshold=-1, **kwargs).double()
+    dense = AEVComputer.cover_linearly(5.2, 3.5, 16.0, 8.0, 16, 4, 32.0, 8, 2,
+                                       small_system_threshold=10, **kwargs).double()
+    assert dense.is_small_system(species, None, None)
+    _, ref_aevs = ref((species, coordinates, charges))
+    weights = torch.rand_like(ref_aevs)
+    ref_force, = torch.autograd.grad((ref_aevs * weights).sum(), coordinates)
+    for computer in [dense, torch.jit.script(dense)]:
+        _, aevs = computer((species, coordinates, charges))
+        force, = torch.autograd.grad((aevs * weights).sum(), coordinates)
+        assert torch.allclose(ref_aevs, aevs, atol=TOLERANCE)
+        assert torch.allclose(ref_force, force, atol=TOLERANCE)
+
+
+@pytest.mark.parametrize("species_subset,channels", [
+    ([2, 0], None),
+    ([1, 2], {'EtaR': [0], 'ShfR': [0, 3], 'ShfZ': [3]})])
+def test_small_pruned_systems(species_subset, channels):
+    species, coordinates, charges = random_system(3, 8)
+    species = torch.tensor(species_subset)[torch.randint(len(species_subset), species.shape)]
+    kwargs = dict(species_subset=species_subset, channels=channels)
+    ref = AEVComputer.cover_linearly(5.2, 3.5, 16.0, 8.0, 16, 4, 32.0, 8, 3,
+                                     small_system_threshold=-1, **kwargs).double()
+    dense = AEVComputer.cover_linearly(5.2, 3.5, 16.0, 8.0, 16, 4, 32.0, 8, 3,
+                                       small_system_threshold=10, **kwargs).double()
+    assert dense.is_small_system(species, None, None)
+    _, ref_aevs = ref((species, coordinates, charges))
+    _, aevs = dense((species, coordinates, charges))
+    assert torch.allclose(ref_aevs, aevs, atol=TOLERANCE)
+
+
+@pytest.mark.parametrize("kwargs", [{'angular_chunk_size': 100}, {'reuse_buffers': True},
+                                    {'reduction': 'segment'}])
+def test_small_systems_options(kwargs):
+    species, _, _ = random_system(3, 4)
+    assert aev_computer().is_small_system(species, None, None)
+    assert not aev_computer(**kwargs).is_small_system(species, None, None)
+
+
+def test_small_systems_default_sizes():
+    # the dense path only takes the sizes where it is faster than the pairs
+    computer = aev_computer()
+    for num_atoms in range(8):
+        species, coordinates, charges = random_system(1, num_atoms)
+        assert computer.is_small_system(species, None, None) == (3 <= num_atoms <= 5)
+        _, aevs = computer((species, coordinates, charges))
+        assert aevs.shape[1] == num_atoms
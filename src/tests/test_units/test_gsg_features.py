@@ -0,0 +1,121 @@
+import torch
+
+from flexibletopology.mlmodels.gsg import GSG
+from flexibletopology.utils.stats import (adjacency_matrix, sparse_adjacency_matrix,
+                                          skew, kurtosis)
+
+torch.manual_seed(11)
+
+TOLERANCE = 1e-10
+NUM_ATOMS = 8
+NUM_SIGNALS = 5
+
+
+def random_graph(*batch):
+    positions = torch.rand(*batch, NUM_ATOMS, 3, dtype=torch.float64)
+    signals = torch.rand(*batch, NUM_ATOMS, NUM_SIGNALS, dtype=torch.float64)
+    return positions, signals
+
+
+def test_batched_features():
+    positions, signals = random_graph(3)
+    gsg = GSG(radial_cutoff=0.9)
+
+    features = gsg(positions, signals)
+    for replica in range(3):
+        ref = gsg(positions[replica], signals[replica])
+        assert torch.allclose(ref, features[replica], atol=TOLERANCE)
+
+
+def test_wavelets_and_second_order():
+    positions, signals = random_graph(2)
+    gsg = GSG(radial_cutoff=0.9)
+    probability_mat = gsg.lazy_random_walk(adjacency_matrix(positions, 0.9))
+
+    wavelets = gsg.graph_wavelet(probability_mat)
+    for j in range(gsg.max_wavelet_scale):
+        ref = torch.matrix_power(probability_mat, 2 ** j) - \
+            torch.matrix_power(probability_mat, 2 ** (j + 1))
+        assert torch.allclose(ref, wavelets[..., j, :, :], atol=TOLERANCE)
+
+    wavelet_signals = torch.abs(wavelets @ signals.unsqueeze(-3))
+    coefficients = torch.abs(torch.cat([wavelets[..., i, :, :].unsqueeze(-3) @
+                                        wavelet_signals[..., :i, :, :]
+                                        for i in range(1, gsg.max_wavelet_scale)], dim=-3))
+    ref = torch.stack([coefficients.mean(-2), coefficients.var(-2, unbiased=False),
+                       skew(coefficients, dim=-2), kurtosis(coefficients, dim=-2)], dim=-3)
+    features = gsg.second_order_feature(wavelets, signals)
+    assert torch.allclose(ref.flatten(-3).unsqueeze(-1), features, atol=TOLERANCE)
+
+
+def test_spectral_wavelets():
+    positions, signals = random_graph(2)
+    # within the cutoff of each other, so that no atom is isolated and the
+    # degrees are not zero
+    positions = 0.5 * positions
+    # a square has a repeated eigenvalue, where the gradient of eigh diverges
+    square = torch.tensor([[0.0, 0.0, 0.0], [0.3, 0.0, 0.0],
+                           [0.3, 0.3, 0.0], [0.0, 0.3, 0.0]], dtype=torch.float64)
+    gsg = GSG(radial_cutoff=0.9)
+    spectral_gsg = torch.jit.script(GSG(radial_cutoff=0.9, wavelet_method='spectral'))
+
+    for coords in (positions, square):
+        coords = coords.clone().requires_grad_()
+        wavelets = gsg.wavelets(adjacency_matrix(coords, 0.9))
+        spectral_wavelets = spectral_gsg.wavelets(adjacency_matrix(coords, 0.9))
+        assert torch.allclose(wavelets, spectral_wavelets, atol=TOLERANCE)
+
+        weights = torch.rand_like(wavelets)
+        grad, = torch.autograd.grad((wavelets * weights).sum(), coords)
+        spectral_grad, = torch.autograd.grad((spectral_wavelets * weights).sum(), coords)
+        assert torch.allclose(grad, spectral_grad, atol=TOLERANCE)
+
+    assert torch.allclose(gsg(positions, signals), spectral_gsg(positions, signals),
+                          atol=TOLERANCE)
+
+
+def test_matrix_free_features():
+    positions, signals = random_graph(2)
+    gsg = GSG(radial_cutoff=0.9)
+    matrix_free_gsg = torch.jit.script(GSG(radial_cutoff=0.9, wavelet_method='matrix_free'))
+
+    probability_mat = gsg.lazy_random_walk(adjacency_matrix(positions, 0.9))
+    ref = torch.matmul(gsg.graph_wavelet(probability_mat), signals.unsqueeze(-3))
+    wavelet_signals = matrix_free_gsg.matrix_free_wavelet_signals(probability_mat, signals)
+    assert torch.allclose(ref, wavelet_signals, atol=TOLERANCE)
+
+    for sm_operators in ((True, True, True), (False, False, True)):
+        gsg.sm_operators = sm_operators
+        matrix_free_gsg = GSG(radial_cutoff=0.9, sm_operators=sm_operators,
+                              wavelet_method='matrix_free')
+        coords = positions.clone().requires_grad_()
+        features = gsg(coords, signals)
+        matrix_free_features = matrix_free_gsg(coords, signals)
+        assert torch.allclose(features, matrix_free_features, atol=TOLERANCE)
+
+        grad, = torch.autograd.grad(features.sum(), coords)
+        matrix_free_grad, = torch.autograd.grad(matrix_free_features.sum(), coords)
+        assert torch.allclose(grad, matrix_free_grad, atol=TOLERANCE)
+
+
+def test_sparse_features():
+    positions, signals = random_graph(2)
+    edge_index, adj = sparse_adjacency_matrix(positions, 0.9)
+    ref = adjacency_matrix(positions, 0.9).flatten(0, 1)
+    assert torch.allclose(ref[edge_index[0], edge_index[1] % NUM_ATOMS], adj,
+                          atol=TOLERANCE)
+    assert edge_index.shape[1] == int((ref > 0).sum())
+
+    gsg = GSG(radial_cutoff=0.9)
+    sparse_gsg = torch.jit.script(GSG(radial_cutoff=0.9, wavelet_method='sparse'))
+    for coords, signals_ in ((positions, signals), (positions[0], signals[0])):
+        coords = coords.clone().requires_grad_()
+        features = gsg(coords, signals_)
+        sparse_features = sparse_gsg(coords, signals_)
+        assert torch.allclose(features, sparse_features, atol=TOLERANCE)
+        with torch.no_grad():
+            assert torch.allclose(features, sparse_gsg(coords, signals_), atol=TOLERANCE)
+
+        grad, = torch.autograd.grad(features.sum(), coords)
+        sparse_grad, = torch.autograd.grad(sparse_features.sum(), coords)
+        assert torch.allclose(grad, sparse_grad, atol=TOLERANCE)
@@ -36,3 +36,14 @@ def test_moment():
     sci_moment = sci_stats.moment(DATA.numpy(), moment=MOMENT, axis=AXIS)
     assert eq(np.round(fltop_moment.numpy(), PRECISION),
               np.round(sci_moment, PRECISION))
+
+
+def test_central_moments():
+    mean, var, third, fourth = fltop_stats.central_moments(DATA, dim=AXIS)
+    sci_moments = [sci_stats.moment(DATA.numpy(), moment=order, axis=AXIS)
+                   for order in (2, 3, 4)]
+    assert eq(np.round(mean.numpy(), PRECISION),
+              np.round(DATA.numpy().mean(axis=AXIS), PRECISION))
+    for fltop_moment, sci_moment in zip((var, third, fourth), sci_moments):
+        assert eq(np.round(fltop_moment.numpy(), PRECISION),
+                  np.round(sci_moment, PRECISION))